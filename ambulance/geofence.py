@@ -0,0 +1,420 @@
+import logging
+import math
+import threading
+import time
+from enum import Enum
+
+from django.conf import settings
+from django.db import transaction
+
+from emstrack.latlon import calculate_distance
+
+logger = logging.getLogger(__name__)
+
+# meters in one degree of latitude
+meters_per_degree = 111320
+
+
+class GeofenceType(Enum):
+    w = 'waypoint'
+
+
+class GeofenceEventType(Enum):
+    A = 'arrival'
+    D = 'departure'
+
+
+class Geofence:
+    """
+    A circular fence around a location.
+
+    Waypoint fences are restricted to the ambulance of the ambulance call.
+    Sources are the (model name, id) pairs whose changes affect the fence.
+    """
+
+    def __init__(self, type, id, location, radius, ambulance_id=None, location_type=None, sources=()):
+        self.type = type
+        self.id = id
+        self.location = location
+        self.radius = radius
+        self.ambulance_id = ambulance_id
+        self.location_type = location_type
+        self.sources = sources
+
+    @property
+    def key(self):
+        return self.type.name, self.id
+
+    def applies_to(self, ambulance_id):
+        return self.ambulance_id is None or self.ambulance_id == ambulance_id
+
+    def distance(self, location):
+        return calculate_distance(self.location, location)
+
+    def __str__(self):
+        return "{}({}) @{} r={}".format(self.type.value, self.id, self.location, self.radius)
+
+
+class GeofenceEvent:
+
+    def __init__(self, type, ambulance_id, fence):
+        self.type = type
+        self.ambulance_id = ambulance_id
+        self.fence = fence
+
+    def is_arrival(self):
+        return self.type == GeofenceEventType.A
+
+    def is_departure(self):
+        return self.type == GeofenceEventType.D
+
+    def __str__(self):
+        return "{} of ambulance {} at {}".format(self.type.value, self.ambulance_id, self.fence)
+
+
+class GeofenceGrid:
+    """
+    Uniform grid index of fences.
+
+    Each fence is added to every cell its bounding box overlaps, so that
+    a position only has to be tested against the fences of its own cell.
+    """
+
+    def __init__(self, cell_size):
+        # cell size in degrees
+        self.cell_size = cell_size
+        self.cells = {}
+        self.fences = {}
+        self.sources = {}
+
+    def cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell_size),
+                math.floor(longitude / self.cell_size))
+
+    def get_cells(self, fence):
+
+        # bounding box in degrees
+        latitude, longitude = fence.location.y, fence.location.x
+        d_lat = fence.radius / meters_per_degree
+        d_lon = fence.radius / (meters_per_degree * max(math.cos(math.radians(latitude)), 1e-6))
+
+        (i1, j1) = self.cell(latitude - d_lat, longitude - d_lon)
+        (i2, j2) = self.cell(latitude + d_lat, longitude + d_lon)
+        return [(i, j) for i in range(i1, i2 + 1) for j in range(j1, j2 + 1)]
+
+    def add(self, fence):
+
+        # replace existing fence
+        self.remove(fence.key)
+
+        for cell in self.get_cells(fence):
+            self.cells.setdefault(cell, []).append(fence)
+
+        self.fences[fence.key] = fence
+        for source in fence.sources:
+            self.sources.setdefault(source, set()).add(fence.key)
+
+    def remove(self, key):
+
+        fence = self.fences.pop(key, None)
+        if fence is None:
+            return
+
+        for cell in self.get_cells(fence):
+            fences = self.cells.get(cell)
+            if fences is not None and fence in fences:
+                fences.remove(fence)
+
+        for source in fence.sources:
+            keys = self.sources.get(source)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.sources[source]
+
+    def remove_source(self, source):
+
+        for key in list(self.sources.get(source, ())):
+            self.remove(key)
+
+    def get(self, key):
+        return self.fences.get(key)
+
+    def candidates(self, location):
+        return self.cells.get(self.cell(location.y, location.x), ())
+
+    def __len__(self):
+        return len(self.fences)
+
+
+# waypoint lookup by source model
+WaypointSources = {
+    'waypoint': 'id',
+    'ambulancecall': 'ambulance_call_id',
+    'call': 'ambulance_call__call_id',
+    'location': 'location_id',
+}
+
+
+class GeofenceEngine:
+    """
+    Detect ambulance arrivals at and departures from the waypoints of their calls.
+
+    Hospitals and bases are only fences when they are waypoints, since arrival
+    there without a call does not change the ambulance status.
+
+    The index is built from the database once. Changes made in this process
+    are applied to it incrementally and changes made by other processes,
+    signalled through GeofenceVersion, rebuild it. The version is checked at
+    most once every SYNC_SECONDS, so testing a position does not hit the database.
+    """
+
+    def __init__(self, radius=None, hysteresis=None, refresh_seconds=None, sync_seconds=None):
+
+        options = getattr(settings, 'GEOFENCE', {})
+        self.radius = radius if radius is not None else options.get('RADIUS', 50)
+        self.hysteresis = hysteresis if hysteresis is not None else options.get('HYSTERESIS', 0.2)
+        self.refresh_seconds = refresh_seconds if refresh_seconds is not None \
+            else options.get('REFRESH_SECONDS', 60)
+        self.sync_seconds = sync_seconds if sync_seconds is not None \
+            else options.get('SYNC_SECONDS', 1)
+
+        self.grid = None
+        self.built_on = None
+        self.synced_on = None
+        self.version = None
+        self.changes = []
+        self.lock = threading.Lock()
+
+        # fences each ambulance is currently inside of
+        self.inside = {}
+
+    def changed(self, source, deleted=False):
+        """
+        Record a change to the waypoints of source, a (model name, id) pair.
+
+        The change is applied before testing the next position, and once more
+        after commit, when it is also signalled to the other processes.
+        """
+
+        with self.lock:
+            self.changes.append((source, deleted))
+
+        def commit():
+            with self.lock:
+                self.changes.append((source, deleted))
+            self.signal()
+
+        transaction.on_commit(commit)
+
+    def signal(self):
+
+        from .models import GeofenceVersion
+
+        version = GeofenceVersion.increment()
+        with self.lock:
+            # still up to date unless another process changed fences meanwhile
+            if self.version == version - 1:
+                self.version = version
+
+    def remove(self, key):
+        """
+        Remove a fence from the index without rebuilding it.
+        """
+        with self.lock:
+            if self.grid is not None:
+                self.grid.remove(key)
+
+    def get_fences(self, source=None):
+        """
+        Return the fences of the active waypoints, or only of those of source.
+        """
+
+        from .models import Waypoint, WaypointStatus, AmbulanceCallStatus, CallStatus
+
+        # waypoints of active calls
+        waypoints = Waypoint.objects\
+            .filter(status__in=(WaypointStatus.C.name, WaypointStatus.V.name),
+                    location__isnull=False)\
+            .exclude(ambulance_call__status__in=(AmbulanceCallStatus.C.name, AmbulanceCallStatus.D.name))\
+            .exclude(ambulance_call__call__status=CallStatus.E.name)\
+            .select_related('ambulance_call', 'location')
+        if source is not None:
+            (model_name, id) = source
+            waypoints = waypoints.filter(**{WaypointSources[model_name]: id})
+
+        fences = []
+        for waypoint in waypoints:
+            fences.append(Geofence(GeofenceType.w, waypoint.id, waypoint.location.location, self.radius,
+                                   ambulance_id=waypoint.ambulance_call.ambulance_id,
+                                   location_type=waypoint.location.type,
+                                   sources=(('waypoint', waypoint.id),
+                                            ('ambulancecall', waypoint.ambulance_call_id),
+                                            ('call', waypoint.ambulance_call.call_id),
+                                            ('location', waypoint.location_id))))
+
+        return fences
+
+    def build(self):
+
+        from .models import GeofenceVersion
+
+        # read version first so that concurrent changes are not missed
+        self.version = GeofenceVersion.get_version()
+        self.changes = []
+
+        # cell size is the fence diameter
+        grid = GeofenceGrid(2 * self.radius / meters_per_degree)
+        for fence in self.get_fences():
+            grid.add(fence)
+
+        self.grid = grid
+        self.built_on = self.synced_on = time.monotonic()
+
+        logger.debug('Geofence index built with {} fences'.format(len(grid)))
+
+    def apply(self):
+
+        # last change of each source wins
+        changes = dict(self.changes)
+        self.changes = []
+
+        for (source, deleted) in changes.items():
+            self.grid.remove_source(source)
+            if not deleted:
+                for fence in self.get_fences(source):
+                    self.grid.add(fence)
+
+        logger.debug('Geofence index updated with {} changes'.format(len(changes)))
+
+    def get_grid(self):
+
+        from .models import GeofenceVersion
+
+        with self.lock:
+            now = time.monotonic()
+
+            # changed by another process?
+            if self.grid is not None and now - self.synced_on >= self.sync_seconds:
+                self.synced_on = now
+                if GeofenceVersion.get_version() != self.version:
+                    self.grid = None
+
+            if self.grid is None or now - self.built_on > self.refresh_seconds:
+                self.build()
+            elif self.changes:
+                self.apply()
+
+            return self.grid
+
+    def update(self, ambulance_id, location):
+        """
+        Test a new ambulance position and return the list of arrival and departure events.
+        """
+
+        grid = self.get_grid()
+        inside = self.inside.setdefault(ambulance_id, set())
+        events = []
+
+        # departures, with hysteresis to avoid flapping at the border
+        for key in list(inside):
+            fence = grid.get(key)
+            if fence is None:
+                # fence no longer exists
+                inside.discard(key)
+            elif fence.distance(location) > fence.radius * (1 + self.hysteresis):
+                inside.discard(key)
+                events.append(GeofenceEvent(GeofenceEventType.D, ambulance_id, fence))
+
+        # arrivals
+        for fence in grid.candidates(location):
+            if (fence.key not in inside and
+                    fence.applies_to(ambulance_id) and
+                    fence.distance(location) <= fence.radius):
+                inside.add(fence.key)
+                events.append(GeofenceEvent(GeofenceEventType.A, ambulance_id, fence))
+
+        return events
+
+    def reset(self):
+        with self.lock:
+            self.grid = None
+            self.changes = []
+            self.inside = {}
+
+
+# ambulance status on arrival at its destination, by location type
+GeofenceArrivalStatus = {
+    ('h', 'HB'): 'AH',
+    ('b', 'BB'): 'AB',
+    ('w', 'WB'): 'AW',
+    ('i', 'PB'): 'AP',
+}
+
+
+def is_destination(waypoint):
+    """
+    Is waypoint the next waypoint of an accepted ambulance call?
+    """
+
+    from .models import Waypoint, WaypointStatus, AmbulanceCallStatus
+
+    if waypoint.ambulance_call.status != AmbulanceCallStatus.A.name:
+        return False
+
+    return not Waypoint.objects\
+        .filter(ambulance_call=waypoint.ambulance_call_id, order__lt=waypoint.order,
+                status__in=(WaypointStatus.C.name, WaypointStatus.V.name))\
+        .exists()
+
+
+def apply_geofence_events(ambulance, events):
+    """
+    Update ambulance status and waypoint status from geofence events.
+
+    Ambulance status only changes on arrival at the destination of its
+    accepted call, so passing by the other waypoints does not change it.
+    Ambulance status is set on the instance, which is about to be saved.
+    Returns the list of waypoints that were changed.
+    """
+
+    from .models import Waypoint, WaypointStatus
+
+    waypoints = []
+    for event in events:
+
+        logger.debug('Geofence: {}'.format(event))
+        fence = event.fence
+
+        try:
+            waypoint = Waypoint.objects.select_related('ambulance_call').get(id=fence.id)
+        except Waypoint.DoesNotExist:
+            continue
+
+        # ambulance status
+        if event.is_arrival() and is_destination(waypoint):
+            status = GeofenceArrivalStatus.get((fence.location_type, ambulance.status))
+            if status is not None:
+                ambulance.status = status
+
+        # waypoint status
+        if event.is_arrival() and waypoint.is_created():
+            waypoint.status = WaypointStatus.V.name
+        elif event.is_departure() and waypoint.is_visiting():
+            waypoint.status = WaypointStatus.D.name
+
+            # visited waypoints are no longer fences
+            engine.remove(fence.key)
+        else:
+            continue
+
+        # the index is up to date, do not record the change on save
+        waypoint._geofence_update = True
+        waypoint.updated_by = ambulance.updated_by
+        waypoints.append(waypoint)
+
+    return waypoints
+
+
+# engine used by the ingest path
+engine = GeofenceEngine()
@@ -0,0 +1,230 @@
+import logging
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from emstrack.latlon import calculate_distance, calculate_orientation, stationary_radius
+
+logger = logging.getLogger(__name__)
+
+
+def heading_change(orientation1, orientation2):
+    """
+    Returns the smallest angle in degrees between two orientations.
+    """
+    change = abs(orientation1 - orientation2) % 360
+    return min(change, 360 - change)
+
+
+class IngestFilter:
+    """
+    Decide which ambulance location updates are worth writing and publishing.
+
+    An update is accepted if the ambulance moved more than the distance
+    threshold, turned more than the heading threshold after moving beyond
+    the stationary radius, or has not been written for longer than the
+    maximum silence interval. Suppressed updates only refresh the in-memory
+    last-seen record.
+    """
+
+    def __init__(self, distance=None, heading=None, max_silence=None, stats_interval=None):
+
+        options = getattr(settings, 'INGEST', {})
+        self.distance = distance if distance is not None else options.get('DISTANCE', stationary_radius)
+        self.heading = heading if heading is not None else options.get('HEADING', 0)
+        self.max_silence = max_silence if max_silence is not None else options.get('MAX_SILENCE', 0)
+        self.stats_interval = stats_interval if stats_interval is not None \
+            else options.get('STATS_INTERVAL', 300)
+
+        # last seen location of each ambulance
+        self.last_seen = {}
+
+        # counters
+        self.stats = {}
+        self.reset_stats()
+        self.logged_on = time.monotonic()
+
+    def reset_stats(self):
+        self.stats = {
+            'accepted': 0,
+            'heartbeats': 0,
+            'suppressed': 0,
+            'writes_avoided': 0,
+            'publishes_avoided': 0,
+        }
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def has_moved(self, ambulance, loaded_values):
+
+        distance = calculate_distance(loaded_values['location'], ambulance.location)
+        if distance > self.distance:
+            return True
+
+        # turned?
+        if self.heading and distance > stationary_radius:
+            orientation = calculate_orientation(loaded_values['location'], ambulance.location)
+            if heading_change(orientation, loaded_values['orientation']) >= self.heading:
+                return True
+
+        return False
+
+    def is_silent(self, loaded_values):
+
+        if not self.max_silence or loaded_values.get('updated_on') is None:
+            return False
+
+        silence = (timezone.now() - loaded_values['updated_on']).total_seconds()
+        return silence > self.max_silence
+
+    def accept(self, ambulance, heartbeat=False):
+
+        self.last_seen[ambulance.id] = {
+            'location': ambulance.location,
+            'timestamp': ambulance.timestamp,
+            'seen_on': timezone.now()
+        }
+
+        self.stats['accepted'] += 1
+        if heartbeat:
+            self.stats['heartbeats'] += 1
+
+    def suppress(self, ambulance):
+
+        self.last_seen[ambulance.id] = {
+            'location': ambulance.location,
+            'timestamp': ambulance.timestamp,
+            'seen_on': timezone.now()
+        }
+
+        # one write to Ambulance, one to AmbulanceUpdate and one publish avoided
+        self.stats['suppressed'] += 1
+        self.stats['writes_avoided'] += 2
+        self.stats['publishes_avoided'] += 1
+
+        self.log_stats()
+
+    def log_stats(self):
+
+        now = time.monotonic()
+        if self.stats_interval and now - self.logged_on > self.stats_interval:
+            logger.info('Ingest filter: {}'.format(self.stats))
+            self.logged_on = now
+
+
+# filter used by Ambulance.save
+ingest_filter = IngestFilter()
+
+
+# minimum interval in seconds and distance in meters between location reports, by ambulance status
+ReportingPolicyDefaults = {
+    'UK': {'interval': 30, 'distance': 50},
+    'AV': {'interval': 30, 'distance': 50},
+    'OS': {'interval': 120, 'distance': 200},
+    'PB': {'interval': 2, 'distance': 10},
+    'AP': {'interval': 10, 'distance': 20},
+    'HB': {'interval': 2, 'distance': 10},
+    'AH': {'interval': 30, 'distance': 50},
+    'BB': {'interval': 5, 'distance': 20},
+    'AB': {'interval': 120, 'distance': 200},
+    'WB': {'interval': 2, 'distance': 10},
+    'AW': {'interval': 10, 'distance': 20},
+}
+
+
+class ReportingPolicy:
+    """
+    Server-side reporting rate policy for ambulance clients.
+
+    The policy is published to clients with the settings. Location reports
+    that arrive faster and closer than the policy of the current ambulance
+    status are either tagged (counted and logged) or throttled (dropped),
+    according to mode. Reports that change anything other than the location
+    are always accepted.
+    """
+
+    MODES = ('tag', 'throttle')
+
+    def __init__(self, mode=None, load_factor=None, status=None):
+
+        options = getattr(settings, 'REPORTING_POLICY', {})
+        self.mode = mode if mode is not None else options.get('MODE', 'tag')
+        if self.mode not in self.MODES:
+            raise ValueError("Invalid reporting policy mode '{}'".format(self.mode))
+        self.load_factor = load_factor if load_factor is not None else options.get('LOAD_FACTOR', 1.0)
+
+        self.status = {k: dict(v) for (k, v) in ReportingPolicyDefaults.items()}
+        for (k, v) in (status if status is not None else options.get('STATUS', {})).items():
+            self.status.setdefault(k, {}).update(v)
+
+        # last accepted report of each client
+        self.last_report = {}
+
+        # clients exceeding the policy
+        self.violations = {}
+        self.stats = {'accepted': 0, 'tagged': 0, 'throttled': 0}
+
+    def get_policy(self):
+        """
+        Returns the policy scaled by the current load factor.
+        """
+        return {
+            'mode': self.mode,
+            'load_factor': self.load_factor,
+            'status': {k: {'interval': v['interval'] * self.load_factor,
+                           'distance': v['distance'] * self.load_factor}
+                       for (k, v) in self.status.items()}
+        }
+
+    def set_load_factor(self, load_factor):
+        self.load_factor = load_factor
+
+    def check(self, client_id, status, data):
+        """
+        Returns False if the location report should be throttled.
+        """
+
+        now = time.monotonic()
+        location = data.get('location')
+
+        # only location reports are subject to the policy
+        if location is None or set(data.keys()) - {'location', 'orientation', 'timestamp'}:
+            if location is not None:
+                self.last_report[client_id] = (now, location)
+            return True
+
+        policy = self.status.get(status)
+        last = self.last_report.get(client_id)
+        if policy is None or last is None:
+            self.last_report[client_id] = (now, location)
+            self.stats['accepted'] += 1
+            return True
+
+        (last_time, last_location) = last
+        if (now - last_time >= policy['interval'] * self.load_factor or
+                calculate_distance(last_location, location) >= policy['distance'] * self.load_factor):
+            self.last_report[client_id] = (now, location)
+            self.stats['accepted'] += 1
+            return True
+
+        # exceeds policy
+        count = self.violations.get(client_id, 0) + 1
+        self.violations[client_id] = count
+        if count == 1 or count % 100 == 0:
+            logger.info("Client '{}' exceeds reporting policy for status '{}' ({} times)".format(client_id,
+                                                                                             status,
+                                                                                             count))
+
+        if self.mode == 'throttle':
+            self.stats['throttled'] += 1
+            return False
+
+        self.last_report[client_id] = (now, location)
+        self.stats['tagged'] += 1
+        return True
+
+
+# policy used by the mqtt ingest
+reporting_policy = ReportingPolicy()
@@ -0,0 +1,108 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ambulance.models import Ambulance, AmbulanceCall, AmbulanceCallStatus, AmbulanceCapability, Call, CallStatus
+from ambulance.permissions import get_call_permissions_filter
+from login.models import UserAmbulancePermission
+from login.permissions import update_effective_permissions
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmark call permission filtering over synthetic calls'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', nargs='?', type=int, default=1000000)
+        parser.add_argument('--ambulances', nargs='?', type=int, default=200)
+        parser.add_argument('--permitted', nargs='?', type=int, default=50)
+        parser.add_argument('--ambulances-per-call', nargs='?', type=int, default=2)
+        parser.add_argument('--page-size', nargs='?', type=int, default=100)
+        parser.add_argument('--repeat', nargs='?', type=int, default=3)
+        parser.add_argument('--batch-size', nargs='?', type=int, default=10000)
+        parser.add_argument('--explain', action='store_true', help='Print query plans')
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic data')
+
+    def handle(self, *args, **options):
+
+        with transaction.atomic():
+
+            user = self.populate(**options)
+
+            # querysets
+            permitted = list(UserAmbulancePermission.objects.filter(user=user)
+                             .values_list('ambulance_id', flat=True))
+            querysets = {
+                'join + distinct': lambda: Call.objects.filter(ambulancecall__ambulance_id__in=permitted).distinct(),
+                'exists': lambda: Call.objects.filter(get_call_permissions_filter(user)),
+            }
+
+            for (name, queryset) in querysets.items():
+
+                if options['explain']:
+                    self.stdout.write('{}:\n{}'.format(name,
+                                                       queryset().order_by('-created_at', '-id')
+                                                       [:options['page_size']].explain(analyze=True)))
+
+                count = self.measure(lambda: queryset().count(), options['repeat'])
+                page = self.measure(lambda: list(queryset().order_by('-created_at', '-id')
+                                                 [:options['page_size']]),
+                                    options['repeat'])
+                self.stdout.write('{:>16}: count {:.3f}s, first page {:.3f}s'.format(name, count, page))
+
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    def measure(self, function, repeat):
+        elapsed = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            elapsed.append(time.perf_counter() - start)
+        return min(elapsed)
+
+    def populate(self, **options):
+
+        if options['verbosity'] >= 1:
+            self.stdout.write('Creating {} calls on {} ambulances'.format(options['calls'], options['ambulances']))
+
+        admin = User.objects.filter(is_superuser=True).first() or \
+            User.objects.create_superuser('callbenchmark-admin', password=None)
+        user = User.objects.create_user('callbenchmark-{}'.format(random.getrandbits(32)), password=None)
+
+        # ambulances
+        ambulances = []
+        for i in range(options['ambulances']):
+            ambulance = Ambulance(identifier='callbenchmark-{}-{}'.format(user.id, i),
+                                  capability=AmbulanceCapability.B.name,
+                                  updated_by=admin)
+            ambulance.save(publish=False)
+            ambulances.append(ambulance.id)
+
+        # permissions
+        UserAmbulancePermission.objects.bulk_create(
+            UserAmbulancePermission(user=user, ambulance_id=id, can_write=True)
+            for id in random.sample(ambulances, min(options['permitted'], len(ambulances))))
+        update_effective_permissions([user.id])
+
+        # calls and ambulance calls, in batches
+        created = 0
+        while created < options['calls']:
+            size = min(options['batch_size'], options['calls'] - created)
+            calls = Call.objects.bulk_create(Call(status=CallStatus.E.name, updated_by=admin) for _ in range(size))
+            AmbulanceCall.objects.bulk_create(
+                AmbulanceCall(call=call, ambulance_id=id, status=AmbulanceCallStatus.C.name, updated_by=admin)
+                for call in calls
+                for id in random.sample(ambulances, min(options['ambulances_per_call'], len(ambulances))))
+            created += size
+
+        # refresh planner statistics
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                for model in (Call, AmbulanceCall):
+                    cursor.execute('ANALYZE {}'.format(model._meta.db_table))
+
+        return user
@@ -1,16 +1,21 @@
+import datetime
 import logging
 from enum import Enum
 
+from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.auth.models import User
-from django.db import transaction
-from django.db.models import Max
+from django.db import IntegrityError, transaction
+from django.db.models import Max, prefetch_related_objects
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.urls import reverse
 from django.template.defaulttags import register
 from django.utils.translation import ugettext_lazy as _
 
-from emstrack.latlon import calculate_orientation, calculate_distance, stationary_radius
+from environs import Env
+
+from emstrack.latlon import calculate_orientation
 from emstrack.mixins import PublishMixin
 from emstrack.models import AddressModel, UpdatedByModel, defaults, UpdatedByHistoryModel
 from emstrack.util import make_choices
@@ -18,8 +23,13 @@ from emstrack.sms import client as sms_client
 
 from equipment.models import EquipmentHolder
 
+from .ingest import ingest_filter
+from .geofence import engine as geofence_engine
+
 logger = logging.getLogger(__name__)
 
+env = Env()
+
 
 # filters
 
@@ -155,9 +165,10 @@ class Ambulance(PublishMixin,
                               choices=make_choices(AmbulanceStatus),
                               default=AmbulanceStatus.UK.name)
 
-    # location
+    # location, not indexed so that location updates can be HOT updates
     orientation = models.FloatField(_('orientation'), default=0.0)
-    location = models.PointField(_('location'), srid=4326, default=defaults['location'])
+    location = models.PointField(_('location'), srid=4326, default=defaults['location'],
+                                 spatial_index=False)
 
     # timestamp
     timestamp = models.DateTimeField(_('timestamp'), default=timezone.now)
@@ -165,20 +176,11 @@ class Ambulance(PublishMixin,
     # active
     active = models.BooleanField(_('active'), default=True)
 
-    # default value for _loaded_values
-    _loaded_values = None
-
-    @classmethod
-    def from_db(cls, db, field_names, values):
-
-        # call super
-        instance = super(Ambulance, cls).from_db(db, field_names, values)
+    # save decides what is worth writing, see ingest_filter
+    track_changes = False
 
-        # store the original field values on the instance
-        instance._loaded_values = dict(zip(field_names, values))
-
-        # return instance
-        return instance
+    # high-frequency fields, written alone when nothing else changed
+    hot_fields = ('status', 'orientation', 'location', 'timestamp', 'updated_by', 'updated_on')
 
     def save(self, *args, **kwargs):
 
@@ -197,10 +199,12 @@ class Ambulance(PublishMixin,
 
         # has location changed?
         has_moved = False
-        if (not loaded_values) or \
-                calculate_distance(self._loaded_values['location'], self.location) > stationary_radius:
+        if (not loaded_values) or ingest_filter.has_moved(self, self._loaded_values):
             has_moved = True
 
+        # silent for too long?
+        heartbeat = loaded_values and not has_moved and ingest_filter.is_silent(self._loaded_values)
+
         # calculate orientation only if location has changed and orientation has not changed
         if has_moved and loaded_values and self._loaded_values['orientation'] == self.orientation:
             # TODO: should we allow for a small radius before updating direction?
@@ -209,16 +213,28 @@ class Ambulance(PublishMixin,
             #                                      self.location,
             #                                      self.orientation))
 
+        # detect arrivals and departures
+        waypoints = []
+        if has_moved and loaded_values and settings.GEOFENCE['ENABLED']:
+            from .geofence import engine, apply_geofence_events
+            waypoints = apply_geofence_events(self, engine.update(self.id, self.location))
+
         # logger.debug('loaded_values: {}'.format(loaded_values))
         # logger.debug('_loaded_values: {}'.format(self._loaded_values))
 
         # if comment, capability, status or location changed
         # model_changed = False
-        if has_moved or \
+        if has_moved or heartbeat or \
                 self._loaded_values['status'] != self.status or \
                 self._loaded_values['capability'] != self.capability or \
                 self._loaded_values['comment'] != self.comment:
 
+            # write only the high-frequency columns if nothing else changed
+            if loaded_values and 'update_fields' not in kwargs and \
+                    set(self.get_changed_fields()) <= {self._meta.get_field(name).attname
+                                                       for name in self.hot_fields}:
+                kwargs['update_fields'] = self.hot_fields
+
             # save to Ambulance
             super().save(*args, **kwargs)
 
@@ -235,6 +251,9 @@ class Ambulance(PublishMixin,
 
             # logger.debug('UPDATE SAVED')
 
+            # refresh last seen
+            ingest_filter.accept(self, heartbeat=heartbeat)
+
             # # model changed
             # model_changed = True
 
@@ -247,9 +266,18 @@ class Ambulance(PublishMixin,
 
             # logger.debug('SAVED')
 
+        else:
+
+            # nothing worth writing or publishing, refresh last seen only
+            ingest_filter.suppress(self)
+
             # # model changed
             # model_changed = True
 
+        # update waypoints visited by the ambulance
+        for waypoint in waypoints:
+            waypoint.save()
+
         # # Did the model change?
         # if model_changed:
         #
@@ -262,9 +290,9 @@ class Ambulance(PublishMixin,
 
         # just created?
         if created:
-            # invalidate permissions cache
-            from mqtt.cache_clear import mqtt_cache_clear
-            mqtt_cache_clear()
+            # invalidate permissions cache, once per import
+            from login.mixins import permissions_changed
+            permissions_changed([])
 
     def publish(self, **kwargs):
 
@@ -274,12 +302,14 @@ class Ambulance(PublishMixin,
 
     def delete(self, *args, **kwargs):
 
-        # invalidate permissions cache
-        from mqtt.cache_clear import mqtt_cache_clear
-        mqtt_cache_clear()
-
         # delete from Ambulance
-        super().delete(*args, **kwargs)
+        result = super().delete(*args, **kwargs)
+
+        # invalidate permissions cache, once per import
+        from login.mixins import permissions_changed
+        permissions_changed([])
+
+        return result
 
     def get_absolute_url(self):
         return reverse('ambulance:detail', kwargs={'pk': self.id})
@@ -399,6 +429,85 @@ class CallRadioCode(models.Model):
     label = models.CharField(_('label'), max_length=200)
 
 
+# related objects needed to serialize calls
+CallSerializerPrefetch = ('ambulancecall_set__waypoint_set__location',
+                          'patient_set',
+                          'callnote_set',
+                          'sms_notifications')
+
+CallSummarySerializerPrefetch = ('ambulancecall_set__ambulance',
+                                 'ambulancecall_set__ambulancecallhistory_set',
+                                 'ambulancecall_set__waypoint_set__location',
+                                 'patient_set',
+                                 'callnote_set',
+                                 'sms_notifications')
+
+
+# period filters accepted by call listings
+CallPeriodFilters = {
+    'created_after': 'created_at__gte',
+    'created_before': 'created_at__lt',
+    'ended_after': 'ended_at__gte',
+    'ended_before': 'ended_at__lt',
+}
+
+# ordering of call listings by status, backed by the call indexes
+CallStatusOrdering = {
+    'P': ('pending_at', 'id'),
+    'S': ('-started_at', '-id'),
+    'E': ('-ended_at', '-id'),
+}
+CallDefaultOrdering = ('-created_at', '-id')
+
+
+def parse_call_period(value):
+    """
+    Parse a datetime or date string, raises ValueError if invalid.
+    """
+    if isinstance(value, datetime.datetime):
+        timestamp = value
+    else:
+        timestamp = parse_datetime(value)
+        if timestamp is None:
+            date = parse_date(value)
+            if date is None:
+                raise ValueError("Invalid date '{}'".format(value))
+            timestamp = datetime.datetime.combine(date, datetime.time())
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    return timestamp
+
+
+class CallQuerySet(models.QuerySet):
+
+    def filter_period(self, **kwargs):
+        """
+        Filter calls created or ended in a period, see CallPeriodFilters.
+        """
+        queryset = self
+        for (key, value) in kwargs.items():
+            if value is None or value == '':
+                continue
+            queryset = queryset.filter(**{CallPeriodFilters[key]: parse_call_period(value)})
+        return queryset
+
+    def order_by_status(self, status=None):
+        return self.order_by(*CallStatusOrdering.get(status, CallDefaultOrdering))
+
+    def prefetch_for_serializer(self):
+        """
+        Retrieve all objects needed by CallSerializer in a constant number of queries.
+        """
+        return self.prefetch_related(*CallSerializerPrefetch)
+
+    def prefetch_for_summary_serializer(self):
+        """
+        Retrieve all objects needed by CallSummarySerializer in a constant number of queries.
+        """
+        return self.select_related('priority_code', 'radio_code')\
+            .prefetch_related(*CallSummarySerializerPrefetch)
+
+
 class Call(PublishMixin,
            UpdatedByModel):
 
@@ -439,8 +548,34 @@ class Call(PublishMixin,
     # created at
     created_at = models.DateTimeField(_('created_at'), auto_now_add=True)
 
+    objects = CallQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['status', 'ended_at'],
+                name='call_status_ended_idx',
+            ),
+            models.Index(
+                fields=['status', 'pending_at'],
+                name='call_status_pending_idx',
+            ),
+        ]
+
+    def refresh_related(self, summary=False):
+        """
+        Discard cached related objects and retrieve the ones needed for serialization.
+        """
+        self._prefetched_objects_cache = {}
+        prefetch_related_objects([self], *(CallSummarySerializerPrefetch if summary else CallSerializerPrefetch))
+        return self
+
     def save(self, *args, **kwargs):
 
+        # nothing changed?
+        if self.skip_unchanged(kwargs.get('update_fields'), publish=kwargs.get('publish', True)):
+            return
+
         # Make sure status sets date at first time they are set
         # TODO: throw exception when it is not a valid status change
         if self.status == CallStatus.E.name:
@@ -449,10 +584,11 @@ class Call(PublishMixin,
             if self.ended_at is None:
                 self.ended_at = timezone.now()
 
-            # stop notifications
-            message = "{}:\n* {} {}".format(_("You will no longer be notified of updates to"),
-                                            _("Call"),
-                                            self.to_string())
+            # stop notifications, message is produced only when sent
+            def message():
+                return "{}:\n* {} {}".format(_("You will no longer be notified of updates to"),
+                                             _("Call"),
+                                             self.to_string())
             for user in self.sms_notifications.all():
                 sms_client.notify_user(user, message)
 
@@ -477,32 +613,151 @@ class Call(PublishMixin,
         from mqtt.publish import SingletonPublishClient
         SingletonPublishClient().publish_call(self, **kwargs)
 
-    def abort(self):
+    def abort(self, updated_by=None):
 
         # simply return if already ended
         if self.status == CallStatus.E.name:
             return
 
-        # retrieve all calls not completed
-        not_completed_ambulancecalls = self.ambulancecall_set.exclude(status=AmbulanceCallStatus.C.name)
+        with transaction.atomic():
 
-        if not_completed_ambulancecalls:
-            # if  ambulancecalls, set ambulancecall to complete until all done
+            # set ambulancecalls to complete, call ends when all done
+            ambulance_calls = self.transition(AmbulanceCallStatus.C.name, updated_by=updated_by)
+
+            if not ambulance_calls:
+                # if no ambulancecalls, force abort
+
+                # change call status to ended
+                self.status = CallStatus.E.name
+                self.save()
+
+    def update_status(self, ambulance_call_status):
+        """
+        Start or end call according to the status of its ambulance calls, without publishing.
+
+        Returns True if the call status changed.
+        """
+
+        if AmbulanceCallStatus.A.name in ambulance_call_status:
+            if self.status != CallStatus.S.name:
+                self.status = CallStatus.S.name
+                self.save(publish=False)
+                return True
+        elif ambulance_call_status == {AmbulanceCallStatus.C.name}:
+            if self.status != CallStatus.E.name:
+                self.status = CallStatus.E.name
+                self.save(publish=False)
+                return True
+        return False
+
+    def transition(self, status, ambulance_calls=None, updated_by=None, comment=None, publish=True):
+        """
+        Move ambulance calls to status in one transaction.
+
+        Defaults to all ambulance calls of this call. History is written in one
+        insert, the call status is decided once and, after commit, the call and
+        the status of each changed ambulance call are published once.
+        Returns the list of changed ambulance calls.
+        """
 
-            for ambulancecall in not_completed_ambulancecalls:
+        with transaction.atomic():
 
-                # change call status to completed
-                ambulancecall.status = AmbulanceCallStatus.C.name
-                ambulancecall.save()
+            # lock ambulance calls
+            queryset = self.ambulancecall_set.select_for_update().exclude(status=status)
+            if ambulance_calls is not None:
+                queryset = queryset.filter(id__in=[ambulance_call.id for ambulance_call in ambulance_calls])
+            ambulance_calls = list(queryset)
+            if not ambulance_calls:
+                return ambulance_calls
+
+            # update ambulance calls and history
+            updated_on = timezone.now()
+            for ambulance_call in ambulance_calls:
+                ambulance_call.status = status
+                ambulance_call.updated_on = updated_on
+                if updated_by is not None:
+                    ambulance_call.updated_by = updated_by
+                if comment is not None:
+                    ambulance_call.comment = comment
+            AmbulanceCall.objects.bulk_update(ambulance_calls, ['status', 'comment', 'updated_by', 'updated_on'])
+            AmbulanceCallHistory.objects.bulk_create([
+                AmbulanceCallHistory(ambulance_call=ambulance_call, status=ambulance_call.status,
+                                     comment=ambulance_call.comment,
+                                     updated_by=ambulance_call.updated_by, updated_on=ambulance_call.updated_on)
+                for ambulance_call in ambulance_calls
+            ])
+
+            # start or end call
+            if status == AmbulanceCallStatus.C.name:
+                self.update_status(set(self.ambulancecall_set.values_list('status', flat=True)))
+            else:
+                self.update_status({status})
 
-            # At the last ambulance call will be closed
+            if publish and env.bool("DJANGO_ENABLE_MQTT_PUBLISH", default=True):
 
-        else:
-            # if no ambulancecalls, force abort
+                # publish call and then ambulance calls once, after commit
+                def _publish():
+                    self.publish()
+                    for ambulance_call in ambulance_calls:
+                        ambulance_call.publish()
+
+                transaction.on_commit(_publish)
+
+        return ambulance_calls
+
+    def dispatch(self, dispatch_set):
+        """
+        Add ambulance calls and their waypoints in bulk, without publishing.
+
+        dispatch_set is a list of (AmbulanceCall, [Waypoint]) pairs of unsaved
+        instances. Waypoints without order are appended in the order given.
+        Returns the list of ambulance calls.
+        """
 
-            # change call status to ended
-            self.status = CallStatus.E.name
-            self.save()
+        ambulance_calls = [ambulance_call for (ambulance_call, _waypoints) in dispatch_set]
+        if not ambulance_calls:
+            return ambulance_calls
+
+        with transaction.atomic():
+
+            # start or end call
+            self.update_status({ambulance_call.status for ambulance_call in ambulance_calls})
+
+            # ambulance calls and history
+            for ambulance_call in ambulance_calls:
+                ambulance_call.call = self
+            AmbulanceCall.objects.bulk_create(ambulance_calls)
+            AmbulanceCallHistory.objects.bulk_create([
+                AmbulanceCallHistory(ambulance_call=ambulance_call, status=ambulance_call.status,
+                                     comment=ambulance_call.comment,
+                                     updated_by=ambulance_call.updated_by, updated_on=ambulance_call.updated_on)
+                for ambulance_call in ambulance_calls
+            ])
+
+            # waypoints and history, calculate order in memory
+            waypoints = []
+            for (ambulance_call, waypoint_set) in dispatch_set:
+                highest_order = None
+                for waypoint in waypoint_set:
+                    waypoint.ambulance_call = ambulance_call
+                    if waypoint.order is None or waypoint.order < 0:
+                        waypoint.order = 0 if highest_order is None else highest_order + 1
+                    highest_order = waypoint.order if highest_order is None else max(highest_order, waypoint.order)
+                    waypoints.append(waypoint)
+            Waypoint.objects.bulk_create(waypoints)
+            WaypointHistory.objects.bulk_create([
+                WaypointHistory(waypoint=waypoint, order=waypoint.order, status=waypoint.status,
+                                comment=waypoint.comment,
+                                updated_by=waypoint.updated_by, updated_on=waypoint.updated_on)
+                for waypoint in waypoints
+            ])
+
+            # bulk_create does not send post_save
+            if settings.GEOFENCE['ENABLED']:
+                for ambulance_call in ambulance_calls:
+                    geofence_engine.changed(('ambulancecall', ambulance_call.id))
+
+        return ambulance_calls
 
     def get_ambulances(self):
         return ', '.join(ac.ambulance.identifier for ac in self.ambulancecall_set.all())
@@ -580,6 +835,10 @@ class AmbulanceCall(PublishMixin,
 
     def save(self, *args, **kwargs):
 
+        # nothing changed?
+        if self.skip_unchanged(kwargs.get('update_fields'), history=True, publish=kwargs.get('publish', True)):
+            return
+
         # retrieve call
         call = self.call
 
@@ -777,6 +1036,10 @@ class Waypoint(PublishMixin,
 
     def save(self, *args, **kwargs):
 
+        # nothing changed?
+        if self.skip_unchanged(kwargs.get('update_fields'), history=True, publish=kwargs.get('publish', True)):
+            return
+
         with transaction.atomic():
 
             # set order to last current order when order is negative
@@ -816,6 +1079,33 @@ class WaypointHistory(UpdatedByModel):
                               choices=make_choices(WaypointStatus))
 
 
+class GeofenceVersion(models.Model):
+    """
+    Version of the geofences, shared by all processes.
+
+    A single row whose version is incremented every time waypoints, calls or
+    locations change, so that every process can tell when its geofence index is stale.
+    """
+
+    version = models.BigIntegerField(_('version'), default=0)
+
+    @classmethod
+    def get_version(cls):
+        version = cls.objects.filter(id=1).values_list('version', flat=True).first()
+        return 0 if version is None else version
+
+    @classmethod
+    def increment(cls):
+        if not cls.objects.filter(id=1).update(version=models.F('version') + 1):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(id=1, version=1)
+            except IntegrityError:
+                # created by a concurrent first increment
+                cls.objects.filter(id=1).update(version=models.F('version') + 1)
+        return cls.get_version()
+
+
 # THOSE NEED REVIEWING
 
 class Region(models.Model):
@@ -1,9 +1,28 @@
-from ambulance.models import Call
+from django.db.models import Exists, OuterRef
+
+from ambulance.models import Call, AmbulanceCall
 from emstrack.mixins import BasePermissionMixin
+from login.models import EffectiveAmbulancePermission
 
 
 # Call permissions
 
+def get_call_permissions_filter(user, write=False):
+    """
+    Calls with at least one ambulance that user can read or write to.
+
+    Expressed as a correlated EXISTS subquery so that calls with many
+    permitted ambulances are not duplicated and no DISTINCT is needed.
+    """
+
+    # e.g.: {'user': user, 'can_read': True}
+    condition = {'user': user, 'can_write' if write else 'can_read': True}
+    ambulances = EffectiveAmbulancePermission.objects.filter(**condition).values('ambulance_id')
+
+    return Exists(AmbulanceCall.objects.filter(call_id=OuterRef('id'),
+                                               ambulance_id__in=ambulances))
+
+
 class CallPermissionMixin(BasePermissionMixin):
 
     filter_field = 'ambulancecall__ambulance_id'
@@ -11,5 +30,5 @@ class CallPermissionMixin(BasePermissionMixin):
     queryset = Call.objects.all()
     dispatcher_override = True
 
-    def get_queryset(self):
-        return super().get_queryset().distinct()
+    def get_permissions_filter(self, user, write=False):
+        return get_call_permissions_filter(user, write=write)
@@ -1,8 +1,9 @@
 import logging
 
-from import_export import resources
+from import_export import resources, fields, widgets
 
-from ambulance.models import Ambulance, CallRadioCode, CallPriorityCode, CallPriorityClassification
+from ambulance.models import Ambulance, AmbulanceUpdate, Call, CallRadioCode, CallPriorityCode, \
+    CallPriorityClassification
 
 logger = logging.getLogger(__name__)
 
@@ -17,12 +18,36 @@ class AmbulanceResource(resources.ModelResource):
                         'orientation', 'location', 'comment', 'active')
 
 
+class AmbulanceUpdateResource(resources.ModelResource):
+    ambulance_identifier = fields.Field(attribute='ambulance__identifier',
+                                        widget=widgets.CharWidget(),
+                                        readonly=True)
+
+    class Meta:
+        model = AmbulanceUpdate
+        fields = ('id', 'ambulance', 'ambulance_identifier', 'capability', 'status',
+                  'orientation', 'location', 'timestamp', 'comment', 'updated_by', 'updated_on')
+        export_order = ('id', 'ambulance', 'ambulance_identifier', 'capability', 'status',
+                        'orientation', 'location', 'timestamp', 'comment', 'updated_by', 'updated_on')
+
+
+class CallResource(resources.ModelResource):
+
+    class Meta:
+        model = Call
+        fields = ('id', 'status', 'details', 'priority', 'priority_code', 'radio_code',
+                  'pending_at', 'started_at', 'ended_at', 'created_at', 'comment', 'updated_by', 'updated_on')
+        export_order = ('id', 'status', 'details', 'priority', 'priority_code', 'radio_code',
+                        'pending_at', 'started_at', 'ended_at', 'created_at', 'comment', 'updated_by', 'updated_on')
+
+
 class CallRadioCodeResource(resources.ModelResource):
 
     class Meta:
         model = CallRadioCode
         fields = ('id', 'code', 'label')
         export_order = ('id', 'code', 'label')
+        use_bulk = True
 
 
 class CallPriorityCodeResource(resources.ModelResource):
@@ -31,6 +56,7 @@ class CallPriorityCodeResource(resources.ModelResource):
         model = CallPriorityCode
         fields = ('id', 'prefix', 'priority', 'suffix', 'label')
         export_order = ('id', 'prefix', 'priority', 'suffix', 'label')
+        use_bulk = True
 
 
 class CallPriorityClassificationResource(resources.ModelResource):
@@ -39,3 +65,4 @@ class CallPriorityClassificationResource(resources.ModelResource):
         model = CallPriorityClassification
         fields = ('id', 'label')
         export_order = ('id', 'label')
+        use_bulk = True
@@ -3,6 +3,8 @@ import logging
 from django.db import IntegrityError, transaction
 from django.contrib.auth.models import User
 
+from environs import Env
+
 from rest_framework import serializers
 from rest_framework.exceptions import PermissionDenied
 
@@ -16,6 +18,8 @@ from .models import Ambulance, AmbulanceUpdate, Call, Location, AmbulanceCall, P
 
 logger = logging.getLogger(__name__)
 
+env = Env()
+
 
 # Ambulance serializers
 
@@ -470,7 +474,10 @@ class CallSerializer(serializers.ModelSerializer):
             if call.status != CallStatus.P.name and len(ambulancecall_set) == 0:
                 raise serializers.ValidationError('Started call and ended call must have ambulancecall_set')
 
-            # then add ambulances, do not publish
+            # then add ambulances and waypoints in bulk, do not publish
+            dispatch_set = []
+            location_ids = set()
+            new_locations = []
             for ambulancecall in ambulancecall_set:
                 ambulance = ambulancecall.pop('ambulance_id')
 
@@ -482,15 +489,15 @@ class CallSerializer(serializers.ModelSerializer):
 
                 waypoint_set = ambulancecall.pop('waypoint_set', [])
                 ambulance_call = AmbulanceCall(call=call, ambulance=ambulance, **ambulancecall, updated_by=user)
-                ambulance_call.save(publish=False)
-                # add waypoints
+                waypoints = []
                 for waypoint in waypoint_set:
                     location = waypoint.pop('location', {})
                     if not location:
                         raise serializers.ValidationError('Location is not defined')
                     if 'id' in location:
-                        # location already exists, retrieve
-                        location = Location.objects.get(id=location['id'])
+                        # location already exists, retrieve all at once later
+                        location = location['id']
+                        location_ids.add(location)
                     else:
                         # location does not exist, create one
                         if 'type' not in location:
@@ -499,12 +506,29 @@ class CallSerializer(serializers.ModelSerializer):
                             raise serializers.ValidationError('Hospitals must be created before using as waypoints')
                         elif location['type'] == LocationType.i.name or location['type'] == LocationType.w.name:
                             # TODO: check to see if a close by waypoint already exists to contain proliferation
-                            location = Location.objects.create(**location, updated_by=user)
+                            location = Location(**location, updated_by=user)
+                            new_locations.append(location)
                         else:
                             raise serializers.ValidationError("Invalid waypoint '{}'".format(location))
-                    # add waypoint
-                    obj = Waypoint.objects.create(ambulance_call=ambulance_call, **waypoint,
-                                                  location=location, updated_by=user)
+                    waypoints.append((waypoint, location))
+                dispatch_set.append((ambulance_call, waypoints))
+
+            # retrieve existing locations
+            locations = Location.objects.in_bulk(list(location_ids))
+            missing = location_ids - set(locations.keys())
+            if missing:
+                raise serializers.ValidationError("Location '{}' does not exist".format(missing.pop()))
+
+            # create new locations
+            Location.objects.bulk_create(new_locations)
+
+            # add ambulance calls and waypoints
+            call.dispatch([(ambulance_call,
+                            [Waypoint(**waypoint,
+                                      location=location if isinstance(location, Location) else locations[location],
+                                      updated_by=user)
+                             for (waypoint, location) in waypoints])
+                           for (ambulance_call, waypoints) in dispatch_set])
 
             # add users to sms notifications
             for user in sms_notifications:
@@ -513,12 +537,17 @@ class CallSerializer(serializers.ModelSerializer):
                 else:
                     logger.warning("User %s does not have a mobile phone on file, skipping", user)
 
-            # publish call to mqtt only after all includes have succeeded
-            call.publish()
+            if env.bool("DJANGO_ENABLE_MQTT_PUBLISH", default=True):
+
+                # publish call and then ambulance calls once, after commit
+                ambulance_calls = [ambulance_call for (ambulance_call, _waypoints) in dispatch_set]
+
+                def publish():
+                    call.publish()
+                    for ambulance_call in ambulance_calls:
+                        ambulance_call.publish()
 
-            # then publish ambulance calls
-            for ambulancecall in call.ambulancecall_set.all():
-                ambulancecall.publish()
+                transaction.on_commit(publish)
 
         return call
 
@@ -1,6 +1,7 @@
 import logging
 
-from django.db.models.signals import post_save, m2m_changed
+from django.db import connections
+from django.db.models.signals import post_save, post_delete, post_migrate, m2m_changed
 from django.dispatch import receiver
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -8,11 +9,56 @@ from django.utils.translation import ugettext_lazy as _
 
 from emstrack.sms import client
 
-from .models import Call
+from hospital.models import Hospital
+
+from .geofence import engine as geofence_engine
+from .models import Ambulance, Call, AmbulanceCall, Location, Waypoint
 
 logger = logging.getLogger(__name__)
 
 
+# Add signal to set the fillfactor of the ambulance table after migrations
+@receiver(post_migrate)
+def ambulance_fillfactor_handler(sender, using='default', **kwargs):
+
+    if sender.name != 'ambulance' or not settings.AMBULANCE_FILLFACTOR:
+        return
+
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+
+    # leave room in each page so that location updates can be HOT updates
+    with connection.cursor() as cursor:
+        cursor.execute('ALTER TABLE {} SET (fillfactor = {:d})'.format(
+            connection.ops.quote_name(Ambulance._meta.db_table), int(settings.AMBULANCE_FILLFACTOR)))
+    logger.debug('Set fillfactor of {} to {}'.format(Ambulance._meta.db_table, settings.AMBULANCE_FILLFACTOR))
+
+
+# Add signal to automatically update the geofence index when fences might have changed
+@receiver(post_save, sender=Location)
+@receiver(post_save, sender=Hospital)
+@receiver(post_save, sender=Waypoint)
+@receiver(post_save, sender=AmbulanceCall)
+@receiver(post_save, sender=Call)
+@receiver(post_delete, sender=Location)
+@receiver(post_delete, sender=Hospital)
+@receiver(post_delete, sender=Waypoint)
+@receiver(post_delete, sender=AmbulanceCall)
+def geofence_changed_handler(sender, instance, signal, **kwargs):
+
+    if not settings.GEOFENCE['ENABLED']:
+        return
+
+    # waypoints updated by the geofence engine are already up to date in its index
+    if getattr(instance, '_geofence_update', False):
+        return
+
+    # hospitals are locations
+    model_name = 'location' if sender is Hospital else sender._meta.model_name
+    geofence_engine.changed((model_name, instance.id), deleted=signal is post_delete)
+
+
 # Add signal to automatically clear cache when group permissions change
 @receiver(m2m_changed, sender=Call.sms_notifications.through)
 def user_groups_changed_handler(sender, instance, action,
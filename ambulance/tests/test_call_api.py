@@ -1,8 +1,11 @@
+import csv
 import logging
 
 from django.urls import reverse
 from django.test import Client
 from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from rest_framework.parsers import JSONParser
 from rest_framework import serializers
@@ -14,12 +17,30 @@ from emstrack.tests.util import date2iso
 from login.tests.setup_data import TestSetup
 
 from ambulance.models import CallStatus, CallPriority, LocationType, WaypointStatus, \
-    Call, Patient, AmbulanceCall, CallNote
-from ambulance.serializers import CallSerializer, PatientSerializer, AmbulanceCallSerializer, CallNoteSerializer
+    Call, Patient, AmbulanceCall, CallNote, Location, Waypoint
+from ambulance.serializers import CallSerializer, PatientSerializer, AmbulanceCallSerializer, CallNoteSerializer, \
+    CallSummarySerializer
+from ambulance.views import CallExportView
+from mqtt.policy import TopicPolicy
+from mqtt.publish import PublishClient
 
 logger = logging.getLogger(__name__)
 
 
+class RecordingPublishClient(PublishClient):
+    """
+    Records the topics published to, without connecting.
+    """
+
+    def __init__(self):
+        self.active = True
+        self.policy = TopicPolicy()
+        self.published = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append(topic)
+
+
 class TestCallAPI(TestSetup):
 
     def test_call_create_viewset(self):
@@ -576,6 +597,33 @@ class TestCallAPI(TestSetup):
         # logout
         client.logout()
 
+    def test_call_list_viewset_exists(self):
+
+        # testuser2 can read a3 but not a1
+        c1 = Call.objects.create(details='nani', updated_by=self.u1)
+        AmbulanceCall.objects.create(call=c1, ambulance=self.a1, updated_by=self.u1)
+        AmbulanceCall.objects.create(call=c1, ambulance=self.a3, updated_by=self.u1)
+        c2 = Call.objects.create(details='suhmuh', updated_by=self.u1)
+        AmbulanceCall.objects.create(call=c2, ambulance=self.a1, updated_by=self.u1)
+
+        # login as testuser2
+        client = Client()
+        client.login(username='testuser2', password='very_secret')
+
+        # calls are filtered by EXISTS, without DISTINCT
+        with CaptureQueriesContext(connection) as context:
+            response = client.get('/en/api/call/', follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual([c['id'] for c in result], [c1.id])
+
+        sql = [query['sql'] for query in context.captured_queries if 'FROM "ambulance_call"' in query['sql']]
+        self.assertTrue(any('EXISTS' in query for query in sql))
+        self.assertFalse(any('DISTINCT' in query for query in sql))
+
+        # logout
+        client.logout()
+
     def test_call_list_view(self):
 
         # instantiate client
@@ -681,4 +729,223 @@ class TestCallAPI(TestSetup):
         self.assertContains(response, 'Test1')
 
         # logout
-        client.logout()
\ No newline at end of file
+        client.logout()
+
+    def create_call(self, details, ambulances):
+        call = Call.objects.create(details=details, updated_by=self.u1)
+        Patient.objects.create(call=call, name='Jose', age=3)
+        CallNote.objects.create(call=call, comment='some comment', updated_by=self.u1)
+        for ambulance in ambulances:
+            ambulance_call = AmbulanceCall.objects.create(call=call, ambulance=ambulance, updated_by=self.u1)
+            for order in range(2):
+                location = Location.objects.create(type=LocationType.i.name, updated_by=self.u1)
+                Waypoint.objects.create(ambulance_call=ambulance_call, order=order,
+                                        location=location, updated_by=self.u1)
+        return call
+
+    def test_call_serializer_queries(self):
+
+        create_call = self.create_call
+
+        create_call('nani', [self.a1])
+
+        # count queries for a single call
+        with CaptureQueriesContext(connection) as context:
+            CallSerializer(Call.objects.prefetch_for_serializer(), many=True).data
+        single = len(context)
+
+        # number of queries should not depend on the number of calls, ambulances or waypoints
+        create_call('suhmuh', [self.a1, self.a2])
+        create_call('nihao', [self.a1, self.a2, self.a3])
+
+        with self.assertNumQueries(single):
+            result = CallSerializer(Call.objects.prefetch_for_serializer(), many=True).data
+        self.assertEqual(len(result), 3)
+        self.assertCountEqual([len(c['ambulancecall_set']) for c in result], [1, 2, 3])
+
+        with CaptureQueriesContext(connection) as context:
+            CallSummarySerializer(Call.objects.prefetch_for_summary_serializer(), many=True).data
+        summary = len(context)
+
+        create_call('hola', [self.a2, self.a3])
+
+        with self.assertNumQueries(summary):
+            result = CallSummarySerializer(Call.objects.prefetch_for_summary_serializer(), many=True).data
+        self.assertEqual(len(result), 4)
+
+        # refresh_related should see new waypoints
+        call = Call.objects.prefetch_for_serializer().get(details='nani')
+        ambulance_call = call.ambulancecall_set.all()[0]
+        Waypoint.objects.create(ambulance_call=ambulance_call, order=2,
+                                location=Location.objects.create(type=LocationType.i.name, updated_by=self.u1),
+                                updated_by=self.u1)
+        self.assertEqual(len(call.ambulancecall_set.all()[0].waypoint_set.all()), 2)
+        call.refresh_related()
+        self.assertEqual(len(call.ambulancecall_set.all()[0].waypoint_set.all()), 3)
+
+    def test_call_api_queries(self):
+
+        # instantiate client
+        client = Client()
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        def count_queries(url):
+            # first request warms up the caches
+            client.get(url, follow=True)
+            with CaptureQueriesContext(connection) as context:
+                response = client.get(url, follow=True)
+            self.assertEqual(response.status_code, 200)
+            return len(context)
+
+        def count_publish_queries(call):
+            publish_client = RecordingPublishClient()
+            with CaptureQueriesContext(connection) as context:
+                publish_client.publish_call(call)
+            self.assertEqual(publish_client.published, ['call/{}/data'.format(call.id)])
+            return len(context)
+
+        def urls(call):
+            return {
+                'list': '/en/api/call/',
+                'retrieve': '/en/api/call/{}/'.format(call.id),
+                'summary': '/en/api/call/{}/summary/'.format(call.id),
+                'ambulance calls': '/en/api/ambulance/{}/calls/'.format(self.a1.id),
+            }
+
+        call = self.create_call('nani', [self.a1])
+        expected = {name: count_queries(url) for (name, url) in urls(call).items()}
+        expected_publish = count_publish_queries(call)
+
+        # number of queries should not depend on the number of calls, ambulances or waypoints
+        self.create_call('suhmuh', [self.a1, self.a2])
+        call = self.create_call('nihao', [self.a1, self.a2, self.a3])
+
+        for (name, url) in urls(call).items():
+            self.assertEqual(count_queries(url), expected[name], name)
+        self.assertEqual(count_publish_queries(call), expected_publish)
+
+        # logout
+        client.logout()
+
+    def test_call_list_viewset_pagination(self):
+
+        # instantiate client
+        client = Client()
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        # ended calls
+        calls = []
+        for i in range(5):
+            call = Call.objects.create(details='call {}'.format(i), updated_by=self.u1)
+            call.status = CallStatus.E.name
+            call.save()
+            calls.append(call)
+
+        # paginate in pages of two, most recently ended first
+        ids = []
+        url = '/en/api/call/?status=E&page_size=2'
+        while url:
+            response = client.get(url, follow=True)
+            self.assertEqual(response.status_code, 200)
+            result = JSONParser().parse(BytesIO(response.content))
+            self.assertLessEqual(len(result['results']), 2)
+            ids += [c['id'] for c in result['results']]
+            url = result['next']
+        self.assertEqual(ids, [c.id for c in reversed(calls)])
+
+        # not paginated without page_size
+        response = client.get('/en/api/call/?status=E', follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual(len(result), 5)
+
+        # filter by period
+        ended_at = Call.objects.get(id=calls[2].id).ended_at
+        response = client.get('/en/api/call/', {'status': 'E', 'ended_after': ended_at.isoformat()}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertCountEqual([c['id'] for c in result], [c.id for c in calls[2:]])
+
+        response = client.get('/en/api/call/', {'status': 'E', 'ended_before': ended_at.isoformat()}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertCountEqual([c['id'] for c in result], [c.id for c in calls[:2]])
+
+        # invalid period
+        response = client.get('/en/api/call/', {'created_after': 'yesterday'}, follow=True)
+        self.assertEqual(response.status_code, 400)
+
+        # calls without an end timestamp are ordered by creation
+        Call.objects.filter(id=calls[0].id).update(ended_at=None)
+        ids = []
+        url = '/en/api/call/?status=E&page_size=2'
+        while url:
+            response = client.get(url, follow=True)
+            self.assertEqual(response.status_code, 200)
+            result = JSONParser().parse(BytesIO(response.content))
+            ids += [c['id'] for c in result['results']]
+            url = result['next']
+        self.assertEqual(ids, [c.id for c in reversed(calls)])
+
+        # ambulance calls are not filtered by status, status does not change their ordering
+        active = []
+        for i in range(3):
+            call = Call.objects.create(details='active call {}'.format(i), updated_by=self.u1)
+            AmbulanceCall.objects.create(call=call, ambulance=self.a1, updated_by=self.u1)
+            active.append(call)
+
+        ids = []
+        url = '/en/api/ambulance/{}/calls/?status=E&page_size=2'.format(self.a1.id)
+        while url:
+            response = client.get(url, follow=True)
+            self.assertEqual(response.status_code, 200)
+            result = JSONParser().parse(BytesIO(response.content))
+            ids += [c['id'] for c in result['results']]
+            url = result['next']
+        self.assertEqual(ids, [c.id for c in reversed(active)])
+
+        # logout
+        client.logout()
+
+    def test_call_export_view(self):
+
+        # ended calls
+        calls = []
+        for i in range(5):
+            call = Call.objects.create(details='call {}'.format(i), updated_by=self.u1)
+            call.status = CallStatus.E.name
+            call.save()
+            calls.append(call)
+
+        # instantiate client
+        client = Client()
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        # export in chunks of two
+        chunk_size = CallExportView.chunk_size
+        CallExportView.chunk_size = 2
+        try:
+            response = client.get(reverse('ambulance:export-call'), follow=True)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        finally:
+            CallExportView.chunk_size = chunk_size
+
+        self.assertEqual(rows[0][:3], ['id', 'status', 'details'])
+        self.assertEqual([int(row[0]) for row in rows[1:]], [c.id for c in calls])
+        self.assertEqual([row[2] for row in rows[1:]], [c.details for c in calls])
+
+        # filter by period
+        ended_at = Call.objects.get(id=calls[2].id).ended_at
+        response = client.get(reverse('ambulance:export-call'), {'ended_after': ended_at.isoformat()}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual([int(row[0]) for row in rows[1:]], [c.id for c in calls[2:]])
+
+        # invalid period
+        response = client.get(reverse('ambulance:export-call'), {'ended_after': 'yesterday'}, follow=True)
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
@@ -5,7 +5,8 @@ from django.test import Client
 from django.conf import settings
 from django.urls import reverse
 
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
 from rest_framework.parsers import JSONParser
@@ -1351,3 +1352,166 @@ class TestCall(TestSetup):
         self.assertEqual(call.started_at, started_at)
 
 
+
+    def test_call_serializer_create_bulk(self):
+
+        def dispatch(ambulances, waypoints):
+            call = {
+                'status': CallStatus.P.name,
+                'priority': CallPriority.B.name,
+                'sms_notifications': [],
+                'ambulancecall_set': [
+                    {
+                        'ambulance_id': ambulance.id,
+                        'waypoint_set': [
+                            {
+                                'order': -1,
+                                'location': {
+                                    'type': LocationType.i.name,
+                                    'number': str(order),
+                                    'street': 'some street'
+                                }
+                            }
+                            for order in range(waypoints)
+                        ]
+                    }
+                    for ambulance in ambulances
+                ],
+                'patient_set': [],
+            }
+            serializer = CallSerializer(data=call)
+            self.assertTrue(serializer.is_valid())
+            with CaptureQueriesContext(connection) as context:
+                call = serializer.save(updated_by=self.u1)
+            return call, len(context)
+
+        # number of queries does not depend on the number of ambulances and waypoints
+        (c1, queries) = dispatch([self.a1], 1)
+        (c2, bulk_queries) = dispatch([self.a1, self.a2, self.a3], 3)
+        self.assertEqual(queries, bulk_queries)
+
+        # ambulance calls, history and waypoint orders
+        for ambulance_call in c2.ambulancecall_set.all():
+            self.assertEqual(ambulance_call.status, AmbulanceCallStatus.R.name)
+            self.assertEqual(ambulance_call.ambulancecallhistory_set.count(), 1)
+            waypoints = ambulance_call.waypoint_set.order_by('order')
+            self.assertEqual([w.order for w in waypoints], [0, 1, 2])
+            self.assertEqual([w.location.number for w in waypoints], ['0', '1', '2'])
+            for waypoint in waypoints:
+                self.assertEqual(waypoint.waypointhistory_set.count(), 1)
+
+        # accepted ambulance call starts call
+        call = {
+            'status': CallStatus.P.name,
+            'priority': CallPriority.B.name,
+            'sms_notifications': [],
+            'ambulancecall_set': [
+                {'ambulance_id': self.a1.id, 'status': AmbulanceCallStatus.A.name},
+                {'ambulance_id': self.a2.id}
+            ],
+            'patient_set': [],
+        }
+        serializer = CallSerializer(data=call)
+        self.assertTrue(serializer.is_valid())
+        call = serializer.save(updated_by=self.u1)
+        self.assertEqual(Call.objects.get(id=call.id).status, CallStatus.S.name)
+
+        # missing location
+        call = {
+            'status': CallStatus.P.name,
+            'priority': CallPriority.B.name,
+            'ambulancecall_set': [
+                {'ambulance_id': self.a1.id, 'waypoint_set': [{'order': 0, 'location': {'id': -1}}]},
+            ],
+            'patient_set': [],
+        }
+        serializer = CallSerializer(data=call)
+        if serializer.is_valid():
+            self.assertRaises(serializers.ValidationError, serializer.save, updated_by=self.u1)
+
+    def test_call_transition(self):
+
+        call = {
+            'status': CallStatus.P.name,
+            'priority': CallPriority.B.name,
+            'sms_notifications': [],
+            'ambulancecall_set': [{'ambulance_id': self.a1.id},
+                                  {'ambulance_id': self.a2.id},
+                                  {'ambulance_id': self.a3.id}],
+            'patient_set': [],
+        }
+        serializer = CallSerializer(data=call)
+        self.assertTrue(serializer.is_valid())
+        call = serializer.save(updated_by=self.u1)
+
+        # accept one ambulance call
+        ambulance_call = call.ambulancecall_set.get(ambulance=self.a1)
+        changed = call.transition(AmbulanceCallStatus.A.name, ambulance_calls=[ambulance_call], updated_by=self.u2)
+        self.assertEqual([ac.id for ac in changed], [ambulance_call.id])
+
+        call = Call.objects.get(id=call.id)
+        self.assertEqual(call.status, CallStatus.S.name)
+        ambulance_call = AmbulanceCall.objects.get(id=ambulance_call.id)
+        self.assertEqual(ambulance_call.status, AmbulanceCallStatus.A.name)
+        self.assertEqual(ambulance_call.updated_by, self.u2)
+        self.assertEqual(ambulance_call.ambulancecallhistory_set.count(), 2)
+
+        # nothing to change
+        self.assertEqual(call.transition(AmbulanceCallStatus.A.name, ambulance_calls=[ambulance_call]), [])
+
+        # abort completes all ambulance calls and ends call
+        call.abort(updated_by=self.u3)
+
+        call = Call.objects.get(id=call.id)
+        self.assertEqual(call.status, CallStatus.E.name)
+        self.assertIsNotNone(call.ended_at)
+        for ambulance_call in call.ambulancecall_set.all():
+            self.assertEqual(ambulance_call.status, AmbulanceCallStatus.C.name)
+            self.assertEqual(ambulance_call.updated_by, self.u3)
+            self.assertEqual(ambulance_call.ambulancecallhistory_set.filter(status=AmbulanceCallStatus.C.name).count(), 1)
+
+        # abort without ambulance calls
+        call = Call.objects.create(updated_by=self.u1)
+        call.abort()
+        self.assertEqual(Call.objects.get(id=call.id).status, CallStatus.E.name)
+
+    def test_skip_unchanged(self):
+
+        call = Call.objects.create(details='nani', updated_by=self.u1)
+        ambulance_call = AmbulanceCall.objects.create(call=call, ambulance=self.a1, updated_by=self.u1)
+        location = Location.objects.create(type=LocationType.i.name, updated_by=self.u1)
+        waypoint = Waypoint.objects.create(ambulance_call=ambulance_call, order=0,
+                                           location=location, updated_by=self.u1)
+
+        Call.reset_skipped()
+
+        # saving unchanged instances does not write
+        call = Call.objects.get(id=call.id)
+        updated_on = call.updated_on
+        call.updated_by = self.u2
+        call.save()
+        self.assertEqual(Call.objects.get(id=call.id).updated_on, updated_on)
+
+        ambulance_call = AmbulanceCall.objects.get(id=ambulance_call.id)
+        ambulance_call.save()
+        self.assertEqual(ambulance_call.ambulancecallhistory_set.count(), 1)
+
+        waypoint = Waypoint.objects.get(id=waypoint.id)
+        waypoint.save()
+        self.assertEqual(waypoint.waypointhistory_set.count(), 1)
+
+        self.assertDictEqual(Call.get_skipped(), {'writes': 3, 'history': 2, 'publishes': 3})
+
+        # changes are written, and the new values are tracked
+        waypoint.status = WaypointStatus.V.name
+        waypoint.save()
+        self.assertEqual(waypoint.waypointhistory_set.count(), 2)
+        self.assertEqual(Waypoint.objects.get(id=waypoint.id).status, WaypointStatus.V.name)
+
+        waypoint.save()
+        self.assertEqual(waypoint.waypointhistory_set.count(), 2)
+
+        waypoint.status = WaypointStatus.C.name
+        waypoint.save()
+        self.assertEqual(waypoint.waypointhistory_set.count(), 3)
+        self.assertEqual(Waypoint.objects.get(id=waypoint.id).status, WaypointStatus.C.name)
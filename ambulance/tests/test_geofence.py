@@ -0,0 +1,160 @@
+from django.contrib.gis.geos import Point
+from django.test import override_settings
+
+from ambulance.geofence import GeofenceEngine, GeofenceGrid, Geofence, GeofenceType, engine
+from ambulance.models import Ambulance, AmbulanceStatus, AmbulanceCall, AmbulanceCallStatus, Call, \
+    GeofenceVersion, Waypoint, WaypointStatus
+
+from login.tests.setup_data import TestSetup
+
+
+class TestGeofence(TestSetup):
+
+    def setUp(self):
+
+        # move base and hospital away from the default location
+        self.l2.location = Point(-117.0, 32.6, srid=4326)
+        self.l2.save()
+
+        self.h1.location = Point(-117.1, 32.5, srid=4326)
+        self.h1.save()
+
+    def test_geofence_grid(self):
+
+        grid = GeofenceGrid(0.001)
+        fence = Geofence(GeofenceType.w, 1, Point(-117.0, 32.6, srid=4326), 50,
+                         sources=(('waypoint', 1), ('location', 2)))
+        grid.add(fence)
+
+        self.assertIn(fence, grid.candidates(Point(-117.0, 32.6, srid=4326)))
+        self.assertIn(fence, grid.candidates(Point(-117.0003, 32.6003, srid=4326)))
+        self.assertNotIn(fence, grid.candidates(Point(-117.01, 32.6, srid=4326)))
+        self.assertEqual(grid.get(fence.key), fence)
+
+        # remove by source
+        grid.remove_source(('location', 2))
+        self.assertIsNone(grid.get(fence.key))
+        self.assertNotIn(fence, grid.candidates(Point(-117.0, 32.6, srid=4326)))
+        self.assertEqual(grid.sources, {})
+
+    def test_geofence_engine(self):
+
+        geofence = GeofenceEngine(radius=50, hysteresis=0.2, refresh_seconds=60, sync_seconds=60)
+
+        # hospitals and bases are not fences without a call
+        events = geofence.update(self.a1.id, Point(-117.0, 32.6, srid=4326))
+        self.assertEqual(events, [])
+        events = geofence.update(self.a1.id, Point(-117.1, 32.5, srid=4326))
+        self.assertEqual(events, [])
+        built_on = geofence.built_on
+
+        # call with base as waypoint
+        call = Call.objects.create(details='geofence', updated_by=self.u1)
+        ambulance_call = AmbulanceCall.objects.create(call=call, ambulance=self.a1,
+                                                      status=AmbulanceCallStatus.A.name,
+                                                      updated_by=self.u1)
+        waypoint = Waypoint.objects.create(ambulance_call=ambulance_call, order=0,
+                                           location=self.l2, updated_by=self.u1)
+        for source in (('call', call.id), ('ambulancecall', ambulance_call.id), ('waypoint', waypoint.id)):
+            geofence.changed(source)
+
+        # arrive at base
+        events = geofence.update(self.a1.id, Point(-117.0001, 32.6001, srid=4326))
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].is_arrival())
+        self.assertEqual(events[0].fence.key, (GeofenceType.w.name, waypoint.id))
+
+        # updated without rebuilding
+        self.assertEqual(geofence.built_on, built_on)
+
+        # other ambulances are not affected
+        events = geofence.update(self.a2.id, Point(-117.0001, 32.6001, srid=4326))
+        self.assertEqual(events, [])
+
+        # still at base
+        events = geofence.update(self.a1.id, Point(-117.0, 32.6, srid=4326))
+        self.assertEqual(events, [])
+
+        # leave base
+        events = geofence.update(self.a1.id, Point(-117.1, 32.6, srid=4326))
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].is_departure())
+
+        # complete ambulance call
+        ambulance_call.status = AmbulanceCallStatus.C.name
+        ambulance_call.save()
+        geofence.changed(('ambulancecall', ambulance_call.id))
+
+        events = geofence.update(self.a1.id, Point(-117.0, 32.6, srid=4326))
+        self.assertEqual(events, [])
+        self.assertEqual(len(geofence.grid), 0)
+        self.assertEqual(geofence.built_on, built_on)
+
+    def test_geofence_sync(self):
+
+        geofence = GeofenceEngine(radius=50, hysteresis=0.2, refresh_seconds=60, sync_seconds=0)
+        geofence.update(self.a1.id, Point(-116.5, 32.0, srid=4326))
+        self.assertEqual(len(geofence.grid), 0)
+
+        # waypoint added by another process
+        call = Call.objects.create(details='geofence', updated_by=self.u1)
+        ambulance_call = AmbulanceCall.objects.create(call=call, ambulance=self.a1,
+                                                      status=AmbulanceCallStatus.A.name,
+                                                      updated_by=self.u1)
+        waypoint = Waypoint.objects.create(ambulance_call=ambulance_call, order=0,
+                                           location=self.l2, updated_by=self.u1)
+        GeofenceVersion.increment()
+
+        events = geofence.update(self.a1.id, Point(-117.0, 32.6, srid=4326))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].fence.key, (GeofenceType.w.name, waypoint.id))
+
+        # own changes do not rebuild
+        built_on = geofence.built_on
+        geofence.signal()
+        geofence.update(self.a1.id, Point(-117.0, 32.6, srid=4326))
+        self.assertEqual(geofence.built_on, built_on)
+
+    @override_settings(GEOFENCE={'ENABLED': True})
+    def test_geofence_ambulance_status(self):
+
+        engine.reset()
+
+        # base bound
+        ambulance = Ambulance.objects.get(id=self.a1.id)
+        ambulance.status = AmbulanceStatus.BB.name
+        ambulance.location = Point(-116.5, 32.0, srid=4326)
+        ambulance.save()
+
+        # pass by base without a call
+        ambulance = Ambulance.objects.get(id=self.a1.id)
+        ambulance.location = Point(-117.0, 32.6, srid=4326)
+        ambulance.save()
+
+        self.assertEqual(Ambulance.objects.get(id=self.a1.id).status, AmbulanceStatus.BB.name)
+
+        # leave base
+        ambulance = Ambulance.objects.get(id=self.a1.id)
+        ambulance.location = Point(-116.5, 32.0, srid=4326)
+        ambulance.save()
+
+        # call with base as destination
+        call = Call.objects.create(details='geofence', updated_by=self.u1)
+        ambulance_call = AmbulanceCall.objects.create(call=call, ambulance=self.a1,
+                                                      status=AmbulanceCallStatus.A.name,
+                                                      updated_by=self.u1)
+        waypoint = Waypoint.objects.create(ambulance_call=ambulance_call, order=0,
+                                           location=self.l2, updated_by=self.u1)
+
+        # arrive at base
+        ambulance = Ambulance.objects.get(id=self.a1.id)
+        ambulance.location = Point(-117.0, 32.6, srid=4326)
+        ambulance.save()
+
+        self.assertEqual(Ambulance.objects.get(id=self.a1.id).status, AmbulanceStatus.AB.name)
+        self.assertEqual(Waypoint.objects.get(id=waypoint.id).status, WaypointStatus.V.name)
+
+        # updating the waypoint did not record a change
+        self.assertEqual(engine.changes, [])
+
+        engine.reset()
@@ -0,0 +1,142 @@
+from datetime import timedelta
+
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ambulance.ingest import IngestFilter, heading_change, ingest_filter, ReportingPolicy, ReportingPolicyDefaults
+from ambulance.models import Ambulance, AmbulanceUpdate
+
+from login.tests.setup_data import TestSetup
+
+
+class TestIngestFilter(TestSetup):
+
+    def test_heading_change(self):
+        self.assertEqual(heading_change(10, 350), 20)
+        self.assertEqual(heading_change(90, 270), 180)
+        self.assertEqual(heading_change(45, 45), 0)
+
+    def test_ingest_filter(self):
+
+        ingest = IngestFilter(distance=30, heading=45, max_silence=60)
+        ambulance = Ambulance.objects.get(id=self.a1.id)
+        loaded_values = {
+            'location': Point(-117.0, 32.5, srid=4326),
+            'orientation': 0.0,
+            'updated_on': timezone.now()
+        }
+
+        # jitter of about 20m is suppressed
+        ambulance.location = Point(-117.0, 32.50018, srid=4326)
+        self.assertFalse(ingest.has_moved(ambulance, loaded_values))
+
+        # jitter of about 20m with a sharp turn is accepted
+        ambulance.location = Point(-117.00021, 32.5, srid=4326)
+        self.assertTrue(ingest.has_moved(ambulance, loaded_values))
+
+        # about 50m is accepted
+        ambulance.location = Point(-117.0, 32.50045, srid=4326)
+        self.assertTrue(ingest.has_moved(ambulance, loaded_values))
+
+        # heartbeat
+        self.assertFalse(ingest.is_silent(loaded_values))
+        loaded_values['updated_on'] = timezone.now() - timedelta(seconds=120)
+        self.assertTrue(ingest.is_silent(loaded_values))
+
+    def test_ambulance_suppressed_update(self):
+
+        ingest_filter.reset_stats()
+
+        ambulance = Ambulance.objects.get(id=self.a1.id)
+        ambulance.location = Point(-117.0, 32.5, srid=4326)
+        ambulance.save()
+        count = AmbulanceUpdate.objects.filter(ambulance=ambulance).count()
+
+        # jitter below stationary radius does not write
+        ambulance = Ambulance.objects.get(id=self.a1.id)
+        ambulance.location = Point(-117.0, 32.50002, srid=4326)
+        ambulance.save()
+
+        self.assertEqual(AmbulanceUpdate.objects.filter(ambulance=ambulance).count(), count)
+        self.assertEqual(ingest_filter.get_stats()['suppressed'], 1)
+        self.assertEqual(ingest_filter.get_stats()['publishes_avoided'], 1)
+        self.assertEqual(ingest_filter.last_seen[ambulance.id]['location'], ambulance.location)
+
+
+class TestReportingPolicy(TestSetup):
+
+    def test_reporting_policy(self):
+
+        policy = ReportingPolicy(mode='throttle', load_factor=1.0,
+                                 status={'AB': {'interval': 60, 'distance': 100}})
+
+        # published policy
+        published = policy.get_policy()
+        self.assertEqual(published['mode'], 'throttle')
+        self.assertEqual(published['status']['AB'], {'interval': 60, 'distance': 100})
+        self.assertEqual(published['status']['PB'], ReportingPolicyDefaults['PB'])
+
+        # scaled by load
+        policy.set_load_factor(2)
+        self.assertEqual(policy.get_policy()['status']['AB'], {'interval': 120, 'distance': 200})
+        policy.set_load_factor(1)
+
+        # first report is accepted
+        data = {'location': Point(-117.0, 32.5, srid=4326)}
+        self.assertTrue(policy.check('client1', 'AB', data))
+
+        # report too soon and too close is throttled
+        data = {'location': Point(-117.0, 32.5001, srid=4326)}
+        self.assertFalse(policy.check('client1', 'AB', data))
+        self.assertEqual(policy.violations['client1'], 1)
+
+        # report far enough is accepted
+        data = {'location': Point(-117.0, 32.502, srid=4326)}
+        self.assertTrue(policy.check('client1', 'AB', data))
+
+        # status changes are always accepted
+        data = {'location': Point(-117.0, 32.502, srid=4326), 'status': 'BB'}
+        self.assertTrue(policy.check('client1', 'AB', data))
+
+        # tag mode accepts but counts
+        policy = ReportingPolicy(mode='tag')
+        data = {'location': Point(-117.0, 32.5, srid=4326)}
+        self.assertTrue(policy.check('client1', 'AB', data))
+        self.assertTrue(policy.check('client1', 'AB', data))
+        self.assertEqual(policy.stats['tagged'], 1)
+
+
+class TestAmbulanceHotUpdate(TestSetup):
+
+    def test_ambulance_hot_update(self):
+
+        # location update writes only the high-frequency columns
+        ambulance = Ambulance.objects.get(id=self.a1.id)
+        ambulance.location = Point(-116.5, 32.0, srid=4326)
+        ambulance.timestamp = timezone.now()
+        with CaptureQueriesContext(connection) as context:
+            ambulance.save()
+        updates = [q['sql'] for q in context.captured_queries
+                   if q['sql'].startswith('UPDATE "{}"'.format(Ambulance._meta.db_table))]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"location"', updates[0])
+        self.assertNotIn('"identifier"', updates[0])
+        self.assertNotIn('"comment"', updates[0])
+
+        ambulance = Ambulance.objects.get(id=self.a1.id)
+        self.assertEqual(ambulance.location, Point(-116.5, 32.0, srid=4326))
+        self.assertEqual(AmbulanceUpdate.objects.filter(ambulance=ambulance).latest('timestamp').location,
+                         Point(-116.5, 32.0, srid=4326))
+
+        # other changes write the whole row
+        ambulance.comment = 'new comment'
+        ambulance.location = Point(-116.0, 32.0, srid=4326)
+        with CaptureQueriesContext(connection) as context:
+            ambulance.save()
+        updates = [q['sql'] for q in context.captured_queries
+                   if q['sql'].startswith('UPDATE "{}"'.format(Ambulance._meta.db_table))]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"comment"', updates[0])
+        self.assertEqual(Ambulance.objects.get(id=self.a1.id).comment, 'new comment')
@@ -32,6 +32,10 @@ urlpatterns = [
         staff_member_required(views.AmbulanceExportView.as_view()),
         name='export-ambulance'),
 
+    url(r'^update/export/$',
+        staff_member_required(views.AmbulanceUpdateExportView.as_view()),
+        name='export-ambulance-update'),
+
     url(r'^import/$',
         staff_member_required(views.AmbulanceImportView.as_view()),
         name='import-ambulance'),
@@ -72,6 +76,10 @@ urlpatterns = [
         login_required(views.CallAbortView.as_view()),
         name='call_abort'),
 
+    url(r'^call/export/$',
+        staff_member_required(views.CallExportView.as_view()),
+        name='export-call'),
+
     # Radio codes
 
     url(r'^radio-code/list/$',
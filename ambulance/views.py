@@ -5,7 +5,7 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.contrib.messages.views import SuccessMessageMixin
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.http import HttpResponseForbidden
+from django.http import HttpResponseForbidden, HttpResponseBadRequest
 from django.shortcuts import redirect
 from django.urls import reverse_lazy
 from django.views import View
@@ -18,8 +18,8 @@ from django.utils.translation import ugettext_lazy as _
 from drf_extra_fields.geo_fields import PointField
 
 from ambulance.permissions import CallPermissionMixin
-from ambulance.resources import AmbulanceResource, CallRadioCodeResource, CallPriorityCodeResource, \
-    CallPriorityClassificationResource
+from ambulance.resources import AmbulanceResource, AmbulanceUpdateResource, CallResource, CallRadioCodeResource, \
+    CallPriorityCodeResource, CallPriorityClassificationResource
 
 from equipment.mixins import EquipmentHolderCreateMixin, EquipmentHolderUpdateMixin
 
@@ -34,7 +34,7 @@ from .models import Ambulance, AmbulanceCapability, AmbulanceStatus, \
     Call, Location, LocationType, CallStatus, AmbulanceCallStatus, \
     CallPriority, AmbulanceStatusOrder, AmbulanceCapabilityOrder, CallStatusOrder, CallPriorityOrder, LocationTypeOrder, \
     AmbulanceOnline, AmbulanceOnlineOrder, CallRadioCode, CallPriorityCode, WaypointStatus, WaypointStatusOrder, \
-    CallPriorityClassification
+    CallPriorityClassification, CallPeriodFilters, AmbulanceUpdate, parse_call_period
 
 from .forms import AmbulanceCreateForm, AmbulanceUpdateForm, LocationAdminCreateForm, LocationAdminUpdateForm
 
@@ -408,12 +408,18 @@ class CallListView(LoginRequiredMixin,
         # query all calls
         queryset = self.get_queryset()
 
-        # filter
-        context['pending_list'] = queryset.filter(status=CallStatus.P.name).order_by('pending_at')
-        context['started_list'] = queryset.filter(status=CallStatus.S.name).order_by('-started_at')
+        # filter by period, ignore invalid dates
+        try:
+            queryset = queryset.filter_period(**{key: self.request.GET.get(key, None) for key in CallPeriodFilters})
+        except ValueError:
+            pass
+
+        # filter, same ordering as the api
+        context['pending_list'] = queryset.filter(status=CallStatus.P.name).order_by_status(CallStatus.P.name)
+        context['started_list'] = queryset.filter(status=CallStatus.S.name).order_by_status(CallStatus.S.name)
 
         # query ended and paginate
-        ended_calls_query = queryset.filter(status=CallStatus.E.name).order_by('-ended_at')
+        ended_calls_query = queryset.filter(status=CallStatus.E.name).order_by_status(CallStatus.E.name)
 
         # get current page
         page = self.request.GET.get('page', 1)
@@ -485,7 +491,7 @@ class CallAbortView(LoginRequiredMixin,
         self.object = self.get_object()
 
         # abort call
-        self.object.abort()
+        self.object.abort(updated_by=user)
 
         return redirect('ambulance:call_list')
 
@@ -539,6 +545,62 @@ class AmbulanceProcessImportView(SuccessMessageMixin,
     import_breadcrumbs = {'ambulance:list': _("Ambulances")}
 
 
+# AmbulanceUpdate export
+
+class AmbulanceUpdateExportView(ExportModelMixin,
+                                View):
+    model = AmbulanceUpdate
+    resource_class = AmbulanceUpdateResource
+    filename = 'ambulance_updates.csv'
+    select_related = ('ambulance',)
+
+    def get_export_queryset(self, resource):
+        queryset = super().get_export_queryset(resource)
+
+        # filter by ambulance and period
+        ambulance = self.request.GET.get('ambulance', None)
+        if ambulance is not None:
+            queryset = queryset.filter(ambulance_id=ambulance)
+        timestamp_after = self.request.GET.get('timestamp_after', None)
+        if timestamp_after is not None:
+            queryset = queryset.filter(timestamp__gte=parse_call_period(timestamp_after))
+        timestamp_before = self.request.GET.get('timestamp_before', None)
+        if timestamp_before is not None:
+            queryset = queryset.filter(timestamp__lt=parse_call_period(timestamp_before))
+
+        return queryset
+
+    def get(self, *args, **kwargs):
+        try:
+            return super().get(*args, **kwargs)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+
+# Call export
+
+class CallExportView(ExportModelMixin,
+                     View):
+    model = Call
+    resource_class = CallResource
+    filename = 'calls.csv'
+
+    def get_export_queryset(self, resource):
+        queryset = super().get_export_queryset(resource)
+
+        # filter by status and period
+        status = self.request.GET.get('status', None)
+        if status is not None:
+            queryset = queryset.filter(status=status)
+        return queryset.filter_period(**{key: self.request.GET.get(key, None) for key in CallPeriodFilters})
+
+    def get(self, *args, **kwargs):
+        try:
+            return super().get(*args, **kwargs)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+
+
 # CallRadioCode import and export
 
 class CallRadioCodeExportView(ExportModelMixin,
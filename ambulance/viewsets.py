@@ -8,7 +8,7 @@ from rest_framework import viewsets, mixins, exceptions
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.pagination import PageNumberPagination, LimitOffsetPagination
+from rest_framework.pagination import PageNumberPagination, LimitOffsetPagination, CursorPagination
 from rest_framework.exceptions import APIException, NotFound
 from rest_framework.status import HTTP_400_BAD_REQUEST
 
@@ -27,11 +27,11 @@ from .permissions import CallPermissionMixin
 
 from .models import Location, Ambulance, LocationType, Call, CallNote, AmbulanceUpdate, AmbulanceCall, \
     AmbulanceCallHistory, AmbulanceCallStatus, CallStatus, CallPriorityClassification, \
-    CallPriorityCode, CallRadioCode, Waypoint
+    CallPriorityCode, CallRadioCode, Waypoint, CallPeriodFilters, CallStatusOrdering, CallDefaultOrdering
 
 from .serializers import LocationSerializer, AmbulanceSerializer, AmbulanceUpdateSerializer, CallSerializer, \
     CallPriorityCodeSerializer, CallPriorityClassificationSerializer, CallRadioCodeSerializer, \
-    CallAmbulanceSummarySerializer, WaypointSerializer, CallNoteSerializer, AmbulanceUpdateCompactSerializer
+    CallSummarySerializer, WaypointSerializer, CallNoteSerializer, AmbulanceUpdateCompactSerializer
 
 
 logger = logging.getLogger(__name__)
@@ -79,6 +79,42 @@ class AmbulanceLimitOffsetPagination(LimitOffsetPagination):
     max_limit = 5000
 
 
+class CallCursorPagination(CursorPagination):
+    """
+    Keyset pagination of calls, enabled only when page_size is given.
+
+    Calls are ordered by the timestamp of the status the view filtered by,
+    if any, see CallStatusOrdering, and by creation otherwise.
+    """
+    page_size = None
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    ordering = CallDefaultOrdering
+
+    def get_ordering(self, request, queryset, view):
+
+        ordering = CallStatusOrdering.get(getattr(view, 'status_filter', None))
+        if ordering is None:
+            return self.ordering
+
+        # cursors cannot be built from null timestamps
+        field = ordering[0].lstrip('-')
+        if queryset.filter(**{'{}__isnull'.format(field): True}).exists():
+            return self.ordering
+
+        return ordering
+
+
+def filter_call_period(queryset, query_params):
+    """
+    Apply the created_at/ended_at period filters in query_params.
+    """
+    try:
+        return queryset.filter_period(**{key: query_params.get(key, None) for key in CallPeriodFilters})
+    except ValueError as e:
+        raise exceptions.ValidationError({'detail': str(e)})
+
+
 # Ambulance viewset
 
 class AmbulanceViewSet(mixins.ListModelMixin,
@@ -112,10 +148,17 @@ class AmbulanceViewSet(mixins.ListModelMixin,
 
     serializer_class = AmbulanceSerializer
 
-    @action(detail=True, methods=['get'])
+    @action(detail=True, methods=['get'], pagination_class=CallCursorPagination)
     def calls(self, request, pk=None, **kwargs):
         """Retrieve active calls for ambulance instance."""
         calls = Call.objects.filter(ambulancecall__ambulance_id=pk).exclude(status=CallStatus.E.name)
+        calls = filter_call_period(calls, request.query_params).prefetch_for_serializer()
+
+        # paginate only if page_size is given
+        page = self.paginate_queryset(calls)
+        if page is not None:
+            serializer = CallSerializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
 
         serializer = CallSerializer(calls, many=True)
         return Response(serializer.data)
@@ -406,6 +449,7 @@ class CallViewSet(mixins.ListModelMixin,
     queryset = Call.objects.all()
 
     serializer_class = CallSerializer
+    pagination_class = CallCursorPagination
 
     def get_queryset(self):
 
@@ -415,13 +459,20 @@ class CallViewSet(mixins.ListModelMixin,
         status = self.request.query_params.get('status', None)
         exclude = self.request.query_params.get('exclude', CallStatus.E.name)
 
-        # filter by status
+        # filter by status, also used for ordering pages
+        self.status_filter = status
         if status is not None:
             queryset = queryset.filter(status=status)
         elif exclude is not None:
             queryset = queryset.exclude(status=exclude)
 
-        return queryset
+        # filter by period
+        queryset = filter_call_period(queryset, self.request.query_params)
+
+        # retrieve related objects in a constant number of queries
+        if self.action == 'summary':
+            return queryset.prefetch_for_summary_serializer()
+        return queryset.prefetch_for_serializer()
 
     @action(detail=True, methods=['get'], permission_classes=[IsAdminOrSuperOrDispatcher])
     def abort(self, request, pk=None, **kwargs):
@@ -431,10 +482,10 @@ class CallViewSet(mixins.ListModelMixin,
         call = self.get_object()
 
         # abort call
-        call.abort()
+        call.abort(updated_by=request.user)
 
         # serialize and return
-        serializer = CallSerializer(call)
+        serializer = CallSerializer(call.refresh_related())
         return Response(serializer.data)
 
     @action(detail=True, methods=['get'])
@@ -445,7 +496,7 @@ class CallViewSet(mixins.ListModelMixin,
         call = self.get_object()
 
         # serialize and return
-        serializer = CallAmbulanceSummarySerializer(call)
+        serializer = CallSummarySerializer(call)
         return Response(serializer.data)
 
     @action(detail=True, methods=['get'], permission_classes=[IsAdminOrSuperOrDispatcher])
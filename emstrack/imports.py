@@ -0,0 +1,122 @@
+import csv
+import itertools
+import logging
+
+import tablib
+from django.conf import settings
+from django.db import transaction
+from django.utils.encoding import force_text
+
+from import_export.results import Result
+
+from emstrack.mixins import defer_side_effects
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkedImport:
+    """
+    Import a file with a resource in chunks of chunk_size rows.
+
+    Csv files are streamed from disk, other formats are read at once. All
+    chunks are imported in a single transaction, rolled back on dry runs or
+    errors, and the publishes and permission changes of the imported objects
+    are deferred to a single flush after the import.
+    """
+
+    def __init__(self, resource, input_format, file_name, from_encoding='utf-8', chunk_size=None, progress=None):
+        self.resource = resource
+        self.input_format = input_format
+        self.file_name = file_name
+        self.from_encoding = from_encoding
+        self.chunk_size = chunk_size or getattr(settings, 'IMPORT_CHUNK_SIZE', 1000)
+        self.progress = progress
+
+    def is_csv(self):
+        return self.input_format.get_title() == 'csv'
+
+    def open(self):
+        # skip byte order marks
+        encoding = 'utf-8-sig' if self.from_encoding.lower() in ('utf-8', 'utf8') else self.from_encoding
+        return open(self.file_name, 'r', encoding=encoding, newline='')
+
+    def count(self):
+        if self.is_csv():
+            with self.open() as file:
+                return max(sum(1 for _ in csv.reader(file)) - 1, 0)
+        return None
+
+    def get_datasets(self):
+        """
+        Yield tablib datasets of at most chunk_size rows.
+        """
+
+        if self.is_csv():
+
+            with self.open() as file:
+                reader = csv.reader(file)
+                headers = next(reader, None)
+                if headers is None:
+                    return
+                while True:
+                    rows = list(itertools.islice(reader, self.chunk_size))
+                    if not rows:
+                        break
+                    # pad or truncate rows to the headers
+                    yield tablib.Dataset(*[(row + [''] * len(headers))[:len(headers)] for row in rows],
+                                         headers=headers)
+
+        else:
+
+            with open(self.file_name, self.input_format.get_read_mode()) as file:
+                data = file.read()
+            if not self.input_format.is_binary() and self.from_encoding:
+                data = force_text(data, self.from_encoding)
+            dataset = self.input_format.create_dataset(data)
+            for start in range(0, len(dataset), self.chunk_size):
+                yield tablib.Dataset(*dataset[start:start + self.chunk_size], headers=dataset.headers)
+
+    def merge(self, result, chunk, offset):
+
+        if result is None:
+            return chunk
+
+        result.base_errors.extend(chunk.base_errors)
+        result.rows.extend(chunk.rows)
+        for row in chunk.invalid_rows:
+            row.number += offset
+            result.invalid_rows.append(row)
+        for (key, value) in chunk.totals.items():
+            result.totals[key] = result.totals.get(key, 0) + value
+        result.total_rows += chunk.total_rows
+        return result
+
+    def run(self, dry_run=False, raise_errors=False, **kwargs):
+
+        total = self.count()
+        result = None
+        offset = 0
+
+        with defer_side_effects() as effects:
+
+            with transaction.atomic():
+
+                for dataset in self.get_datasets():
+
+                    chunk = self.resource.import_data(dataset, dry_run=dry_run,
+                                                      raise_errors=raise_errors,
+                                                      **kwargs)
+                    result = self.merge(result, chunk, offset)
+                    offset += len(dataset)
+
+                    logger.info('Imported {} of {} rows'.format(offset, total if total is not None else '?'))
+                    if self.progress is not None:
+                        self.progress(offset, total)
+
+                # all or nothing
+                if dry_run or result is None or result.has_errors() or result.has_validation_errors():
+                    transaction.set_rollback(True)
+                    effects.discard()
+
+        # empty file
+        return result if result is not None else Result()
@@ -1,12 +1,16 @@
+import copy
+import csv
 import logging
 import os
 import tempfile
+import threading
+from contextlib import contextmanager
 
 from django.contrib import messages
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.http import HttpResponseRedirect, HttpResponse
+from django.db import transaction
+from django.http import HttpResponseRedirect, StreamingHttpResponse
 from django.template.response import TemplateResponse
-from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
 
 from rest_framework import mixins
@@ -55,6 +59,10 @@ class BasePermissionMixin:
     queryset = None
     dispatcher_override = False
 
+    def get_permissions_filter(self, user, write=False):
+        from login.permissions import get_permissions_filter
+        return get_permissions_filter(user, self.profile_field, self.filter_field, write=write)
+
     def get_queryset(self):
 
         # print('@get_queryset {}({})'.format(self.request.user,
@@ -69,33 +77,28 @@ class BasePermissionMixin:
         if user.is_anonymous:
             raise PermissionDenied()
 
-        # get permissions
-        from login.permissions import get_permissions
-        permissions = get_permissions(user)
-
         # otherwise only return objects that the user can read or write to
         # if dispatcher_override is True substitute read permissions for write permissions
         if self.request.method == 'GET' or (self.dispatcher_override and user.userprofile.is_dispatcher):
             # objects that the user can read
-            can_do = permissions.get_can_read(self.profile_field)
+            write = False
 
         elif (self.request.method == 'PUT' or
               self.request.method == 'PATCH' or
               self.request.method == 'DELETE'):
             # objects that the user can write to
-            can_do = permissions.get_can_write(self.profile_field)
+            write = True
 
         else:
             raise PermissionDenied()
 
-        # add filter
-        filter_params = {self.filter_field + '__in': can_do}
+        # add filter on the effective permissions
+        filter_params = self.get_permissions_filter(user, write=write)
 
-        logger.debug('can_do = {}'.format(can_do))
         logger.debug('filter_params = {}'.format(filter_params))
 
         # retrieve query
-        return super().get_queryset().filter(**filter_params)
+        return super().get_queryset().filter(filter_params)
 
 
 class SuccessMessageWithInlinesMixin:
@@ -147,18 +150,217 @@ class UpdatedByMixin:
         return super().form_valid(form)
 
 
-class PublishMixin:
+class ChangeTrackingMixin:
+    """
+    Track changes to the field values loaded from the database.
+
+    Values are captured in from_db and refreshed after every save, so that
+    save() can skip the UPDATE, history and publication when no tracked
+    field changed; see skip_unchanged.
+    """
+
+    # fields not compared, by attname
+    untracked_fields = ('updated_by_id', 'updated_on')
+
+    # set to False to always save
+    track_changes = True
+
+    # default value for _loaded_values
+    _loaded_values = None
+
+    # skipped operations, all models
+    skipped_lock = threading.Lock()
+    skipped = {
+        'writes': 0,
+        'history': 0,
+        'publishes': 0,
+    }
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+
+        # call super
+        instance = super().from_db(db, field_names, values)
+
+        # store the original field values on the instance
+        instance._loaded_values = {name: copy.copy(value) for (name, value) in zip(field_names, values)}
+
+        # return instance
+        return instance
+
+    def snapshot(self, fields=None):
+
+        # store current values of fields that are not deferred
+        values = {field.attname: copy.copy(getattr(self, field.attname))
+                  for field in self._meta.concrete_fields
+                  if field.attname in self.__dict__ and (fields is None or field.attname in fields)}
+        if fields is None or self._loaded_values is None:
+            self._loaded_values = values
+        else:
+            self._loaded_values.update(values)
+
+    def save_base(self, *args, **kwargs):
+        super().save_base(*args, **kwargs)
+        self.snapshot()
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self.snapshot(None if fields is None else [self._meta.get_field(name).attname for name in fields])
+
+    def get_changed_fields(self, update_fields=None):
+        """
+        Returns the attnames of the tracked fields that changed, or None if not loaded from the database.
+        """
+
+        if self.pk is None or self._loaded_values is None:
+            return None
+
+        if update_fields is not None:
+            update_fields = {self._meta.get_field(name).attname for name in update_fields}
+
+        changed = []
+        for field in self._meta.concrete_fields:
+            attname = field.attname
+            if attname in self.untracked_fields or (update_fields is not None and attname not in update_fields):
+                continue
+            if attname in self._loaded_values:
+                if getattr(self, attname) != self._loaded_values[attname]:
+                    changed.append(attname)
+            elif attname in self.__dict__:
+                # deferred field has been set
+                changed.append(attname)
+
+        return changed
+
+    def has_changed(self, update_fields=None):
+        if not self.track_changes:
+            return True
+        changed = self.get_changed_fields(update_fields)
+        return changed is None or len(changed) > 0
+
+    def skip_unchanged(self, update_fields=None, history=False, publish=False):
+        """
+        Returns True, and counts the skipped operations, if no tracked field changed.
+        """
+
+        if self.has_changed(update_fields):
+            return False
+
+        with self.skipped_lock:
+            ChangeTrackingMixin.skipped['writes'] += 1
+            if history:
+                ChangeTrackingMixin.skipped['history'] += 1
+            if publish:
+                ChangeTrackingMixin.skipped['publishes'] += 1
+
+        logger.debug('Skipped saving unchanged {}(id={})'.format(self.__class__.__name__, self.pk))
+        return True
+
+    @classmethod
+    def get_skipped(cls):
+        with cls.skipped_lock:
+            return dict(ChangeTrackingMixin.skipped)
+
+    @classmethod
+    def reset_skipped(cls):
+        with cls.skipped_lock:
+            for key in ChangeTrackingMixin.skipped:
+                ChangeTrackingMixin.skipped[key] = 0
+
+
+# Deferred side effects
+
+class DeferredSideEffects:
+    """
+    Publishes and permission changes recorded while saving many objects.
+
+    Each object is published once, and effective permissions are updated and
+    permission caches invalidated once, when flushed.
+    """
+
+    def __init__(self):
+        self.publish = {}
+        self.user_ids = set()
+        self.permissions = False
+
+    def add_publish(self, obj):
+        self.publish[(obj.__class__, obj.pk)] = obj
+
+    def add_permissions(self, user_ids):
+        self.user_ids.update(user_ids)
+        self.permissions = True
+
+    def discard(self):
+        self.publish = {}
+        self.user_ids = set()
+        self.permissions = False
+
+    def flush(self):
+
+        if self.permissions:
+            from login.permissions import update_effective_permissions
+            from mqtt.cache_clear import mqtt_cache_clear
+            update_effective_permissions(self.user_ids)
+            mqtt_cache_clear()
+
+        if self.publish and env.bool("DJANGO_ENABLE_MQTT_PUBLISH", default=True):
+            objs = list(self.publish.values())
+            transaction.on_commit(lambda: [obj.publish() for obj in objs])
+
+        logger.debug('Flushed {} publishes and permissions of {} users'.format(len(self.publish),
+                                                                               len(self.user_ids)))
+        self.discard()
+
+
+deferred_side_effects = threading.local()
+
+
+def get_deferred_side_effects():
+    return getattr(deferred_side_effects, 'effects', None)
+
+
+@contextmanager
+def defer_side_effects():
+    """
+    Defer publishes and permission changes of the current thread until exit.
+
+    Nothing is flushed if an exception is raised or if the effects are discarded.
+    """
+
+    # nested, defer to the outermost
+    effects = get_deferred_side_effects()
+    if effects is not None:
+        yield effects
+        return
+
+    effects = deferred_side_effects.effects = DeferredSideEffects()
+    try:
+        yield effects
+    finally:
+        deferred_side_effects.effects = None
+    effects.flush()
+
+
+class PublishMixin(ChangeTrackingMixin):
 
     def save(self, *args, **kwargs):
 
         # publish?
         publish = kwargs.pop('publish', True)
 
+        # nothing changed?
+        if self.skip_unchanged(kwargs.get('update_fields'), publish=publish):
+            return
+
         # save to Call
         super().save(*args, **kwargs)
 
         if publish and env.bool("DJANGO_ENABLE_MQTT_PUBLISH", default=True):
-            self.publish()
+            effects = get_deferred_side_effects()
+            if effects is not None:
+                effects.add_publish(self)
+            else:
+                self.publish()
 
 
 # ImportExport mixin
@@ -200,15 +402,71 @@ class BaseImportExportMixin:
         """
         return self.get_resource_class()
 
+    def import_file(self, resource, input_format, file_name, **kwargs):
+        """
+        Import file in chunks, see ChunkedImport.
+        """
+        from emstrack.imports import ChunkedImport
+        return ChunkedImport(resource, input_format, file_name,
+                             from_encoding=self.from_encoding,
+                             progress=self.import_progress).run(**kwargs)
+
+    def import_progress(self, count, total):
+        logger.debug('{}: imported {} of {} rows'.format(self.model.__name__, count, total))
+
+
+class Echo:
+    """
+    File-like object that returns what is written, for streaming csv.writer rows.
+    """
+
+    def write(self, value):
+        return value
+
 
 # Export Mixin
 class ExportModelMixin(BaseImportExportMixin):
+    """
+    Stream a csv export of the resource queryset.
+
+    The queryset is retrieved in chunks of chunk_size objects, ordered by
+    primary key, so memory does not grow with the size of the export.
+    """
     filename = 'export.csv'
+    chunk_size = 1000
+    select_related = ()
+    prefetch_related = ()
+
+    def get_export_queryset(self, resource):
+        queryset = resource.get_queryset()
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        return queryset
+
+    def iterate_queryset(self, queryset):
+
+        # keyset pagination by primary key
+        queryset = queryset.order_by('pk')
+        last = None
+        while True:
+            chunk = list((queryset if last is None else queryset.filter(pk__gt=last))[:self.chunk_size])
+            yield from chunk
+            if len(chunk) < self.chunk_size:
+                break
+            last = chunk[-1].pk
+
+    def stream(self, resource, queryset):
+        writer = csv.writer(Echo())
+        yield writer.writerow(resource.get_export_headers())
+        for obj in self.iterate_queryset(queryset):
+            yield writer.writerow(resource.export_resource(obj))
 
-    def get(self, *args, **kwargs ):
+    def get(self, *args, **kwargs):
         resource = self.get_export_resource_class()()
-        dataset = resource.export()
-        response = HttpResponse(dataset.csv, content_type="csv")
+        queryset = self.get_export_queryset(resource)
+        response = StreamingHttpResponse(self.stream(resource, queryset), content_type='text/csv')
         response['Content-Disposition'] = 'attachment; filename={}'.format(self.filename)
         return response
 
@@ -262,23 +520,15 @@ class ImportModelMixin(BaseImportExportMixin):
                 for chunk in import_file.chunks():
                     uploaded_file.write(chunk)
 
-            # then read the file, using the proper format-specific mode
-            with open(uploaded_file.name,
-                      input_format.get_read_mode()) as uploaded_import_file:
-                # warning, big files may exceed memory
-                data = uploaded_import_file.read()
-                if not input_format.is_binary() and self.from_encoding:
-                    data = force_text(data, self.from_encoding)
-                dataset = input_format.create_dataset(data)
-                # logger.info(dataset)
-
-                resource = self.get_import_resource_class()()
-                imp_kwargs = self.get_import_data_kwargs(self.request, form=form, *args, **kwargs)
-                result = resource.import_data(dataset, dry_run=True,
-                                              raise_errors=False,
-                                              user=self.request.user,
-                                              request=self.request,
-                                              **imp_kwargs)
+            # then import the file in chunks
+            resource = self.get_import_resource_class()()
+            imp_kwargs = self.get_import_data_kwargs(self.request, form=form, *args, **kwargs)
+            result = self.import_file(resource, input_format, uploaded_file.name,
+                                      dry_run=True,
+                                      raise_errors=False,
+                                      user=self.request.user,
+                                      request=self.request,
+                                      **imp_kwargs)
 
             # logger.info(result.__dict__)
             # for row in result.rows:
@@ -336,28 +586,15 @@ class ProcessImportModelMixin(BaseImportExportMixin):
             form.cleaned_data['import_file_name']
         )
 
-        # open import file
-        with open(import_file_name, input_format.get_read_mode()) as import_file:
-
-            # read file
-            data = import_file.read()
-
-            # handle encoding
-            if not input_format.is_binary() and self.from_encoding:
-                data = force_text(data, self.from_encoding)
-
-            # create dataset
-            dataset = input_format.create_dataset(data)
-            # logger.info(dataset)
-
-            # import data, raise error if necessary
-            resource = self.get_import_resource_class()()
-            imp_kwargs = self.get_import_data_kwargs(self.request, form=form)
-            result = resource.import_data(dataset, dry_run=False,
-                                          raise_errors=True,
-                                          user=self.request.user,
-                                          request=self.request,
-                                          **imp_kwargs)
+        # import data in chunks, raise error if necessary
+        resource = self.get_import_resource_class()()
+        imp_kwargs = self.get_import_data_kwargs(self.request, form=form)
+        result = self.import_file(resource, input_format, import_file_name,
+                                  dry_run=False,
+                                  raise_errors=True,
+                                  user=self.request.user,
+                                  request=self.request,
+                                  **imp_kwargs)
 
         return super().form_valid(form)
 
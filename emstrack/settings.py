@@ -87,6 +87,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'login.middleware.PermissionCacheMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -202,6 +203,28 @@ MQTT = {
     'BROKER_WEBSOCKETS_HOST': env.str('MQTT_BROKER_WEBSOCKETS_HOST'),
     'BROKER_WEBSOCKETS_PORT': env.str('MQTT_BROKER_WEBSOCKETS_PORT'),
     'BROKER_TEST_HOST': env.str('MQTT_BROKER_TEST_HOST'),
+    'PROTOCOL': env.str('MQTT_PROTOCOL', default='3.1.1'),
+    'SESSION_EXPIRY': env.int('MQTT_SESSION_EXPIRY', default=0),
+    # topics with 'alias' in MQTT_POLICY, e.g. telemetry, use aliases at any QoS;
+    # messages in flight are resent on their full topic after reconnecting
+    'TOPIC_ALIAS_MAXIMUM': env.int('MQTT_TOPIC_ALIAS_MAXIMUM', default=0),
+    'SHARED_GROUP': env.str('MQTT_SHARED_GROUP', default=''),
+}
+MQTT_PUBLISH_LAZY = env.bool('MQTT_PUBLISH_LAZY', default=False)
+MQTT_PUBLISH_BUFFER_SIZE = env.int('MQTT_PUBLISH_BUFFER_SIZE', default=10000)
+MQTT_PUBLISH_GATEWAY = env.str('MQTT_PUBLISH_GATEWAY', default='')
+MQTT_GATEWAY_QUEUE = env.str('MQTT_GATEWAY_QUEUE', default='/tmp/emstrack-mqtt-gateway.sqlite3')
+
+# MQTT topic policy, overrides of the classes in mqtt.policy.DEFAULT_TOPIC_POLICY
+MQTT_POLICY = {
+    'MAX_INFLIGHT': env.int('MQTT_MAX_INFLIGHT', default=20),
+    'MAX_QUEUED': env.int('MQTT_MAX_QUEUED', default=0),
+    'CLASSES': {
+        'telemetry': {
+            'qos': env.int('MQTT_TELEMETRY_QOS', default=1),
+            'expiry': env.int('MQTT_TELEMETRY_EXPIRY', default=60),
+        },
+    },
 }
 
 # REST Framework
@@ -235,6 +258,57 @@ SMS_KEY = env.str('SMS_KEY')
 SMS_PASS = env.str('SMS_PASS')
 SMS_FROM = env.str('SMS_FROM')
 
+# sms delivery, asynchronous delivery uses a background thread
+SMS_ASYNC = env.bool('SMS_ASYNC', default=False)
+SMS_RATE = env.float('SMS_RATE', default=1.0)
+SMS_BATCH_WINDOW = env.float('SMS_BATCH_WINDOW', default=1.0)
+SMS_MAX_RETRIES = env.int('SMS_MAX_RETRIES', default=3)
+SMS_BACKOFF = env.float('SMS_BACKOFF', default=2.0)
+
+# permission cache, shared version keeps the caches of all processes in sync
+PERMISSION_CACHE_SIZE = env.int('PERMISSION_CACHE_SIZE', default=1000)
+PERMISSION_CACHE_WARMUP = env.bool('PERMISSION_CACHE_WARMUP', default=False)
+
+# free space left in ambulance table pages for HOT updates, 0 to leave unchanged
+AMBULANCE_FILLFACTOR = env.int('AMBULANCE_FILLFACTOR', default=50)
+
+# ingest settings
+INGEST = {
+    'DISTANCE': env.float('INGEST_DISTANCE', default=10),
+    'HEADING': env.float('INGEST_HEADING', default=0),
+    'MAX_SILENCE': env.int('INGEST_MAX_SILENCE', default=0),
+    'STATS_INTERVAL': env.int('INGEST_STATS_INTERVAL', default=300),
+    'LANES': env.list('INGEST_LANES', default=['call', 'status', 'default', 'telemetry']),
+    'COALESCE_THRESHOLD': env.int('INGEST_COALESCE_THRESHOLD', default=1000),
+    'MAX_TELEMETRY': env.int('INGEST_MAX_TELEMETRY', default=10000),
+    'METRICS_INTERVAL': env.int('INGEST_METRICS_INTERVAL', default=60),
+}
+
+# durable spool for ingest, disabled without a path
+MQTT_SPOOL = {
+    'PATH': env.str('MQTT_SPOOL_PATH', default=''),
+    'SEGMENT_SIZE': env.int('MQTT_SPOOL_SEGMENT_SIZE', default=64 * 1024 * 1024),
+    'SYNC_INTERVAL': env.float('MQTT_SPOOL_SYNC_INTERVAL', default=0.05),
+    'BATCH_SIZE': env.int('MQTT_SPOOL_BATCH_SIZE', default=100),
+    'STATS_INTERVAL': env.int('MQTT_SPOOL_STATS_INTERVAL', default=300),
+}
+
+# reporting policy published to clients
+REPORTING_POLICY = {
+    'MODE': env.str('REPORTING_POLICY_MODE', default='tag'),
+    'LOAD_FACTOR': env.float('REPORTING_POLICY_LOAD_FACTOR', default=1.0),
+    'STATUS': {},
+}
+
+# geofence settings
+GEOFENCE = {
+    'ENABLED': env.bool('GEOFENCE_ENABLED', default=False),
+    'RADIUS': env.float('GEOFENCE_RADIUS', default=50),
+    'HYSTERESIS': env.float('GEOFENCE_HYSTERESIS', default=0.2),
+    'REFRESH_SECONDS': env.int('GEOFENCE_REFRESH_SECONDS', default=60),
+    'SYNC_SECONDS': env.float('GEOFENCE_SYNC_SECONDS', default=1),
+}
+
 # Webpack Loader
 WEBPACK_LOADER = {
     'BASE': {
@@ -269,6 +343,7 @@ WEBPACK_LOADER = {
 
 # Import-export settings
 IMPORT_EXPORT_USE_TRANSACTIONS = True
+IMPORT_CHUNK_SIZE = env.int('IMPORT_CHUNK_SIZE', default=1000)
 
 # Logging
 LOGGING = {
@@ -1,6 +1,11 @@
+import heapq
+import itertools
 import logging
+import threading
+import time
 
 from django.conf import settings
+from django.db import connections, transaction
 
 logger = logging.getLogger(__name__)
 
@@ -25,21 +30,200 @@ else:
             self.messages = []
 
 
+class SMSDeliveryError(Exception):
+    pass
+
+
+class SMSDispatcher:
+    """
+    Background SMS delivery queue.
+
+    Messages are delivered by a worker thread, started on first use. Messages
+    to the same destination queued within the batch window are joined into a
+    single SMS, deliveries are limited to rate messages per second and failed
+    deliveries are retried with exponential backoff.
+    """
+
+    def __init__(self, send, rate=None, batch_window=None, max_retries=None, backoff=None):
+
+        self.send = send
+        self.rate = rate if rate is not None else getattr(settings, 'SMS_RATE', 1.0)
+        self.batch_window = batch_window if batch_window is not None else getattr(settings, 'SMS_BATCH_WINDOW', 1.0)
+        self.max_retries = max_retries if max_retries is not None else getattr(settings, 'SMS_MAX_RETRIES', 3)
+        self.backoff = backoff if backoff is not None else getattr(settings, 'SMS_BACKOFF', 2.0)
+
+        # queue of (due, sequence, message, retries)
+        self.queue = []
+        self.sequence = itertools.count()
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.sent_on = 0
+
+        # counters
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'batched': 0,
+            'retried': 0,
+            'failed': 0,
+        }
+
+    def get_stats(self):
+        with self.condition:
+            return dict(self.stats, pending=self.pending)
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name='sms-dispatcher', daemon=True)
+            self.thread.start()
+
+    def enqueue(self, message):
+
+        with self.condition:
+            heapq.heappush(self.queue, (time.monotonic(), next(self.sequence), message, 0))
+            self.pending += 1
+            self.stats['queued'] += 1
+            self.start()
+            self.condition.notify()
+
+    def flush(self, timeout=None):
+        """
+        Wait until all messages have been delivered or have failed; returns False on timeout.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending == 0, timeout)
+
+    def next_batch(self):
+
+        with self.condition:
+
+            # wait for the first message to be due
+            while True:
+                now = time.monotonic()
+                if self.queue and self.queue[0][0] <= now:
+                    break
+                self.condition.wait(self.queue[0][0] - now if self.queue else None)
+
+            # wait for more messages within the batch window
+            window = self.queue[0][0] + self.batch_window
+            while time.monotonic() < window:
+                self.condition.wait(window - time.monotonic())
+
+            # collect messages that are due, by destination
+            now = time.monotonic()
+            batch = {}
+            while self.queue and self.queue[0][0] <= now:
+                (_due, _sequence, message, retries) = heapq.heappop(self.queue)
+                batch.setdefault(message['to'], []).append((message, retries))
+
+            return batch
+
+    def run(self):
+
+        while True:
+
+            batch = self.next_batch()
+            try:
+                for entries in batch.values():
+                    self.deliver(entries)
+            except Exception as e:
+                logger.exception('SMS dispatcher: {}'.format(e))
+            finally:
+                # messages may have been produced using the database
+                connections.close_all()
+
+    def deliver(self, entries):
+
+        # join messages to the same destination
+        messages = [message for (message, _retries) in entries]
+        try:
+            texts = [message['text']() if callable(message['text']) else message['text'] for message in messages]
+        except Exception as e:
+            logger.exception("Could not produce SMS to '{}': {}".format(messages[0]['to'], e))
+            with self.condition:
+                self.pending -= len(entries)
+                self.stats['failed'] += 1
+                self.condition.notify_all()
+            return
+        sms = dict(messages[0], text='\n\n'.join(texts))
+        retries = min(r for (_message, r) in entries)
+
+        # rate limit
+        if self.rate:
+            wait = self.sent_on + 1 / self.rate - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self.sent_on = time.monotonic()
+
+        try:
+            self.send(sms)
+            logger.debug('SMS sent: {}'.format(sms))
+            with self.condition:
+                self.stats['sent'] += 1
+                self.stats['batched'] += len(entries) - 1
+                self.pending -= len(entries)
+                self.condition.notify_all()
+
+        except Exception as e:
+            with self.condition:
+                if retries < self.max_retries:
+                    logger.warning("SMS to '{}' failed, will retry: {}".format(sms['to'], e))
+                    due = time.monotonic() + self.backoff * 2 ** retries
+                    heapq.heappush(self.queue, (due, next(self.sequence), sms, retries + 1))
+                    self.pending -= len(entries) - 1
+                    self.stats['retried'] += 1
+                else:
+                    logger.error("SMS to '{}' failed: {}".format(sms['to'], e))
+                    self.pending -= len(entries)
+                    self.stats['failed'] += 1
+                self.condition.notify_all()
+
+
 class Client(BaseClient):
 
+    def __init__(self, asynchronous=False, **kwargs):
+        super().__init__(**kwargs)
+        self.dispatcher = SMSDispatcher(self.deliver) if asynchronous else None
+
+    def deliver(self, sms):
+        response = self.send_message(sms)
+
+        # nexmo reports failures in the response
+        if isinstance(response, dict):
+            for message in response.get('messages', []):
+                if message.get('status', '0') != '0':
+                    raise SMSDeliveryError(message.get('error-text', message['status']))
+
     def notify_user(self, user, message):
+        """
+        Notify user; message can be a callable, evaluated when the message is delivered.
+        """
         mobile_number = user.userprofile.mobile_number
         if mobile_number:
             sms = {
                 'from': settings.SMS_FROM,
                 'to': mobile_number.as_e164,
-                'text': 'EMSTrack:\n' + message,
+                'text': lambda: 'EMSTrack:\n' + (message() if callable(message) else message),
             }
-            client.send_message(sms)
-            logger.debug('SMS sent: {}'.format(sms))
+            if self.dispatcher is not None:
+                # deliver in the background after commit
+                transaction.on_commit(lambda: self.dispatcher.enqueue(sms))
+                logger.debug('SMS queued: {}'.format(sms['to']))
+            else:
+                sms['text'] = sms['text']()
+                self.send_message(sms)
+                logger.debug('SMS sent: {}'.format(sms))
         else:
             logger.debug('SMS not sent: user {} does not have a mobile on file'.format(user))
 
+    def get_stats(self):
+        return self.dispatcher.get_stats() if self.dispatcher is not None else {}
+
     if not hasattr(BaseClient, 'reset'):
         def reset(self):
             pass
@@ -47,4 +231,5 @@ class Client(BaseClient):
 
 # notify users that they will be updated call
 client = Client(key=settings.SMS_KEY,
-                secret=settings.SMS_PASS)
+                secret=settings.SMS_PASS,
+                asynchronous=getattr(settings, 'SMS_ASYNC', False))
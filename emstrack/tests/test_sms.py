@@ -0,0 +1,64 @@
+from django.test import TestCase
+
+from emstrack.sms import SMSDispatcher
+
+
+class FakeProvider:
+
+    def __init__(self, failures=0):
+        self.messages = []
+        self.failures = failures
+
+    def send_message(self, message):
+        if self.failures > 0:
+            self.failures -= 1
+            raise Exception('provider unavailable')
+        self.messages.append(message)
+
+
+class TestSMSDispatcher(TestCase):
+
+    def test_dispatcher_batching(self):
+
+        provider = FakeProvider()
+        dispatcher = SMSDispatcher(provider.send_message, rate=0, batch_window=0.2, max_retries=0, backoff=0)
+
+        dispatcher.enqueue({'from': 'EMSTrack', 'to': '+15555555555', 'text': 'first'})
+        dispatcher.enqueue({'from': 'EMSTrack', 'to': '+15555555555', 'text': lambda: 'second'})
+        dispatcher.enqueue({'from': 'EMSTrack', 'to': '+15555555556', 'text': 'third'})
+        self.assertTrue(dispatcher.flush(timeout=5))
+
+        # messages to the same destination are joined
+        self.assertCountEqual(provider.messages,
+                              [{'from': 'EMSTrack', 'to': '+15555555555', 'text': 'first\n\nsecond'},
+                               {'from': 'EMSTrack', 'to': '+15555555556', 'text': 'third'}])
+
+        stats = dispatcher.get_stats()
+        self.assertEqual(stats['queued'], 3)
+        self.assertEqual(stats['sent'], 2)
+        self.assertEqual(stats['batched'], 1)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_dispatcher_retries(self):
+
+        provider = FakeProvider(failures=2)
+        dispatcher = SMSDispatcher(provider.send_message, rate=0, batch_window=0, max_retries=3, backoff=0.01)
+
+        dispatcher.enqueue({'from': 'EMSTrack', 'to': '+15555555555', 'text': 'message'})
+        self.assertTrue(dispatcher.flush(timeout=5))
+
+        self.assertEqual(len(provider.messages), 1)
+        stats = dispatcher.get_stats()
+        self.assertEqual(stats['retried'], 2)
+        self.assertEqual(stats['sent'], 1)
+        self.assertEqual(stats['failed'], 0)
+
+        # give up after max_retries
+        provider.failures = 5
+        dispatcher.enqueue({'from': 'EMSTrack', 'to': '+15555555555', 'text': 'message'})
+        self.assertTrue(dispatcher.flush(timeout=5))
+
+        self.assertEqual(len(provider.messages), 1)
+        stats = dispatcher.get_stats()
+        self.assertEqual(stats['retried'], 5)
+        self.assertEqual(stats['failed'], 1)
@@ -14,3 +14,14 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "emstrack.settings")
 
 application = get_wsgi_application()
+
+# connect each uwsgi worker to the MQTT broker after fork
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    pass
+else:
+    @postfork
+    def mqtt_publish_postfork():
+        from mqtt.publish import SingletonPublishClient
+        SingletonPublishClient.postfork()
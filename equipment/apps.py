@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class EquipmentConfig(AppConfig):
     name = 'equipment'
+
+    def ready(self):
+
+        # enable signals
+        from . import signals
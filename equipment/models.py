@@ -1,15 +1,21 @@
+import logging
+import re
 from enum import Enum
 
 from django.contrib.gis.db import models
+from django.core.exceptions import ValidationError
+from django.db.models import Q, Sum
 from django.template.defaulttags import register
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
 
+from emstrack.mixins import ChangeTrackingMixin
 from emstrack.models import UpdatedByModel
 from emstrack.util import make_choices
 from environs import Env
 
 env = Env()
+logger = logging.getLogger(__name__)
 
 
 @register.filter
@@ -29,6 +35,46 @@ EquipmentTypeDefaults = {
     EquipmentType.S.name: ""
 }
 
+# typed column holding the value of each equipment type
+EquipmentTypeValueField = {
+    EquipmentType.B.name: 'value_boolean',
+    EquipmentType.I.name: 'value_integer',
+    EquipmentType.S.name: 'value'
+}
+
+EquipmentBooleanValues = {
+    'true': True,
+    '1': True,
+    'false': False,
+    '0': False
+}
+
+# integer values are plain decimals within the range of value_integer
+EquipmentIntegerPattern = re.compile(r'[-+]?[0-9]+')
+EquipmentIntegerRange = (-2147483648, 2147483647)
+
+
+def parse_equipment_value(type, value):
+    """
+    Returns value converted to the python type of the equipment type.
+    Raises ValueError if value is not valid for the equipment type.
+    """
+    if type == EquipmentType.B.name:
+        try:
+            return EquipmentBooleanValues[str(value).strip().lower()]
+        except KeyError:
+            raise ValueError("'{}' is not a valid boolean".format(value))
+    elif type == EquipmentType.I.name:
+        if not EquipmentIntegerPattern.fullmatch(str(value).strip()):
+            raise ValueError("'{}' is not a valid integer".format(value))
+        value = int(str(value).strip())
+        if not EquipmentIntegerRange[0] <= value <= EquipmentIntegerRange[1]:
+            raise ValueError("'{}' is out of range".format(value))
+        return value
+    elif type == EquipmentType.S.name:
+        return str(value)
+    raise ValueError("'{}' is not a valid equipment type".format(type))
+
 
 class Equipment(models.Model):
     name = models.CharField(_('name'), max_length=254, unique=True)
@@ -116,7 +162,56 @@ class EquipmentHolder(models.Model):
             return reverse('equipment:detail-holder', kwargs={'pk': self.id})
 
 
-class EquipmentItem(UpdatedByModel):
+class EquipmentItemQuerySet(models.QuerySet):
+
+    def filter_value(self, equipment, lookup='exact', value=None):
+        """
+        Filter items of equipment using the typed value column, e.g.
+        filter_value(beds, 'gte', 1) for all holders with at least one bed.
+        """
+        field = EquipmentTypeValueField[equipment.type]
+        value = parse_equipment_value(equipment.type, value)
+        return self.filter(equipment=equipment,
+                           **{'{}__{}'.format(field, lookup): value})
+
+    def total_value(self, equipment):
+        """
+        Sum the values of an integer equipment in the database.
+        """
+        if equipment.type != EquipmentType.I.name:
+            raise ValueError("Only integer equipment can be totaled")
+        return self.filter(equipment=equipment).aggregate(total=Sum('value_integer'))['total']
+
+    def backfill_typed_values(self, batch_size=1000):
+        """
+        Populate the typed value columns of items saved before they existed.
+        Items with invalid values are left empty. Returns the number of items updated.
+        """
+        items = self.select_related('equipment').filter(
+            Q(equipment__type=EquipmentType.B.name, value_boolean__isnull=True) |
+            Q(equipment__type=EquipmentType.I.name, value_integer__isnull=True))
+
+        count = 0
+        batch = []
+        for item in items.iterator():
+            try:
+                value = parse_equipment_value(item.equipment.type, item.value)
+            except ValueError:
+                continue
+            setattr(item, EquipmentTypeValueField[item.equipment.type], value)
+            batch.append(item)
+            if len(batch) >= batch_size:
+                count += len(batch)
+                self.bulk_update(batch, ['value_boolean', 'value_integer'])
+                batch = []
+        if batch:
+            count += len(batch)
+            self.bulk_update(batch, ['value_boolean', 'value_integer'])
+        return count
+
+
+class EquipmentItem(ChangeTrackingMixin,
+                    UpdatedByModel):
     equipmentholder = models.ForeignKey(EquipmentHolder,
                                         on_delete=models.CASCADE,
                                         verbose_name=_('equipmentholder'))
@@ -125,6 +220,33 @@ class EquipmentItem(UpdatedByModel):
                                   verbose_name=_('equipment'))
     value = models.CharField(_('value'), max_length=254)
 
+    # typed values, populated according to equipment.type
+    value_boolean = models.BooleanField(_('value_boolean'), null=True, blank=True)
+    value_integer = models.IntegerField(_('value_integer'), null=True, blank=True)
+
+    objects = EquipmentItemQuerySet.as_manager()
+
+    def clean(self):
+
+        # validate value against equipment type
+        if self.value:
+            try:
+                parse_equipment_value(self.equipment.type, self.value)
+            except ValueError as e:
+                raise ValidationError({'value': str(e)})
+
+    def set_typed_value(self):
+
+        # reset and populate typed value column
+        self.value_boolean = None
+        self.value_integer = None
+        field = EquipmentTypeValueField[self.equipment.type]
+        if field != 'value':
+            try:
+                setattr(self, field, parse_equipment_value(self.equipment.type, self.value))
+            except ValueError as e:
+                logger.warning("Invalid value for equipment item '{}': {}".format(self.pk, e))
+
     def save(self, *args, **kwargs):
 
         # creation?
@@ -134,6 +256,13 @@ class EquipmentItem(UpdatedByModel):
         if not self.value:
             self.value = self.equipment.default
 
+        # populate typed values
+        self.set_typed_value()
+
+        # nothing changed?
+        if self.skip_unchanged(kwargs.get('update_fields'), publish=True):
+            return
+
         # save to EquipmentItem
         super().save(*args, **kwargs)
 
@@ -147,6 +276,16 @@ class EquipmentItem(UpdatedByModel):
 
     class Meta:
         unique_together = ('equipmentholder', 'equipment',)
+        indexes = [
+            models.Index(
+                fields=['equipment', 'value_integer'],
+                name='equipmentitem_integer_idx',
+            ),
+            models.Index(
+                fields=['equipment', 'value_boolean'],
+                name='equipmentitem_boolean_idx',
+            ),
+        ]
 
     def __str__(self):
         return "EquipmentHolder: {}, Equipment: {}, Count: {}".format(self.equipmentholder, self.equipment, self.value)
@@ -1,6 +1,16 @@
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
 from rest_framework import serializers
 
-from .models import EquipmentItem, Equipment
+from environs import Env
+
+from .models import EquipmentItem, Equipment, parse_equipment_value
+
+env = Env()
+logger = logging.getLogger(__name__)
 
 
 class EquipmentItemSerializer(serializers.ModelSerializer):
@@ -17,12 +27,110 @@ class EquipmentItemSerializer(serializers.ModelSerializer):
                             'equipment_id', 'equipment_name', 'equipment_type',
                             'updated_by',)
 
-    # def validate(self, data):
-    #     # call super
-    #     validated_data = super().validate(data)
-    #
-    #     # TODO: validate equipment value using equipment_type
-    #     return validated_data
+    def validate(self, data):
+
+        # validate equipment value using equipment_type
+        if 'value' in data and data['value'] and self.instance is not None:
+            try:
+                parse_equipment_value(self.instance.equipment.type, data['value'])
+            except ValueError as e:
+                raise serializers.ValidationError({'value': str(e)})
+
+        return data
+
+
+class EquipmentItemBulkSerializer(serializers.BaseSerializer):
+    """
+    Update many equipment items of an equipment holder at once.
+
+    Data is a map of equipment_id to value. All values are validated
+    before any item is written, items are written in a single transaction
+    and the changed items are published once the transaction commits.
+    """
+
+    def to_internal_value(self, data):
+
+        if not isinstance(data, dict) or not data:
+            raise serializers.ValidationError('Expected a map of equipment id to value')
+
+        # parse equipment ids
+        errors = {}
+        values = {}
+        for (key, value) in data.items():
+            try:
+                values[int(key)] = value
+            except (TypeError, ValueError):
+                errors[key] = "Invalid equipment id '{}'".format(key)
+
+        # retrieve items in one query
+        items = {item.equipment_id: item
+                 for item in self.instance.equipmentitem_set
+                     .select_related('equipment')
+                     .filter(equipment_id__in=values.keys())}
+
+        # validate all values
+        validated_data = {}
+        for (equipment_id, value) in values.items():
+            item = items.get(equipment_id)
+            if item is None:
+                errors[str(equipment_id)] = "Equipment with id '{}' does not exist".format(equipment_id)
+                continue
+            value = str(value) if value is not None else ''
+            if value:
+                try:
+                    parse_equipment_value(item.equipment.type, value)
+                except ValueError as e:
+                    errors[str(equipment_id)] = str(e)
+                    continue
+            validated_data[equipment_id] = value
+
+        if errors:
+            raise serializers.ValidationError(errors)
+
+        return validated_data
+
+    def to_representation(self, instance):
+        return EquipmentItemSerializer(instance, many=True).data
+
+    def update(self, instance, validated_data):
+
+        # get current user
+        user = validated_data.pop('updated_by')
+
+        with transaction.atomic():
+
+            # lock items and apply values
+            items = list(instance.equipmentitem_set
+                         .select_related('equipment')
+                         .select_for_update()
+                         .filter(equipment_id__in=validated_data.keys()))
+            changed = []
+            updated_on = timezone.now()
+            for item in items:
+
+                value = validated_data[item.equipment_id] or item.equipment.default
+                if value == item.value:
+                    continue
+
+                item.value = value
+                item.set_typed_value()
+                item.updated_by = user
+                item.updated_on = updated_on
+                changed.append(item)
+
+            # write all items at once
+            EquipmentItem.objects.bulk_update(changed, ['value', 'value_boolean', 'value_integer',
+                                                        'updated_by', 'updated_on'])
+
+            if changed and env.bool("DJANGO_ENABLE_MQTT_PUBLISH", default=True):
+
+                # publish changed items after commit
+                from mqtt.publish import SingletonPublishClient
+                transaction.on_commit(lambda: SingletonPublishClient().publish_equipment_items(changed))
+
+        logger.debug('Bulk updated {} of {} equipment items'.format(len(changed), len(items)))
+
+        return items
 
 
 class EquipmentSerializer(serializers.ModelSerializer):
@@ -0,0 +1,20 @@
+import logging
+
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+
+from .models import EquipmentItem
+
+logger = logging.getLogger(__name__)
+
+
+# Add signal to populate the typed values of existing equipment items after migrations
+@receiver(post_migrate)
+def equipment_item_typed_value_handler(sender, using='default', **kwargs):
+
+    if sender.name != 'equipment':
+        return
+
+    count = EquipmentItem.objects.using(using).backfill_typed_values()
+    if count:
+        logger.info('Populated the typed values of {} equipment items'.format(count))
@@ -534,3 +534,149 @@ class TestEquipmentMetadata(TestSetup):
 
         # logout
         client.logout()
+
+
+class TestEquipmentItemTypedValue(TestSetup):
+
+    def test_equipment_item_typed_value(self):
+
+        # typed values are populated on save
+        he1 = EquipmentItem.objects.get(id=self.he1.id)
+        self.assertEqual(he1.value_boolean, True)
+        self.assertIsNone(he1.value_integer)
+
+        he2 = EquipmentItem.objects.get(id=self.he2.id)
+        self.assertEqual(he2.value_integer, 45)
+        self.assertIsNone(he2.value_boolean)
+
+        he3 = EquipmentItem.objects.get(id=self.he3.id)
+        self.assertEqual(he3.value_boolean, False)
+
+        # filter and aggregate in the database
+        self.assertCountEqual(EquipmentItem.objects.filter_value(self.e1, value='True'),
+                              [self.he1, self.he5])
+        self.assertCountEqual(EquipmentItem.objects.filter_value(self.e2, 'gte', 1),
+                              [self.he2])
+        self.assertEqual(EquipmentItem.objects.total_value(self.e2), 45)
+
+        # update value
+        he2.value = '12'
+        he2.save()
+        self.assertEqual(EquipmentItem.objects.get(id=self.he2.id).value_integer, 12)
+        self.assertEqual(EquipmentItem.objects.total_value(self.e2), 12)
+
+    def test_equipment_item_backfill_typed_value(self):
+
+        # items saved before the typed columns existed
+        EquipmentItem.objects.update(value_boolean=None, value_integer=None)
+        self.assertIsNone(EquipmentItem.objects.total_value(self.e2))
+
+        EquipmentItem.objects.backfill_typed_values()
+        self.assertEqual(EquipmentItem.objects.get(id=self.he1.id).value_boolean, True)
+        self.assertEqual(EquipmentItem.objects.get(id=self.he2.id).value_integer, 45)
+        self.assertEqual(EquipmentItem.objects.total_value(self.e2), 45)
+
+        # nothing left to populate
+        self.assertEqual(EquipmentItem.objects.backfill_typed_values(), 0)
+
+    def test_equipment_item_serializer_validate(self):
+
+        # invalid integer
+        serializer = EquipmentItemSerializer(self.he2, data={'value': 'many'}, partial=True)
+        self.assertFalse(serializer.is_valid())
+
+        # valid integer
+        serializer = EquipmentItemSerializer(self.he2, data={'value': '3'}, partial=True)
+        self.assertTrue(serializer.is_valid())
+
+        # integers are plain decimals within range
+        for value in ['1_000', '1e3', '2147483648']:
+            serializer = EquipmentItemSerializer(self.he2, data={'value': value}, partial=True)
+            self.assertFalse(serializer.is_valid())
+
+        # invalid boolean
+        serializer = EquipmentItemSerializer(self.he1, data={'value': '3'}, partial=True)
+        self.assertFalse(serializer.is_valid())
+
+        # valid boolean
+        serializer = EquipmentItemSerializer(self.he1, data={'value': 'False'}, partial=True)
+        self.assertTrue(serializer.is_valid())
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        # set invalid equipment value
+        response = client.patch('/en/api/equipment/{}/item/{}/'.format(str(self.h1.equipmentholder.id), str(self.e2.id)),
+                                content_type='application/json',
+                                data=json.dumps({
+                                    'value': 'many'
+                                })
+                                )
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+
+class TestEquipmentItemBulkUpdate(TestSetup):
+
+    def test_equipment_item_bulk_update_viewset(self):
+        # instantiate client
+        client = Client()
+
+        # login as testuser1
+        client.login(username='testuser1', password='top_secret')
+
+        # set equipment values
+        response = client.patch('/en/api/equipment/{}/item/bulk/'.format(str(self.h1.equipmentholder.id)),
+                                content_type='application/json',
+                                data=json.dumps({
+                                    str(self.e1.id): 'False',
+                                    str(self.e2.id): '12'
+                                })
+                                )
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        answer = [
+            EquipmentItemSerializer(EquipmentItem.objects.get(equipmentholder=self.h1.equipmentholder.id, equipment=self.e1.id)).data,
+            EquipmentItemSerializer(EquipmentItem.objects.get(equipmentholder=self.h1.equipmentholder.id, equipment=self.e2.id)).data
+        ]
+        self.assertCountEqual(result, answer)
+        self.assertEqual(EquipmentItem.objects.get(id=self.he1.id).value, 'False')
+        self.assertEqual(EquipmentItem.objects.get(id=self.he2.id).value_integer, 12)
+
+        # invalid value, nothing is written
+        response = client.patch('/en/api/equipment/{}/item/bulk/'.format(str(self.h1.equipmentholder.id)),
+                                content_type='application/json',
+                                data=json.dumps({
+                                    str(self.e1.id): 'True',
+                                    str(self.e2.id): 'many'
+                                })
+                                )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(EquipmentItem.objects.get(id=self.he1.id).value, 'False')
+        self.assertEqual(EquipmentItem.objects.get(id=self.he2.id).value, '12')
+
+        # inexistent equipment
+        response = client.patch('/en/api/equipment/{}/item/bulk/'.format(str(self.h1.equipmentholder.id)),
+                                content_type='application/json',
+                                data=json.dumps({
+                                    str(self.e3.id): 'True'
+                                })
+                                )
+        self.assertEqual(response.status_code, 400)
+
+        # not permitted to write
+        response = client.patch('/en/api/equipment/{}/item/bulk/'.format(str(self.h3.equipmentholder.id)),
+                                content_type='application/json',
+                                data=json.dumps({
+                                    str(self.e1.id): 'False'
+                                })
+                                )
+        self.assertEqual(response.status_code, 403)
+
+        # logout
+        client.logout()
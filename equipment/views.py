@@ -172,6 +172,7 @@ class EquipmentSetExportView(ExportModelMixin,
                              View):
     model = EquipmentSet
     resource_class = EquipmentSetResource
+    prefetch_related = ('equipmentitem_set',)
 
 
 class EquipmentSetImportView(ImportModelMixin,
@@ -5,10 +5,11 @@ from django.core.exceptions import PermissionDenied
 from rest_framework import viewsets, mixins
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.status import HTTP_400_BAD_REQUEST
 
 from emstrack.mixins import UpdateModelUpdateByMixin, BasePermissionMixin
 from equipment.models import EquipmentItem, EquipmentHolder, Equipment
-from equipment.serializers import EquipmentItemSerializer, EquipmentSerializer
+from equipment.serializers import EquipmentItemSerializer, EquipmentSerializer, EquipmentItemBulkSerializer
 
 from login.permissions import get_permissions
 
@@ -33,6 +34,9 @@ class EquipmentItemViewSet(mixins.ListModelMixin,
 
     partial_update:
     Partially update existing equipment instance.
+
+    bulk:
+    Update many equipment instances at once.
     """
 
     queryset = EquipmentItem.objects.all()
@@ -96,10 +100,31 @@ class EquipmentItemViewSet(mixins.ListModelMixin,
         except EquipmentHolder.DoesNotExist as e:
             raise PermissionDenied()
 
+        # keep equipmentholder for bulk updates
+        self.equipmentholder = equipmentholder
+
         # build queryset
         filter = {'equipmentholder_id': equipmentholder_id}
         return self.queryset.filter(**filter)
 
+    @action(detail=False, methods=['put', 'patch'])
+    def bulk(self, request, **kwargs):
+        """
+        Bulk update equipment items.
+        Use a map of equipment_id to value, e.g. {"1": "True", "2": "12"}.
+        """
+
+        # check write permission once for the equipmentholder
+        self.get_queryset()
+
+        # validate all values and save in one transaction
+        serializer = EquipmentItemBulkSerializer(self.equipmentholder, data=request.data)
+        if serializer.is_valid():
+            serializer.save(updated_by=request.user)
+            return Response(serializer.data)
+
+        return Response(serializer.errors, status=HTTP_400_BAD_REQUEST)
+
 
 class EquipmentViewSet(BasePermissionMixin,
                        viewsets.GenericViewSet):
@@ -3,6 +3,7 @@ from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
 
 from ambulance.models import Location, LocationType
+from emstrack.mixins import ChangeTrackingMixin, get_deferred_side_effects
 from equipment.models import EquipmentHolder
 from environs import Env
 
@@ -11,7 +12,8 @@ env = Env()
 
 # Hospital model
 
-class Hospital(Location):
+class Hospital(ChangeTrackingMixin,
+               Location):
 
     equipmentholder = models.OneToOneField(EquipmentHolder,
                                            on_delete=models.CASCADE,
@@ -35,29 +37,42 @@ class Hospital(Location):
         # enforce type hospital
         self.type = LocationType.h.name
 
+        # nothing changed?
+        if self.skip_unchanged(kwargs.get('update_fields'), publish=True):
+            return
+
         # save to Hospital
         super().save(*args, **kwargs)
 
         if env.bool("DJANGO_ENABLE_MQTT_PUBLISH", default=True):
-
-            # publish to mqtt
-            from mqtt.publish import SingletonPublishClient
-            SingletonPublishClient().publish_hospital(self)
+            effects = get_deferred_side_effects()
+            if effects is not None:
+                effects.add_publish(self)
+            else:
+                self.publish()
 
         # just created?
         if created:
-            # invalidate permissions cache
-            from mqtt.cache_clear import mqtt_cache_clear
-            mqtt_cache_clear()
+            # invalidate permissions cache, once per import
+            from login.mixins import permissions_changed
+            permissions_changed([])
 
-    def delete(self, *args, **kwargs):
+    def publish(self, **kwargs):
 
-        # invalidate permissions cache
-        from mqtt.cache_clear import mqtt_cache_clear
-        mqtt_cache_clear()
+        # publish to mqtt
+        from mqtt.publish import SingletonPublishClient
+        SingletonPublishClient().publish_hospital(self, **kwargs)
+
+    def delete(self, *args, **kwargs):
 
         # delete from Hospital
-        super().delete(*args, **kwargs)
+        result = super().delete(*args, **kwargs)
+
+        # invalidate permissions cache, once per import
+        from login.mixins import permissions_changed
+        permissions_changed([])
+
+        return result
 
     def get_absolute_url(self):
         return reverse('hospital:detail', kwargs={'pk': self.id})
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from login.models import EffectiveAmbulancePermission, EffectiveHospitalPermission
+from login.permissions import rebuild_effective_permissions, cache_invalidate
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuild the materialized effective permissions of all users'
+
+    def handle(self, *args, **options):
+
+        rebuild_effective_permissions()
+        cache_invalidate()
+
+        if options['verbosity'] >= 1:
+            self.stdout.write(
+                self.style.SUCCESS("Rebuilt {} ambulance and {} hospital permissions.".format(
+                    EffectiveAmbulancePermission.objects.count(),
+                    EffectiveHospitalPermission.objects.count())))
@@ -0,0 +1,17 @@
+from login.permissions import cache_sync
+
+
+class PermissionCacheMiddleware:
+    """
+    Clear the permission cache of this process if permissions changed elsewhere.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+
+        # one query per request
+        cache_sync()
+
+        return self.get_response(request)
@@ -1,20 +1,50 @@
+from emstrack.mixins import get_deferred_side_effects
+from login.permissions import update_effective_permissions
 from mqtt.cache_clear import mqtt_cache_clear
 
 
+def permissions_changed(user_ids):
+    """
+    Update the effective permissions of users and invalidate permission caches, unless deferred.
+    """
+
+    effects = get_deferred_side_effects()
+    if effects is not None:
+        effects.add_permissions(user_ids)
+        return
+
+    # update effective permissions
+    update_effective_permissions(user_ids)
+
+    # invalidate permissions cache
+    mqtt_cache_clear()
+
+
 class ClearPermissionCacheMixin:
 
+    def get_permission_user_ids(self):
+        """
+        Ids of the users whose effective permissions depend on this object.
+        """
+        return []
+
     def save(self, *args, **kwargs):
 
         # save to UserProfile
         super().save(*args, **kwargs)
 
-        # invalidate permissions cache
-        mqtt_cache_clear()
+        # update effective permissions and invalidate permissions cache
+        permissions_changed(self.get_permission_user_ids())
 
     def delete(self, *args, **kwargs):
 
+        # users affected by delete
+        user_ids = list(self.get_permission_user_ids())
+
         # delete from UserProfile
-        super().delete(*args, **kwargs)
+        result = super().delete(*args, **kwargs)
+
+        # update effective permissions and invalidate permissions cache
+        permissions_changed(user_ids)
 
-        # invalidate permissions cache
-        mqtt_cache_clear()
+        return result
@@ -6,6 +6,7 @@ from django.contrib.auth.models import User
 from django.contrib.gis.db import models
 from django.core.exceptions import PermissionDenied
 from django.core.validators import MinValueValidator
+from django.db import IntegrityError, transaction
 from django.template.defaulttags import register
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
@@ -13,6 +14,7 @@ from django.utils.translation import ugettext_lazy as _
 from phonenumber_field.modelfields import PhoneNumberField
 
 from ambulance.models import AmbulanceStatus
+from emstrack.mixins import ChangeTrackingMixin
 from emstrack.util import make_choices
 from login.mixins import ClearPermissionCacheMixin
 from login.permissions import get_permissions
@@ -86,6 +88,9 @@ class GroupProfile(ClearPermissionCacheMixin,
     def get_absolute_url(self):
         return reverse('login:detail-group', kwargs={'pk': self.group.id})
 
+    def get_permission_user_ids(self):
+        return User.objects.filter(groups=self.group_id).values_list('id', flat=True)
+
     def __str__(self):
         return '{}: description = {}'.format(self.group, self.description)
 
@@ -115,6 +120,9 @@ class UserAmbulancePermission(ClearPermissionCacheMixin,
     class Meta:
         unique_together = ('user', 'ambulance')
 
+    def get_permission_user_ids(self):
+        return [self.user_id]
+
     def __str__(self):
         return '{}/{}(id={}): read[{}] write[{}]'.format(self.user,
                                                          self.ambulance.identifier,
@@ -135,6 +143,9 @@ class UserHospitalPermission(ClearPermissionCacheMixin,
     class Meta:
         unique_together = ('user', 'hospital')
 
+    def get_permission_user_ids(self):
+        return [self.user_id]
+
     def __str__(self):
         return '{}/{}(id={}): read[{}] write[{}]'.format(self.user,
                                                          self.hospital.name,
@@ -158,6 +169,9 @@ class GroupAmbulancePermission(ClearPermissionCacheMixin,
     def get_absolute_url(self):
         return reverse('login:detail-group', kwargs={'pk': self.group.id})
 
+    def get_permission_user_ids(self):
+        return User.objects.filter(groups=self.group_id).values_list('id', flat=True)
+
     def __str__(self):
         return '{}/{}(id={}): read[{}] write[{}]'.format(self.group,
                                                          self.ambulance.identifier,
@@ -181,6 +195,9 @@ class GroupHospitalPermission(ClearPermissionCacheMixin,
     def get_absolute_url(self):
         return reverse('login:detail-group', kwargs={'pk': self.group.id})
 
+    def get_permission_user_ids(self):
+        return User.objects.filter(groups=self.group_id).values_list('id', flat=True)
+
     def __str__(self):
         return '{}/{}(id={}): read[{}] write[{}]'.format(self.group,
                                                          self.hospital.name,
@@ -189,8 +206,67 @@ class GroupHospitalPermission(ClearPermissionCacheMixin,
                                                          self.can_write)
 
 
+# Effective permissions
+
+class EffectiveAmbulancePermission(Permission):
+    """
+    Effective ambulance permissions of a user, materialized from group and user permissions.
+    """
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             verbose_name=_('user'))
+    ambulance = models.ForeignKey('ambulance.Ambulance',
+                                  on_delete=models.CASCADE,
+                                  verbose_name=_('ambulance'))
+
+    class Meta:
+        unique_together = ('user', 'ambulance')
+
+
+class EffectiveHospitalPermission(Permission):
+    """
+    Effective hospital permissions of a user, materialized from group and user permissions.
+    """
+    user = models.ForeignKey(User,
+                             on_delete=models.CASCADE,
+                             verbose_name=_('user'))
+    hospital = models.ForeignKey('hospital.Hospital',
+                                 on_delete=models.CASCADE,
+                                 verbose_name=_('hospital'))
+
+    class Meta:
+        unique_together = ('user', 'hospital')
+
+
 # TemporaryPassword
 
+class PermissionCacheVersion(models.Model):
+    """
+    Version of the permissions, shared by all processes.
+
+    A single row whose version is incremented every time permissions change,
+    so that every process can tell when its permission cache is stale.
+    """
+
+    version = models.BigIntegerField(_('version'), default=0)
+
+    @classmethod
+    def get_version(cls):
+        version = cls.objects.filter(id=1).values_list('version', flat=True).first()
+        return 0 if version is None else version
+
+    @classmethod
+    def increment(cls):
+        if not cls.objects.filter(id=1).update(version=models.F('version') + 1):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(id=1, version=1)
+            except IntegrityError:
+                # created by a concurrent first increment
+                cls.objects.filter(id=1).update(version=models.F('version') + 1)
+        return cls.get_version()
+
+
 class TemporaryPassword(models.Model):
     user = models.OneToOneField(User,
                                 on_delete=models.CASCADE,
@@ -211,7 +287,8 @@ class ClientStatus(Enum):
 
 
 # Client information
-class Client(models.Model):
+class Client(ChangeTrackingMixin,
+             models.Model):
 
     # NOTE: This shouldn't be needed but django was giving me a hard time
     # id = models.AutoField(_('id'), primary_key=True)
@@ -238,9 +315,6 @@ class Client(models.Model):
 
     updated_on = models.DateTimeField(_('updated_on'), auto_now=True)
 
-    # default value for _loaded_values
-    _loaded_values = None
-
     def __str__(self):
         return '{}[{},{}](ambulance={},hospital={})'.format(self.client_id, self.status,
                                                             self.user, self.ambulance, self.hospital)
@@ -248,18 +322,6 @@ class Client(models.Model):
     def get_absolute_url(self):
         return reverse('login:detail-client', kwargs={'pk': self.id})
 
-    @classmethod
-    def from_db(cls, db, field_names, values):
-
-        # call super
-        instance = super(Client, cls).from_db(db, field_names, values)
-
-        # store the original field values on the instance
-        instance._loaded_values = dict(zip(field_names, values))
-
-        # return instance
-        return instance
-
     def save(self, *args, **kwargs):
 
         from ambulance.models import Ambulance
@@ -431,8 +493,9 @@ class Client(models.Model):
             if self.hospital is not None and not permissions.check_can_write(hospital=self.hospital.id):
                 raise PermissionDenied(_('Cannot write on hospital'))
 
-        # call super
-        super().save(*args, **kwargs)
+        # call super, unless nothing changed; handshakes are still logged
+        if not self.skip_unchanged(kwargs.get('update_fields')):
+            super().save(*args, **kwargs)
 
         # save logs
         for entry in log:
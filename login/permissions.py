@@ -1,6 +1,11 @@
 import logging
+import threading
+from collections import OrderedDict, namedtuple
 
-from functools import lru_cache
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Q
 
 from rest_framework import permissions
 
@@ -9,17 +14,229 @@ from hospital.models import Hospital
 
 logger = logging.getLogger(__name__)
 
-PERMISSION_CACHE_SIZE = 10
+PERMISSION_CACHE_SIZE = getattr(settings, 'PERMISSION_CACHE_SIZE', 10)
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class PermissionCache:
+    """
+    Least recently used cache of user permissions with single-flight rebuilds.
+
+    Concurrent misses for the same user wait for a single Permissions to be
+    built. Permissions that were being built when the cache was cleared are
+    not stored.
+    """
+
+    def __init__(self, maxsize, build=None):
+        self.maxsize = maxsize
+        self.build = build
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.building = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user):
+
+        while True:
+
+            with self.lock:
+
+                # cached?
+                if user in self.data:
+                    self.data.move_to_end(user)
+                    self.hits += 1
+                    return self.data[user]
+
+                # being built?
+                event = self.building.get(user)
+                if event is None:
+                    event = self.building[user] = threading.Event()
+                    generation = self.generation
+                    self.misses += 1
+                    break
+
+            # wait for the build and try again
+            event.wait()
+
+        try:
+            # hit the database for permissions
+            permissions = self.build(user) if self.build is not None else Permissions(user)
+
+            with self.lock:
+                if generation == self.generation:
+                    self.data[user] = permissions
+                    if len(self.data) > self.maxsize:
+                        self.data.popitem(last=False)
+
+            return permissions
+
+        finally:
+            with self.lock:
+                self.building.pop(user, None)
+            event.set()
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.generation += 1
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self.data))
+
+
+cache = PermissionCache(PERMISSION_CACHE_SIZE)
 
 
-@lru_cache(maxsize=PERMISSION_CACHE_SIZE)
 def get_permissions(user):
-    # hit the database for permissions
-    return Permissions(user)
+    return cache.get(user)
+
+
+cache_clear = cache.clear
+cache_info = cache.info
+
+
+def cache_warmup():
+    """
+    Rebuild the permissions of the users of online clients in the background.
+    """
+
+    def warmup():
+        from login.models import Client, ClientStatus
+        try:
+            users = {client.user for client in Client.objects
+                     .filter(status__in=(ClientStatus.O.name, ClientStatus.R.name))
+                     .select_related('user')}
+            for user in users:
+                get_permissions(user)
+            logger.debug('Permission cache warmed up for {} users'.format(len(users)))
+        except Exception as e:
+            logger.warning('Could not warm up permission cache: {}'.format(e))
+        finally:
+            connection.close()
+
+    threading.Thread(target=warmup, name='permission-warmup', daemon=True).start()
+
+
+# version of the permissions in the local cache
+cache_version = None
 
 
-cache_clear = get_permissions.cache_clear
-cache_info = get_permissions.cache_info
+def cache_invalidate():
+    """
+    Clear the local cache and invalidate the caches of all other processes.
+
+    The local cache is cleared again, and its version updated, once the
+    changes are committed, so that permissions rebuilt by other threads
+    from data read before the commit are not kept.
+    """
+    from login.models import PermissionCacheVersion
+
+    # reads in this transaction already see the changes
+    cache_clear()
+    version = PermissionCacheVersion.increment()
+
+    def commit():
+        global cache_version
+        cache_clear()
+        cache_version = version
+
+        # warm up once changes are visible
+        if getattr(settings, 'PERMISSION_CACHE_WARMUP', False):
+            cache_warmup()
+
+    transaction.on_commit(commit)
+
+
+def cache_sync():
+    """
+    Clear the local cache if permissions changed in another process.
+    """
+    global cache_version
+    from login.models import PermissionCacheVersion
+
+    version = PermissionCacheVersion.get_version()
+    if version != cache_version:
+        if cache_version is not None:
+            logger.debug('Permission cache is stale, version {} != {}'.format(cache_version, version))
+        cache_clear()
+        cache_version = version
+
+        # warm up
+        if getattr(settings, 'PERMISSION_CACHE_WARMUP', False):
+            cache_warmup()
+
+
+def update_effective_permissions(user_ids):
+    """
+    Recompute the materialized effective permissions of the given users.
+    """
+    from login.models import EffectiveAmbulancePermission, EffectiveHospitalPermission
+
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+
+    with transaction.atomic():
+
+        EffectiveAmbulancePermission.objects.filter(user_id__in=user_ids).delete()
+        EffectiveHospitalPermission.objects.filter(user_id__in=user_ids).delete()
+
+        # superusers and staff are not filtered
+        ambulance_permissions = []
+        hospital_permissions = []
+        for user in User.objects.filter(id__in=user_ids, is_superuser=False, is_staff=False):
+            permissions = Permissions(user)
+            ambulance_permissions.extend(
+                EffectiveAmbulancePermission(user_id=user.id, ambulance_id=id,
+                                             can_read=obj['can_read'], can_write=obj['can_write'])
+                for (id, obj) in permissions.ambulances.items())
+            hospital_permissions.extend(
+                EffectiveHospitalPermission(user_id=user.id, hospital_id=id,
+                                            can_read=obj['can_read'], can_write=obj['can_write'])
+                for (id, obj) in permissions.hospitals.items())
+
+        EffectiveAmbulancePermission.objects.bulk_create(ambulance_permissions)
+        EffectiveHospitalPermission.objects.bulk_create(hospital_permissions)
+
+    logger.debug('Effective permissions updated for {} users'.format(len(user_ids)))
+
+
+def rebuild_effective_permissions():
+    """
+    Recompute the materialized effective permissions of all users.
+    """
+    update_effective_permissions(User.objects.values_list('id', flat=True))
+
+
+def get_permissions_filter(user, profile_field, filter_field, write=False):
+    """
+    Filter on filter_field restricted to the objects that user can read or write to.
+
+    Uses the materialized effective permissions, so objects are selected by a subquery.
+    """
+    from login.models import EffectiveAmbulancePermission, EffectiveHospitalPermission
+
+    # e.g.: {'user': user, 'can_read': True}
+    condition = {'user': user, 'can_write' if write else 'can_read': True}
+    ambulances = EffectiveAmbulancePermission.objects.filter(**condition)
+    hospitals = EffectiveHospitalPermission.objects.filter(**condition)
+
+    lookup = filter_field + '__in'
+    if profile_field == 'ambulances':
+        return Q(**{lookup: ambulances.values('ambulance_id')})
+    elif profile_field == 'hospitals':
+        return Q(**{lookup: hospitals.values('hospital_id')})
+    elif profile_field == 'equipments':
+        return (Q(**{lookup: ambulances.values('ambulance__equipmentholder_id')}) |
+                Q(**{lookup: hospitals.values('hospital__equipmentholder_id')}))
+    else:
+        raise KeyError(profile_field)
 
 
 class Permissions:
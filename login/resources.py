@@ -5,6 +5,7 @@ from django.contrib.auth.models import User
 
 from import_export import resources, fields, widgets
 
+from login.mixins import permissions_changed
 from login.models import GroupAmbulancePermission, GroupHospitalPermission
 from login.util import PasswordReset
 
@@ -106,7 +107,22 @@ class GroupResource(resources.ModelResource):
         instance.groupprofile.save()
 
 
-class GroupAmbulancePermissionResource(resources.ModelResource):
+class GroupPermissionResourceMixin:
+    """
+    Bulk writes do not call save, so update the permissions of the users of the imported groups.
+    """
+    group_permission_set = None
+
+    def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
+        super().after_import(dataset, result, using_transactions, dry_run, **kwargs)
+        if not dry_run:
+            ids = [row.object_id for row in result.rows if row.object_id is not None]
+            permissions_changed(User.objects.filter(**{'groups__' + self.group_permission_set + '__id__in': ids})
+                                .values_list('id', flat=True).distinct())
+
+
+class GroupAmbulancePermissionResource(GroupPermissionResourceMixin,
+                                       resources.ModelResource):
     group_name = fields.Field(attribute='group__name',
                               widget=widgets.CharWidget(),
                               readonly=True)
@@ -115,15 +131,19 @@ class GroupAmbulancePermissionResource(resources.ModelResource):
                                         widget=widgets.CharWidget(),
                                         readonly=True)
 
+    group_permission_set = 'groupambulancepermission'
+
     class Meta:
         model = GroupAmbulancePermission
         fields = ('id', 'group_name', 'ambulance_identifier',
                   'can_read', 'can_write')
         export_order = ('id', 'group_name', 'ambulance_identifier',
                         'can_read', 'can_write')
+        use_bulk = True
 
 
-class GroupHospitalPermissionResource(resources.ModelResource):
+class GroupHospitalPermissionResource(GroupPermissionResourceMixin,
+                                      resources.ModelResource):
     group_name = fields.Field(attribute='group__name',
                               widget=widgets.CharWidget(),
                               readonly=True)
@@ -132,9 +152,12 @@ class GroupHospitalPermissionResource(resources.ModelResource):
                                  widget=widgets.CharWidget(),
                                  readonly=True)
 
+    group_permission_set = 'grouphospitalpermission'
+
     class Meta:
         model = GroupHospitalPermission
         fields = ('id', 'group_name', 'hospital_name',
                   'can_read', 'can_write')
         export_order = ('id', 'group_name', 'hospital_name',
                         'can_read', 'can_write')
+        use_bulk = True
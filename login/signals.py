@@ -1,19 +1,58 @@
-from django.db.models.signals import post_save, m2m_changed
+import logging
+
+from django.db.models.signals import post_init, post_save, m2m_changed, pre_delete, post_delete, post_migrate
 from django.dispatch import receiver
 
 from django.contrib.auth.models import User, Group
 
-from mqtt.cache_clear import mqtt_cache_clear
+from login.mixins import permissions_changed
+from login.permissions import rebuild_effective_permissions
 from .models import UserProfile, GroupProfile
 
+logger = logging.getLogger(__name__)
+
+
+# Add signal to rebuild the effective permissions after migrations, e.g. on upgrades
+@receiver(post_migrate)
+def effective_permissions_migrate_handler(sender, using='default', **kwargs):
+
+    if sender.name != 'login' or using != 'default':
+        return
+
+    rebuild_effective_permissions()
+    logger.debug('Rebuilt effective permissions')
+
 
 # Add signal to automatically clear cache when group permissions change
 @receiver(m2m_changed, sender=User.groups.through)
-def user_groups_changed_handler(sender, instance, action, **kwargs):
-    if action == 'post_add' or action == 'post_remove':
+def user_groups_changed_handler(sender, instance, action, reverse, pk_set, **kwargs):
+
+    # users affected by the change
+    if action == 'pre_clear' and reverse:
+        instance._permission_user_ids = list(instance.user_set.values_list('id', flat=True))
+        return
+    elif action == 'post_clear':
+        user_ids = getattr(instance, '_permission_user_ids', []) if reverse else [instance.id]
+    elif action == 'post_add' or action == 'post_remove':
+        user_ids = pk_set if reverse else [instance.id]
+    else:
+        return
+
+    # update effective permissions and invalidate permissions cache
+    permissions_changed(user_ids)
+
+
+# Add signal to update effective permissions when a group is deleted
+@receiver(pre_delete, sender=Group)
+def group_pre_delete_handler(sender, instance, **kwargs):
+    instance._permission_user_ids = list(instance.user_set.values_list('id', flat=True))
+
 
-        # invalidate permissions cache
-        mqtt_cache_clear()
+@receiver(post_delete, sender=Group)
+def group_post_delete_handler(sender, instance, **kwargs):
+
+    # update effective permissions and invalidate permissions cache
+    permissions_changed(getattr(instance, '_permission_user_ids', []))
 
 
 # Add signal to automatically extend group profile
@@ -28,3 +67,27 @@ def create_group_profile(sender, instance, created, **kwargs):
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         UserProfile.objects.create(user=instance)
+
+
+def get_user_permission_flags(user):
+    # do not load deferred fields
+    return user.__dict__.get('is_staff'), user.__dict__.get('is_superuser')
+
+
+# Add signal to remember whether a user was staff or superuser when loaded
+@receiver(post_init, sender=User)
+def user_post_init_handler(sender, instance, **kwargs):
+    instance._loaded_permission_flags = get_user_permission_flags(instance)
+
+
+# Add signal to update effective permissions when a user is promoted or demoted
+@receiver(post_save, sender=User)
+def user_post_save_handler(sender, instance, created, **kwargs):
+
+    flags = get_user_permission_flags(instance)
+    changed = not created and flags != getattr(instance, '_loaded_permission_flags', flags)
+    instance._loaded_permission_flags = flags
+
+    # update effective permissions and invalidate permissions cache
+    if changed:
+        permissions_changed([instance.id])
@@ -20,6 +20,23 @@ logger = logging.getLogger(__name__)
 
 class TestClient(TestSetup):
 
+    def test_client_unchanged(self):
+
+        # client online
+        client1 = Client.objects.create(client_id='client_id_1', user=self.u1,
+                                        status=ClientStatus.O.name)
+        self.assertEqual(len(ClientLog.objects.filter(client=client1)), 1)
+
+        # online again, nothing to write but the handshake is logged
+        Client.reset_skipped()
+        client1 = Client.objects.get(id=client1.id)
+        client1.status = ClientStatus.O.name
+        client1.save()
+
+        self.assertEqual(Client.get_skipped()['writes'], 1)
+        self.assertEqual(len(ClientLog.objects.filter(client=client1,
+                                                      activity=ClientActivity.HS.name)), 2)
+
     def testAmbulance(self):
 
         # client online
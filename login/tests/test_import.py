@@ -1,5 +1,7 @@
+import csv
 import logging
 import os
+import tempfile
 
 from django.conf import settings
 from django.urls import reverse
@@ -9,6 +11,14 @@ from django.contrib.auth.models import User
 
 from django.test import Client
 
+from import_export.formats.base_formats import CSV
+
+from ambulance.models import Ambulance, AmbulanceCapability
+from emstrack.imports import ChunkedImport
+from emstrack.mixins import defer_side_effects
+from hospital.models import Hospital
+from login.models import GroupAmbulancePermission, EffectiveAmbulancePermission, PermissionCacheVersion
+from login.resources import GroupAmbulancePermissionResource
 from login.tests.setup_data import TestSetup
 
 logger = logging.getLogger(__name__)
@@ -58,3 +68,52 @@ class TestModels(TestSetup):
         users = User.objects.filter(username='newuser')
         self.assertTrue(users)
 
+    def test_import_chunked(self):
+
+        # export group ambulance permissions, revoking all writes
+        dataset = GroupAmbulancePermissionResource().export()
+        column = dataset.headers.index('can_write')
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as file:
+            writer = csv.writer(file)
+            writer.writerow(dataset.headers)
+            for row in dataset:
+                writer.writerow([0 if i == column else value for (i, value) in enumerate(row)])
+
+        progress = []
+        version = PermissionCacheVersion.get_version()
+
+        # dry run does not write
+        result = ChunkedImport(GroupAmbulancePermissionResource(), CSV(), file.name,
+                               chunk_size=2, progress=lambda count, total: progress.append((count, total))).run(
+            dry_run=True)
+        self.assertFalse(result.has_errors())
+        self.assertEqual(len(result.rows), len(dataset))
+        self.assertEqual(progress[-1], (len(dataset), len(dataset)))
+        self.assertEqual(len(progress), (len(dataset) + 1) // 2)
+        self.assertTrue(GroupAmbulancePermission.objects.filter(can_write=True).exists())
+        self.assertEqual(PermissionCacheVersion.get_version(), version)
+
+        # import
+        result = ChunkedImport(GroupAmbulancePermissionResource(), CSV(), file.name, chunk_size=2).run()
+        os.unlink(file.name)
+        self.assertFalse(result.has_errors())
+        self.assertFalse(GroupAmbulancePermission.objects.filter(can_write=True).exists())
+
+        # effective permissions updated and caches invalidated once
+        self.assertFalse(EffectiveAmbulancePermission.objects.filter(user__in=[self.u5, self.u6, self.u7],
+                                                                     can_write=True).exists())
+        self.assertEqual(PermissionCacheVersion.get_version(), version + 1)
+
+    def test_import_deferred_cache_clear(self):
+
+        version = PermissionCacheVersion.get_version()
+
+        # new ambulances and hospitals invalidate the permission caches once
+        with defer_side_effects():
+            for i in range(3):
+                Ambulance.objects.create(identifier='IMPORT-{}'.format(i),
+                                         capability=AmbulanceCapability.B.name,
+                                         updated_by=self.u1)
+                Hospital.objects.create(name='Import hospital {}'.format(i), updated_by=self.u1)
+            self.assertEqual(PermissionCacheVersion.get_version(), version)
+        self.assertEqual(PermissionCacheVersion.get_version(), version + 1)
@@ -1,4 +1,16 @@
-from login.permissions import Permissions, get_permissions, cache_info, cache_clear
+import threading
+import time
+
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.test import Client
+
+import login.permissions
+from login.models import PermissionCacheVersion, EffectiveAmbulancePermission, EffectiveHospitalPermission, \
+    GroupAmbulancePermission, UserHospitalPermission
+from login.permissions import Permissions, PermissionCache, get_permissions, cache_info, cache_clear, cache_sync, \
+    cache_invalidate, rebuild_effective_permissions
+from login.signals import effective_permissions_migrate_handler
 from login.tests.setup_data import TestSetup
 
 
@@ -675,3 +687,182 @@ class TestPermissions(TestSetup):
         self.assertEqual(info.hits, 0)
         self.assertEqual(info.misses, 0)
         self.assertEqual(info.currsize, 0)
+
+    def test_cache_sync(self):
+
+        # in sync
+        cache_sync()
+        get_permissions(self.u1)
+        self.assertEqual(cache_info().currsize, 1)
+
+        # nothing changed
+        cache_sync()
+        self.assertEqual(cache_info().currsize, 1)
+
+        # permissions changed in another process
+        version = PermissionCacheVersion.get_version()
+        PermissionCacheVersion.increment()
+        self.assertEqual(PermissionCacheVersion.get_version(), version + 1)
+        self.assertEqual(cache_info().currsize, 1)
+
+        cache_sync()
+        self.assertEqual(cache_info().currsize, 0)
+
+        # permissions changed in this process
+        get_permissions(self.u1)
+        cache_invalidate()
+        self.assertEqual(cache_info().currsize, 0)
+        self.assertEqual(PermissionCacheVersion.get_version(), version + 2)
+
+        # a request syncs the cache
+        get_permissions(self.u1)
+        PermissionCacheVersion.increment()
+        client = Client()
+        client.login(username='testuser1', password='top_secret')
+        client.get('/en/api/ambulance/')
+        self.assertEqual(PermissionCacheVersion.get_version(), version + 3)
+        self.assertEqual(login.permissions.cache_version, version + 3)
+        client.logout()
+
+    def test_cache_single_flight(self):
+
+        builds = []
+
+        def build(user):
+            builds.append(user)
+            time.sleep(0.1)
+            return 'permissions of {}'.format(user)
+
+        cache = PermissionCache(2, build=build)
+
+        # concurrent misses build once
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('u1'))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(builds, ['u1'])
+        self.assertEqual(results, ['permissions of u1'] * 5)
+        info = cache.info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 4)
+        self.assertEqual(info.currsize, 1)
+
+        # least recently used is evicted
+        cache.get('u2')
+        cache.get('u1')
+        cache.get('u3')
+        self.assertEqual(list(cache.data.keys()), ['u1', 'u3'])
+
+        # builds that span a clear are not cached
+        thread = threading.Thread(target=cache.get, args=('u4',))
+        thread.start()
+        time.sleep(0.05)
+        cache.clear()
+        thread.join()
+        self.assertEqual(cache.info().currsize, 0)
+
+    def assertEffectivePermissions(self, user):
+        perms = Permissions(user)
+        self.assertCountEqual(perms.get_can_read('ambulances'),
+                              EffectiveAmbulancePermission.objects.filter(user=user, can_read=True)
+                              .values_list('ambulance_id', flat=True))
+        self.assertCountEqual(perms.get_can_write('ambulances'),
+                              EffectiveAmbulancePermission.objects.filter(user=user, can_write=True)
+                              .values_list('ambulance_id', flat=True))
+        self.assertCountEqual(perms.get_can_read('hospitals'),
+                              EffectiveHospitalPermission.objects.filter(user=user, can_read=True)
+                              .values_list('hospital_id', flat=True))
+        self.assertCountEqual(perms.get_can_write('hospitals'),
+                              EffectiveHospitalPermission.objects.filter(user=user, can_write=True)
+                              .values_list('hospital_id', flat=True))
+
+    def test_effective_permissions(self):
+
+        users = [self.u2, self.u3, self.u4, self.u5, self.u6, self.u7]
+
+        # maintained during setup
+        for user in users:
+            self.assertEffectivePermissions(user)
+
+        # superusers and staff are not materialized
+        self.assertFalse(EffectiveAmbulancePermission.objects.filter(user__in=[self.u1, self.u8]).exists())
+
+        # group priority changes
+        self.assertFalse(EffectiveAmbulancePermission.objects.filter(user=self.u6, ambulance=self.a1,
+                                                                     can_read=True).exists())
+        self.g5.groupprofile.priority = 5
+        self.g5.groupprofile.save()
+        self.assertTrue(EffectiveAmbulancePermission.objects.filter(user=self.u6, ambulance=self.a1,
+                                                                    can_read=True).exists())
+        self.assertEffectivePermissions(self.u6)
+
+        # group permission changes
+        permission = GroupAmbulancePermission.objects.get(group=self.g1, ambulance=self.a2)
+        permission.can_write = False
+        permission.save()
+        self.assertEffectivePermissions(self.u5)
+        permission.delete()
+        self.assertEffectivePermissions(self.u5)
+        self.assertFalse(EffectiveAmbulancePermission.objects.filter(user=self.u5, ambulance=self.a2).exists())
+
+        # user permission changes
+        UserHospitalPermission.objects.create(user=self.u4, hospital=self.h3, can_write=True)
+        self.assertEffectivePermissions(self.u4)
+        self.assertTrue(EffectiveHospitalPermission.objects.filter(user=self.u4, hospital=self.h3,
+                                                                   can_write=True).exists())
+
+        # group membership changes
+        self.u4.groups.add(self.g1)
+        self.assertEffectivePermissions(self.u4)
+        self.g1.user_set.remove(self.u4)
+        self.assertEffectivePermissions(self.u4)
+        self.g3.user_set.clear()
+        self.assertEffectivePermissions(self.u5)
+        self.u7.groups.clear()
+        self.assertEffectivePermissions(self.u7)
+        self.assertFalse(EffectiveAmbulancePermission.objects.filter(user=self.u7).exists())
+
+        # group deletion
+        self.g4.delete()
+        self.assertEffectivePermissions(self.u6)
+
+        # saving a user without promoting or demoting it does not recompute
+        version = PermissionCacheVersion.get_version()
+        user = User.objects.get(id=self.u4.id)
+        user.first_name = 'Jose'
+        user.save()
+        self.assertEqual(PermissionCacheVersion.get_version(), version)
+
+        # staff changes
+        user.is_staff = True
+        user.save()
+        self.assertGreater(PermissionCacheVersion.get_version(), version)
+        self.assertFalse(EffectiveHospitalPermission.objects.filter(user=self.u4).exists())
+        user.is_staff = False
+        user.save()
+        self.assertEffectivePermissions(self.u4)
+
+        # rebuild
+        EffectiveAmbulancePermission.objects.all().delete()
+        rebuild_effective_permissions()
+        for user in users:
+            self.assertEffectivePermissions(user)
+
+        # rebuilt after migrations, e.g. when upgrading
+        EffectiveAmbulancePermission.objects.all().delete()
+        EffectiveHospitalPermission.objects.all().delete()
+        effective_permissions_migrate_handler(sender=apps.get_app_config('login'))
+        for user in users:
+            self.assertEffectivePermissions(user)
+
+        # filtered api
+        client = Client()
+        client.login(username='testuser2', password='very_secret')
+        response = client.get('/en/api/ambulance/', follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertCountEqual([ambulance['id'] for ambulance in response.json()],
+                              Permissions(self.u3).get_can_read('ambulances'))
+        client.logout()
@@ -35,6 +35,7 @@ from rest_framework.views import APIView
 from ambulance.models import AmbulanceStatus, AmbulanceCapability, LocationType, Call, CallStatus, AmbulanceCallStatus, \
     AmbulanceStatusOrder, AmbulanceCapabilityOrder, CallPriority, CallPriorityOrder, CallStatusOrder, LocationTypeOrder, \
     WaypointStatus
+from ambulance.ingest import reporting_policy
 from emstrack import CURRENT_VERSION, MINIMUM_VERSION
 from emstrack.mixins import SuccessMessageWithInlinesMixin, UpdatedByMixin, ExportModelMixin, ImportModelMixin, \
     ProcessImportModelMixin, PaginationViewMixin
@@ -698,11 +699,13 @@ class MQTTAclView(CsrfExemptMixin,
                             pass
 
                     #  - user/{username}/client/{client-id}/equipment/{equipment-holder-id}/item/+/data
+                    #  - user/{username}/client/{client-id}/equipment/{equipment-holder-id}/data
                     elif (topic[4] == 'equipment' and
-                          len(topic) == 9 and topic[6] == 'item' and topic[8] == 'data'):
+                          ((len(topic) == 9 and topic[6] == 'item' and topic[8] == 'data') or
+                           (len(topic) == 7 and topic[6] == 'data'))):
 
                         # get equipmentholder_id
-                        equipmentholder_id = int(topic[1])
+                        equipmentholder_id = int(topic[5])
 
                         # is user authorized?
                         try:
@@ -833,6 +836,7 @@ class SettingsView(APIView):
                         'waypoint_status': waypoint_status,
                         'equipment_type': equipment_type,
                         'equipment_type_defaults': equipment_type_defaults,
+                        'reporting_policy': reporting_policy.get_policy(),
                         'defaults': defaults.copy()}
 
         # serialize defaults.location
@@ -903,6 +907,7 @@ class UserExportView(ExportModelMixin,
                      View):
     model = User
     resource_class = UserResource
+    select_related = ('userprofile',)
 
 
 class UserImportView(ImportModelMixin,
@@ -932,18 +937,22 @@ class GroupExportView(ExportModelMixin,
                       View):
     model = Group
     resource_class = GroupResource
+    select_related = ('groupprofile',)
+    prefetch_related = ('user_set',)
 
 
 class GroupAmbulancePermissionExportView(ExportModelMixin,
                                          View):
     model = GroupAmbulancePermission
     resource_class = GroupAmbulancePermissionResource
+    select_related = ('group', 'ambulance')
 
 
 class GroupHospitalPermissionExportView(ExportModelMixin,
                                         View):
     model = GroupHospitalPermission
     resource_class = GroupHospitalPermissionResource
+    select_related = ('group', 'hospital')
 
 
 class GroupImportView(ImportModelMixin,
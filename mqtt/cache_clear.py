@@ -1,4 +1,4 @@
-from login.permissions import cache_clear
+from login.permissions import cache_invalidate
 from environs import Env
 
 env = Env()
@@ -6,8 +6,8 @@ env = Env()
 
 def mqtt_cache_clear():
 
-    # call cache_clear locally
-    cache_clear()
+    # call cache_clear locally and invalidate other processes
+    cache_invalidate()
 
     if env.bool("DJANGO_ENABLE_MQTT_PUBLISH", default=True):
         # and signal through mqtt
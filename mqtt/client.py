@@ -3,7 +3,11 @@ import sys
 import threading
 import time
 
+from collections import OrderedDict
+
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 from django.core.management.base import OutputWrapper
 from django.core.management.color import color_style
@@ -11,14 +15,17 @@ from django.core.management.color import color_style
 from rest_framework import serializers
 from rest_framework.renderers import JSONRenderer
 
+from .policy import PolicyStats, TopicPolicy
+
 logger = logging.getLogger(__name__)
 
 
 class MQTTException(Exception):
 
-    def __init__(self, message, value=None):
+    def __init__(self, message, value=None, info=None):
         super().__init__(message)
         self.value = value
+        self.info = info
 
 
 RETRY_TIMER_SECONDS = 3
@@ -39,9 +46,28 @@ class BaseClient:
         self.style = kwargs.pop('style', color_style())
         self.verbosity = kwargs.pop('verbosity', 1)
         self.debug = kwargs.pop('debug', False)
+        connect_async = kwargs.pop('connect_async', False)
+        self.policy = kwargs.pop('policy', None) or TopicPolicy()
+        self.policy_stats = PolicyStats()
         # self.forgive_mid = False
 
-        if self.broker['CLIENT_ID']:
+        # protocol version, 3.1.1 unless MQTT v5 is requested
+        self.v5 = str(self.broker.get('PROTOCOL', '3.1.1')).lower() in ('5', '5.0', 'v5', 'mqttv5')
+
+        # topic aliases assigned on this connection, most recently used last
+        self.topic_aliases = OrderedDict()
+        self.topic_alias_maximum = 0
+        self.alias_lock = threading.Lock()
+
+        # full topic of messages published with an alias, by mid, until acknowledged
+        self.aliased = {}
+
+        if self.v5:
+            # clean start and session expiry are set on connect
+            self.client = mqtt.Client(client_id=self.broker['CLIENT_ID'] or '',
+                                      protocol=mqtt.MQTTv5,
+                                      transport=self.transport)
+        elif self.broker['CLIENT_ID']:
             self.client = mqtt.Client(client_id=self.broker['CLIENT_ID'],
                                       clean_session=self.broker['CLEAN_SESSION'],
                                       transport=self.transport)
@@ -50,6 +76,9 @@ class BaseClient:
         # WARNING: get client id from private paho's client id property
         self.client_id = self.client._client_id
 
+        # in flight and queue limits
+        self.policy.apply(self.client)
+
         # tls_set?
         if self.tls_set:
             self.client.tls_set(**self.tls_set)
@@ -66,14 +95,22 @@ class BaseClient:
                                  qos=will.get('qos', 2),
                                  retain=will.get('retain', True))
 
-        self.client.on_connect = self.on_connect
+        if self.v5:
+            # translate v5 callbacks
+            self.client.on_connect = self.on_connect_v5
+        else:
+            self.client.on_connect = self.on_connect
 
         # self.subscribed = {}
         # self.published = {}
 
         self.client.on_publish = self.on_publish
-        self.client.on_subscribe = self.on_subscribe
-        self.client.on_disconnect = self.on_disconnect
+        if self.v5:
+            self.client.on_subscribe = self.on_subscribe_v5
+            self.client.on_disconnect = self.on_disconnect_v5
+        else:
+            self.client.on_subscribe = self.on_subscribe
+            self.client.on_disconnect = self.on_disconnect
 
         # default message handler
         self.client.on_message = self.on_message
@@ -84,9 +121,17 @@ class BaseClient:
 
         self.connected = False
 
-        self.client.connect(self.broker['HOST'],
-                            self.broker['PORT'],
-                            self.broker['KEEPALIVE'])
+        if connect_async:
+            # connect once the network loop starts
+            self.client.connect_async(self.broker['HOST'],
+                                      self.broker['PORT'],
+                                      self.broker['KEEPALIVE'],
+                                      **self.get_connect_options())
+        else:
+            self.client.connect(self.broker['HOST'],
+                                self.broker['PORT'],
+                                self.broker['KEEPALIVE'],
+                                **self.get_connect_options())
 
         # add buffer
         self.buffer = []
@@ -97,6 +142,48 @@ class BaseClient:
     def done(self):
         return True
 
+    def get_connect_options(self):
+
+        if not self.v5:
+            return {}
+
+        properties = Properties(PacketTypes.CONNECT)
+
+        # 0 ends the session on disconnect
+        properties.SessionExpiryInterval = int(self.broker.get('SESSION_EXPIRY', 0))
+
+        # accept topic aliases from the broker
+        topic_alias_maximum = int(self.broker.get('TOPIC_ALIAS_MAXIMUM', 0))
+        if topic_alias_maximum:
+            properties.TopicAliasMaximum = topic_alias_maximum
+
+        return {'clean_start': self.broker['CLEAN_SESSION'], 'properties': properties}
+
+    def on_connect_v5(self, client, userdata, flags, reasonCode, properties=None):
+
+        # aliases do not survive the connection
+        with self.alias_lock:
+            self.topic_aliases = OrderedDict()
+            self.topic_alias_maximum = getattr(properties, 'TopicAliasMaximum', 0) if properties else 0
+
+            # paho resends messages in flight once this returns, restore their full topic
+            # WARNING: uses paho's private queue of outgoing messages
+            with client._out_message_mutex:
+                for (mid, topic) in self.aliased.items():
+                    message = client._out_messages.get(mid)
+                    if message is not None and getattr(message.properties, 'TopicAlias', None):
+                        message.topic = topic.encode('utf-8')
+                        del message.properties.TopicAlias
+                self.aliased = {}
+
+        return self.on_connect(client, userdata, flags, reasonCode.value)
+
+    def on_subscribe_v5(self, client, userdata, mid, reasonCodes, properties=None):
+        self.on_subscribe(client, userdata, mid, [reasonCode.value for reasonCode in reasonCodes])
+
+    def on_disconnect_v5(self, client, userdata, reasonCode, properties=None):
+        self.on_disconnect(client, userdata, reasonCode if isinstance(reasonCode, int) else reasonCode.value)
+
     def on_connect(self, client, userdata, flags, rc):
 
         if rc:
@@ -193,15 +280,64 @@ class BaseClient:
         # logger.debug('payload = {}'.format(payload))
         # logger.debug('qos = {}'.format(qos))
         # logger.debug('retain = {}'.format(retain))
-        result = self.client.publish(topic, payload, qos, retain)
+        started = time.monotonic()
+        if self.v5:
+            result = self._publish_v5(topic, payload, qos, retain)
+        else:
+            result = self.client.publish(topic, payload, qos, retain)
         if result.rc:
             logger.debug('Could not publish to topic (rc = {})'.format(result.rc))
-            raise MQTTException('Could not publish to topic (rc = {})'.format(result.rc), result.rc)
+            raise MQTTException('Could not publish to topic (rc = {})'.format(result.rc), result.rc, result)
+
+        self.policy_stats.published(self.policy.get(topic)['class'], result.mid,
+                                    len(payload) if payload is not None else 0, started)
+        return result
+
+    def _publish_v5(self, topic, payload=None, qos=0, retain=False):
+
+        policy = self.policy.get(topic)
+        properties = Properties(PacketTypes.PUBLISH)
+
+        # stale messages are dropped by the broker
+        if policy.get('expiry'):
+            properties.MessageExpiryInterval = int(policy['expiry'])
+
+        if not policy.get('alias') or not self.topic_alias_maximum:
+            return self.client.publish(topic, payload, qos, retain, properties=properties)
+
+        # assign aliases and publish in the same order
+        with self.alias_lock:
+
+            alias = self.topic_aliases.pop(topic, None)
+            if alias is not None:
+                # send alias only
+                self.topic_aliases[topic] = alias
+                properties.TopicAlias = alias
+                result = self.client.publish('', payload, qos, retain, properties=properties)
+            else:
+                if len(self.topic_aliases) < self.topic_alias_maximum:
+                    alias = len(self.topic_aliases) + 1
+                else:
+                    # reassign least recently used alias
+                    (_, alias) = self.topic_aliases.popitem(last=False)
+                self.topic_aliases[topic] = alias
+                properties.TopicAlias = alias
+                result = self.client.publish(topic, payload, qos, retain, properties=properties)
+
+            # aliases are no longer valid if resent after reconnecting
+            if qos:
+                self.aliased[result.mid] = topic
+            return result
 
     def on_publish(self, client, userdata, mid):
-        pass
+        self.policy_stats.acknowledged(mid)
+        self.aliased.pop(mid, None)
 
-    def subscribe(self, topic, qos=0):
+    def subscribe(self, topic, qos=None):
+
+        # qos from policy
+        if qos is None:
+            qos = self.policy.get(topic)['qos']
 
         # try to subscribe
         result, mid = self.client.subscribe(topic, qos)
@@ -215,6 +351,7 @@ class BaseClient:
     def on_disconnect(self, client, userdata, rc):
         logger.debug("Disconnecting client '%s', reason '%d'", self.client_id, rc)
         self.connected = False
+        self.policy_stats.discard()
 
     # disconnect
     def disconnect(self):
@@ -250,7 +387,10 @@ class BaseClient:
         if self.connected:
             raise MQTTException('Could not disconnect')
 
-    def publish_topic(self, topic, payload, qos=0, retain=False):
+    def publish_topic(self, topic, payload, qos=None, retain=None):
+
+        # qos and retain from policy
+        (_, qos, retain) = self.policy.resolve(topic, qos, retain)
 
         # serializer?
         if isinstance(payload, serializers.BaseSerializer):
@@ -264,7 +404,10 @@ class BaseClient:
                      qos=qos,
                      retain=retain)
 
-    def remove_topic(self, topic, qos=0):
+    def remove_topic(self, topic, qos=None):
+
+        # qos from policy
+        (_, qos, _) = self.policy.resolve(topic, qos)
 
         # Publish null to retained topic
         self.publish(topic,
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt
+from django.db import connection
+
+from .lanes import LaneScheduler, get_ordering_key
+from .subscribe import SubscribeClient
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioSubscribeClient(SubscribeClient):
+    """
+    Subscribe client running on an asyncio event loop.
+
+    MQTT I/O runs on the event loop through paho's external loop
+    callbacks, so keep-alives and reads never wait for the database.
+    Handlers run in a pool of at most workers threads, taking messages
+    from priority lanes, in order for messages with the same ordering key.
+    Reading from the broker pauses while more than max_pending messages
+    are waiting.
+    """
+
+    def __init__(self, broker, **kwargs):
+
+        self.workers = kwargs.pop('workers', 8)
+        self.max_pending = kwargs.pop('max_pending', 10000)
+        self.reconnect_delay = kwargs.pop('reconnect_delay', 1)
+
+        # event loop and handler pool
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='mqtt-handler')
+        self.busy = set()
+        self.pending = 0
+        self.socket = None
+        self.paused = False
+        self.stopping = False
+        self.misc = None
+        self.stats = {'dispatched': 0, 'handled': 0, 'failed': 0, 'paused': 0, 'latency': 0.0}
+
+        # connect once the event loop runs
+        super().__init__(broker, connect_async=True, **kwargs)
+        self.scheduler = LaneScheduler(policy=self.policy)
+
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    # MQTT I/O
+
+    def on_socket_open(self, client, userdata, sock):
+        self.socket = sock
+        self.paused = False
+        self.loop.add_reader(sock, self.client.loop_read)
+        self.misc = self.loop.create_task(self.loop_misc())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        self.socket = None
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+        if not self.stopping:
+            self.loop.call_later(self.reconnect_delay, self.reconnect)
+
+    # called from handler threads on publish
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    async def loop_misc(self):
+        # keep-alives and retries
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def reconnect(self):
+        if self.stopping or self.socket is not None:
+            return
+        try:
+            logger.info('>> Reconnecting to MQTT brocker...')
+            self.client.reconnect()
+        except OSError as e:
+            logger.warning('>> Could not reconnect to MQTT brocker: {}'.format(e))
+            self.loop.call_later(self.reconnect_delay, self.reconnect)
+
+    # handlers
+
+    def add_handler(self, topic, handler, spool=True):
+
+        if spool and self.spool is not None:
+            # spooled messages are applied by the replayer
+            super().add_handler(topic, handler, spool)
+            return
+
+        self.client.message_callback_add(topic,
+                                         lambda client, userdata, msg: self.dispatch(handler, msg))
+
+    def dispatch(self, handler, msg):
+
+        self.stats['dispatched'] += 1
+        self.pending += 1
+        if self.pending >= self.max_pending and not self.paused and self.socket is not None:
+            # stop reading until handlers catch up
+            self.loop.remove_reader(self.socket)
+            self.paused = True
+            self.stats['paused'] += 1
+            logger.warning('>> {} messages pending, pausing'.format(self.pending))
+
+        self.scheduler.put(get_ordering_key(msg.topic), msg, handler)
+        self.schedule()
+
+    def schedule(self):
+
+        # pending messages, coalesced or dropped, are no longer pending
+        self.pending = len(self.scheduler) + len(self.busy)
+
+        while len(self.busy) < self.workers:
+            entry = self.scheduler.get(self.busy)
+            if entry is None:
+                break
+            (key, msg, handler) = entry
+            self.busy.add(key)
+            future = self.loop.run_in_executor(self.executor, self.handle, handler, msg, time.monotonic())
+            future.add_done_callback(lambda f, key=key: self.done(key, f))
+
+    def handle(self, handler, msg, dispatched_on):
+
+        # discard broken connections, as Django does between requests
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
+
+        handler(self.client, None, msg)
+        return time.monotonic() - dispatched_on
+
+    def done(self, key, future):
+
+        self.busy.discard(key)
+        try:
+            self.stats['latency'] += future.result()
+            self.stats['handled'] += 1
+        except Exception as e:
+            self.stats['failed'] += 1
+            logger.warning('>> Handler failed: {}'.format(e))
+
+        # next messages
+        self.schedule()
+
+        if self.paused and self.pending < self.max_pending // 2 and self.socket is not None:
+            self.loop.add_reader(self.socket, self.client.loop_read)
+            self.paused = False
+            logger.info('>> {} messages pending, resuming'.format(self.pending))
+
+    def get_stats(self):
+        stats = dict(self.stats, pending=self.pending, busy=len(self.busy), lanes=self.scheduler.get_stats())
+        stats['latency'] = stats['latency'] / stats['handled'] if stats['handled'] else None
+        return stats
+
+    async def report_forever(self):
+        while self.metrics_interval:
+            await asyncio.sleep(self.metrics_interval)
+            self.publish_metrics('ingest', self.get_stats())
+
+    # loop
+
+    def loop_forever(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.reconnect)
+        if self.spool is None:
+            self.loop.create_task(self.report_forever())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.stopping = True
+
+    async def drain(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+    def disconnect(self, timeout=30):
+
+        self.stopping = True
+
+        # stop reading and finish the messages received
+        if self.socket is not None and not self.paused:
+            self.loop.remove_reader(self.socket)
+            self.paused = True
+        if not self.loop.is_running():
+            self.loop.run_until_complete(self.drain(timeout))
+        self.executor.shutdown(wait=True)
+
+        # flush pending writes and close the connection
+        super().disconnect()
+        if self.socket is not None:
+            self.client.loop_write()
+
+        logger.info('<< Subscriber statistics: {}'.format(self.get_stats()))
@@ -0,0 +1,390 @@
+import collections
+import contextlib
+import errno
+import logging
+import os
+import selectors
+import socket
+import sqlite3
+import struct
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from .client import MQTTException
+from .policy import TopicPolicy
+
+logger = logging.getLogger(__name__)
+
+# Frames are
+#
+#   length (uint32) | flags (uint8) | topic length (uint16) | topic | payload
+#
+# where length counts the bytes after itself and flags are
+#
+#   bits 0-1: qos, bit 2: retain, bit 3: null payload
+
+FRAME_LENGTH = struct.Struct('!I')
+FRAME_HEADER = struct.Struct('!BH')
+FLAG_RETAIN = 0x04
+FLAG_NULL = 0x08
+
+
+def encode_frame(topic, payload=None, qos=0, retain=False):
+    topic = topic.encode('utf-8')
+    flags = (qos & 0x03) | (FLAG_RETAIN if retain else 0) | (FLAG_NULL if payload is None else 0)
+    if payload is None:
+        payload = b''
+    elif isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    body = FRAME_HEADER.pack(flags, len(topic)) + topic + payload
+    return FRAME_LENGTH.pack(len(body)) + body
+
+
+def decode_frames(buffer):
+    """
+    Decode the complete frames in buffer, returns (frames, remaining bytes).
+    """
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= FRAME_LENGTH.size:
+        (length,) = FRAME_LENGTH.unpack_from(buffer, offset)
+        start = offset + FRAME_LENGTH.size
+        if len(buffer) - start < length:
+            break
+        (flags, topic_length) = FRAME_HEADER.unpack_from(buffer, start)
+        topic_start = start + FRAME_HEADER.size
+        topic = bytes(buffer[topic_start:topic_start + topic_length]).decode('utf-8')
+        payload = None if flags & FLAG_NULL else bytes(buffer[topic_start + topic_length:start + length])
+        frames.append({'topic': topic, 'payload': payload, 'qos': flags & 0x03, 'retain': bool(flags & FLAG_RETAIN)})
+        offset = start + length
+    return frames, buffer[offset:]
+
+
+class GatewayConnection:
+    """
+    Connection from a web worker to the local publish gateway.
+
+    Writes never block: frames that do not fit in the socket buffer, or that
+    are sent while the gateway is unavailable, are kept in memory, up to
+    max_pending bytes, and flushed in the background.
+    """
+
+    def __init__(self, path, max_pending=10 * 1024 * 1024, retry=1.0):
+        self.path = path
+        self.max_pending = max_pending
+        self.retry = retry
+        self.socket = None
+        self.pending = bytearray()
+        self.lock = threading.Lock()
+        self.timer = None
+        self.connect_on = 0
+        self.dropped = 0
+
+    def connect(self):
+        if self.socket is None and time.monotonic() >= self.connect_on:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                sock.connect(self.path)
+                self.socket = sock
+            except OSError as e:
+                sock.close()
+                self.connect_on = time.monotonic() + self.retry
+                logger.debug("Could not connect to publish gateway '{}': {}".format(self.path, e))
+        return self.socket is not None
+
+    def close(self):
+        with self.lock:
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+
+    def flush(self):
+        # call with lock held
+        while self.pending and self.connect():
+            try:
+                sent = self.socket.send(self.pending)
+                del self.pending[:sent]
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logger.debug("Lost connection to publish gateway '{}': {}".format(self.path, e))
+                self.socket.close()
+                self.socket = None
+                self.connect_on = time.monotonic() + self.retry
+
+        # try again later
+        if self.pending and self.timer is None:
+            self.timer = threading.Timer(self.retry / 10, self.flush_later)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush_later(self):
+        with self.lock:
+            self.timer = None
+            self.flush()
+
+    def send(self, topic, payload=None, qos=0, retain=False):
+        frame = encode_frame(topic, payload, qos, retain)
+        with self.lock:
+            if len(self.pending) + len(frame) > self.max_pending:
+                self.dropped += 1
+                logger.warning("Publish gateway buffer is full, dropping message to '{}'".format(topic))
+                return
+            self.pending += frame
+            self.flush()
+
+    def get_state(self):
+        with self.lock:
+            return {
+                'state': 'gateway',
+                'connected': self.socket is not None,
+                'pending': len(self.pending),
+                'dropped': self.dropped,
+            }
+
+
+class GatewayQueue:
+    """
+    Durable queue of messages to publish, stored in sqlite.
+
+    Pending messages to the same topic are coalesced, so only the latest is
+    published, if they are retained or the topic policy marks them as
+    superseding. Messages are removed once the broker acknowledges them and
+    resent after a restart or reconnection otherwise.
+    """
+
+    def __init__(self, path, policy=None):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS message ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'topic TEXT NOT NULL, payload BLOB, qos INTEGER NOT NULL, retain INTEGER NOT NULL, '
+                                'inflight INTEGER NOT NULL DEFAULT 0)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS message_topic_idx ON message (topic, inflight)')
+        self.policy = policy or TopicPolicy()
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+        # messages in flight when stopped are resent
+        self.reset()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # call with lock held
+        self.connection.execute('BEGIN')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def put(self, topic, payload=None, qos=0, retain=False):
+        self.put_many([{'topic': topic, 'payload': payload, 'qos': qos, 'retain': retain}])
+
+    def put_many(self, messages):
+        """
+        Add messages in order, in a single transaction.
+        """
+        with self.lock, self.transaction():
+            for message in messages:
+                (topic, retain) = (message['topic'], message.get('retain', False))
+                if self.policy.get(topic).get('supersede', False):
+                    cursor = self.connection.execute('DELETE FROM message WHERE topic = ? AND NOT inflight',
+                                                     (topic,))
+                    self.coalesced += cursor.rowcount
+                elif retain:
+                    cursor = self.connection.execute('DELETE FROM message WHERE topic = ? AND retain '
+                                                     'AND NOT inflight', (topic,))
+                    self.coalesced += cursor.rowcount
+                self.connection.execute('INSERT INTO message (topic, payload, qos, retain) VALUES (?, ?, ?, ?)',
+                                        (topic, message.get('payload'), message.get('qos', 0), int(retain)))
+
+    def take(self, limit):
+        """
+        Mark up to limit pending messages as in flight and return them in order.
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT id, topic, payload, qos, retain FROM message '
+                                           'WHERE NOT inflight ORDER BY id LIMIT ?', (limit,)).fetchall()
+            if rows:
+                # the first pending messages, up to the last one taken
+                self.connection.execute('UPDATE message SET inflight = 1 WHERE NOT inflight AND id <= ?',
+                                        (rows[-1][0],))
+        return [{'id': id, 'topic': topic, 'payload': None if payload is None else bytes(payload),
+                 'qos': qos, 'retain': bool(retain)}
+                for (id, topic, payload, qos, retain) in rows]
+
+    def done(self, id):
+        with self.lock:
+            self.connection.execute('DELETE FROM message WHERE id = ?', (id,))
+
+    def release(self, ids):
+        """
+        Mark messages as pending again, to be taken later.
+        """
+        with self.lock, self.transaction():
+            self.connection.executemany('UPDATE message SET inflight = 0 WHERE id = ?', [(id,) for id in ids])
+
+    def reset(self):
+        with self.lock:
+            self.connection.execute('UPDATE message SET inflight = 0 WHERE inflight')
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM message').fetchone()[0]
+
+
+class PublishGateway:
+    """
+    Local publish gateway.
+
+    Receives frames from web workers over a Unix domain socket, stores them
+    in a GatewayQueue and publishes them through a single broker connection,
+    with at most max_inflight unacknowledged messages.
+
+    Messages taken by paho are resent by paho itself after a reconnection,
+    with the same mid, so they stay in flight until acknowledged. Only
+    messages paho does not take are returned to the queue.
+
+    Broker callbacks only post events, which are handled by the gateway
+    thread together with the socket, so paho is never called back into
+    while holding its own locks.
+    """
+
+    def __init__(self, client, path, queue, max_inflight=100):
+        self.client = client
+        self.path = path
+        self.queue = queue
+        self.max_inflight = max_inflight
+        self.inflight = {}
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        self.stats = {'received': 0, 'published': 0}
+
+        # events from the broker thread
+        self.events = collections.deque()
+        (self.wakeup_read, self.wakeup_write) = socket.socketpair()
+        self.wakeup_read.setblocking(False)
+        self.wakeup_write.setblocking(False)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ, self.handle_events)
+
+        # hook broker callbacks
+        on_connect = self.client.client.on_connect
+        on_publish = self.client.client.on_publish
+
+        def connect(*args, **kwargs):
+            on_connect(*args, **kwargs)
+            self.post('connect')
+
+        def publish(client, userdata, mid):
+            on_publish(client, userdata, mid)
+            self.post('publish', mid)
+
+        self.client.client.on_connect = connect
+        self.client.client.on_publish = publish
+
+    def post(self, event, value=None):
+        self.events.append((event, value))
+        try:
+            self.wakeup_write.send(b'\0')
+        except BlockingIOError:
+            # already awake
+            pass
+
+    def handle_events(self, wakeup):
+        try:
+            while wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.events:
+            (event, value) = self.events.popleft()
+            if event == 'publish':
+                id = self.inflight.pop(value, None)
+                if id is not None:
+                    self.queue.done(id)
+                    self.stats['published'] += 1
+
+        self.pump()
+
+    def listen(self):
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(128)
+        server.setblocking(False)
+        self.selector.register(server, selectors.EVENT_READ, self.accept)
+        logger.info("Publish gateway listening on '{}'".format(self.path))
+
+    def accept(self, server):
+        (connection, _address) = server.accept()
+        connection.setblocking(False)
+        self.buffers[connection] = bytearray()
+        self.selector.register(connection, selectors.EVENT_READ, self.read)
+
+    def read(self, connection):
+        try:
+            data = connection.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self.selector.unregister(connection)
+            del self.buffers[connection]
+            connection.close()
+            return
+
+        (frames, self.buffers[connection]) = decode_frames(self.buffers[connection] + data)
+        self.queue.put_many(frames)
+        self.stats['received'] += len(frames)
+        self.pump()
+
+    def pump(self):
+        """
+        Publish pending messages, up to max_inflight.
+        """
+        if not self.client.connected:
+            return
+        available = self.max_inflight - len(self.inflight)
+        if available <= 0:
+            return
+        messages = self.queue.take(available)
+        for (index, message) in enumerate(messages):
+            try:
+                info = self.client._publish(message['topic'], message['payload'],
+                                            message['qos'], message['retain'])
+            except MQTTException as e:
+                if not (message['qos'] and e.value == mqtt.MQTT_ERR_NO_CONN):
+                    # not taken by paho, publish again later
+                    logger.debug('Could not publish to topic (rc = {})'.format(e.value))
+                    self.queue.release([message['id'] for message in messages[index:]])
+                    break
+                # taken by paho, sent once reconnected
+                info = e.info
+            if message['qos'] == 0:
+                self.queue.done(message['id'])
+                self.stats['published'] += 1
+            else:
+                self.inflight[info.mid] = message['id']
+
+    def get_stats(self):
+        return dict(self.stats, inflight=len(self.inflight), queued=len(self.queue), coalesced=self.queue.coalesced)
+
+    def serve_forever(self, report=None, interval=60):
+        self.listen()
+        reported = time.monotonic()
+        while True:
+            for (key, _mask) in self.selector.select(timeout=1):
+                key.data(key.fileobj)
+
+            if report is not None and time.monotonic() - reported >= interval:
+                report(self.get_stats())
+                reported = time.monotonic()
@@ -0,0 +1,189 @@
+import collections
+import json
+import logging
+
+from django.conf import settings
+
+from .policy import TopicPolicy
+
+logger = logging.getLogger(__name__)
+
+
+def merge_payloads(older, newer):
+    """
+    Merge two ambulance data payloads into one with the latest value of each field.
+
+    Payloads are partial updates or lists of them, so applying the merged
+    update leaves the ambulance as applying both would, except for the
+    intermediate fixes. Returns None if the payloads cannot be merged.
+    """
+    merged = {}
+    for payload in (older, newer):
+        try:
+            data = json.loads(payload)
+        except (TypeError, ValueError):
+            return None
+        for update in (data if isinstance(data, list) else [data]):
+            if not isinstance(update, dict):
+                return None
+            merged.update(update)
+    return json.dumps(merged).encode('utf-8')
+
+
+def get_ordering_key(topic):
+    """
+    Returns the key of messages that must be handled in order.
+
+    Messages from devices are ordered per client, which also orders them
+    per ambulance, since only the client logged into an ambulance can
+    update it, and keeps login and status changes ahead of the updates
+    that depend on them. Other messages are ordered by topic.
+    """
+    values = topic.split('/')
+    if len(values) >= 4 and values[0] == 'user' and values[2] == 'client':
+        return 'client/' + values[3]
+    return topic
+
+
+class LaneEntry:
+
+    __slots__ = ('key', 'msg', 'handler', 'lane', 'taken')
+
+    def __init__(self, key, msg, handler, lane):
+        self.key = key
+        self.msg = msg
+        self.handler = handler
+        self.lane = lane
+        self.taken = False
+
+
+class Lane:
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = collections.deque()
+        self.depth = 0
+        self.stats = {'queued': 0, 'handled': 0, 'coalesced': 0, 'dropped': 0}
+
+    def append(self, entry):
+        self.entries.append(entry)
+        self.depth += 1
+
+    def remove(self, entry):
+
+        # entries are removed lazily, once they reach the front
+        entry.taken = True
+        self.depth -= 1
+        while self.entries and self.entries[0].taken:
+            self.entries.popleft()
+
+
+class LaneScheduler:
+    """
+    Priority lanes for ingest.
+
+    Messages are classified by the class of their topic in the topic
+    policy and handled lane by lane, in the order of lanes, so call and
+    client status messages go ahead of telemetry. Messages with the same
+    ordering key are always handled in arrival order: a message waiting
+    behind older messages of its key promotes them, so a client's call or
+    status message moves the client's whole backlog ahead. Keys that are
+    busy are skipped.
+
+    Once more than coalesce_threshold messages are waiting, telemetry
+    waiting on the same topic is coalesced into a single update with the
+    latest fix, and beyond max_telemetry the oldest telemetry is dropped.
+    """
+
+    def __init__(self, lanes=None, coalesce_threshold=None, max_telemetry=None, policy=None):
+
+        options = getattr(settings, 'INGEST', {})
+        self.lanes = [Lane(name) for name in (lanes or options.get('LANES', ['call', 'status', 'default',
+                                                                          'telemetry']))]
+        self.coalesce_threshold = coalesce_threshold if coalesce_threshold is not None \
+            else options.get('COALESCE_THRESHOLD', 1000)
+        self.max_telemetry = max_telemetry if max_telemetry is not None else options.get('MAX_TELEMETRY', 10000)
+        self.policy = policy or TopicPolicy()
+
+        self.by_name = {lane.name: lane for lane in self.lanes}
+        self.default = self.by_name.get('default', self.lanes[-1])
+        self.telemetry = self.by_name.get('telemetry')
+        self.pending = 0
+
+        # waiting entries by ordering key, in arrival order
+        self.keys = {}
+
+        # waiting telemetry by topic
+        self.latest = {}
+
+    def __len__(self):
+        return self.pending
+
+    def classify(self, topic):
+        return self.by_name.get(self.policy.get(topic)['class'], self.default)
+
+    def put(self, key, msg, handler=None, overloaded=None):
+
+        lane = self.classify(msg.topic)
+        lane.stats['queued'] += 1
+
+        if lane is self.telemetry:
+
+            # coalesce under overload, unless other messages of the key arrived since
+            if overloaded is None:
+                overloaded = self.pending >= self.coalesce_threshold
+            entry = self.latest.get(msg.topic)
+            waiting = self.keys.get(key)
+            if entry is not None and overloaded and waiting and waiting[-1] is entry:
+                payload = merge_payloads(entry.msg.payload, msg.payload)
+                if payload is not None:
+                    entry.msg.payload = payload
+                    lane.stats['coalesced'] += 1
+                    return
+
+            # shed the oldest fix
+            if lane.entries and lane.depth >= self.max_telemetry:
+                self.remove(lane.entries[0])
+                lane.stats['dropped'] += 1
+
+        entry = LaneEntry(key, msg, handler, lane)
+        lane.append(entry)
+        self.keys.setdefault(key, collections.deque()).append(entry)
+        if lane is self.telemetry:
+            self.latest[msg.topic] = entry
+        self.pending += 1
+
+    def remove(self, entry):
+
+        entry.lane.remove(entry)
+
+        waiting = self.keys[entry.key]
+        if waiting[0] is entry:
+            waiting.popleft()
+        else:
+            waiting.remove(entry)
+        if not waiting:
+            del self.keys[entry.key]
+
+        if self.latest.get(entry.msg.topic) is entry:
+            del self.latest[entry.msg.topic]
+        self.pending -= 1
+
+    def get(self, busy=()):
+        """
+        Returns (key, msg, handler) of the next message whose key is not busy, or None.
+        """
+        for lane in self.lanes:
+            for entry in lane.entries:
+                if entry.taken or entry.key in busy:
+                    continue
+
+                # oldest message of the key first
+                entry = self.keys[entry.key][0]
+                self.remove(entry)
+                entry.lane.stats['handled'] += 1
+                return entry.key, entry.msg, entry.handler
+        return None
+
+    def get_stats(self):
+        return {lane.name: dict(lane.stats, depth=lane.depth) for lane in self.lanes}
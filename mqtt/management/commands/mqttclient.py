@@ -3,6 +3,8 @@ import logging
 from django.core.management.base import BaseCommand
 from django.conf import settings
 
+from mqtt.engine import AsyncioSubscribeClient
+from mqtt.spool import Spool
 from mqtt.subscribe import SubscribeClient
 
 logger = logging.getLogger(__name__)
@@ -11,6 +13,16 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     help = 'Connect to the mqtt broker'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=['paho', 'asyncio'], default='paho',
+                            help="Run handlers on paho's network thread or on an asyncio loop with a thread pool")
+        parser.add_argument('--workers', nargs='?', type=int, default=8,
+                            help='Number of handler threads of the asyncio engine')
+        parser.add_argument('--max-pending', nargs='?', type=int, default=10000,
+                            help='Messages waiting for a handler before the asyncio engine pauses reading')
+        parser.add_argument('--spool', nargs='?', default=settings.MQTT_SPOOL['PATH'],
+                            help='Directory of the ingest spool, messages are applied from the spool if set')
+
     def handle(self, *args, **options):
 
         import os
@@ -27,10 +39,26 @@ class Command(BaseCommand):
         broker.update(settings.MQTT)
         broker['CLIENT_ID'] = broker['CLIENT_ID'] + '_' + str(os.getpid())
 
-        client = SubscribeClient(broker,
-                                 stdout=self.stdout,
-                                 style=self.style,
-                                 verbosity=options['verbosity'])
+        spool = None
+        if options['spool']:
+            spool = Spool(options['spool'],
+                          segment_size=settings.MQTT_SPOOL['SEGMENT_SIZE'],
+                          sync_interval=settings.MQTT_SPOOL['SYNC_INTERVAL'])
+
+        if options['engine'] == 'asyncio':
+            client = AsyncioSubscribeClient(broker,
+                                            workers=options['workers'],
+                                            max_pending=options['max_pending'],
+                                            spool=spool,
+                                            stdout=self.stdout,
+                                            style=self.style,
+                                            verbosity=options['verbosity'])
+        else:
+            client = SubscribeClient(broker,
+                                     spool=spool,
+                                     stdout=self.stdout,
+                                     style=self.style,
+                                     verbosity=options['verbosity'])
 
         logger.info("* * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *")
         logger.info("* * *                    M Q T T   C L I E N T                    * * *")
@@ -0,0 +1,59 @@
+import datetime
+import logging
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mqtt.gateway import GatewayQueue, PublishGateway
+from mqtt.publish import PublishClient
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Run the local MQTT publish gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', nargs='?', default=settings.MQTT_PUBLISH_GATEWAY or '/tmp/emstrack-mqtt.sock',
+                            help='Unix domain socket to listen on')
+        parser.add_argument('--queue', nargs='?', default=settings.MQTT_GATEWAY_QUEUE,
+                            help='Sqlite file with the retry queue')
+        parser.add_argument('--max-inflight', nargs='?', type=int, default=100,
+                            help='Maximum number of unacknowledged messages')
+        parser.add_argument('--interval', nargs='?', type=int, default=60,
+                            help='Seconds between statistics reports')
+
+    def handle(self, *args, **options):
+
+        broker = {
+            'HOST': settings.MQTT['BROKER_HOST'],
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True
+        }
+        broker.update(settings.MQTT)
+        broker['CLIENT_ID'] = 'mqtt_gateway_' + str(os.getpid())
+
+        client = PublishClient(broker, lazy=True)
+        gateway = PublishGateway(client, options['socket'], GatewayQueue(options['queue'], policy=client.policy),
+                                 max_inflight=options['max_inflight'])
+
+        logger.info("* * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *")
+        logger.info("* * *                   M Q T T   G A T E W A Y                   * * *")
+        logger.info("* * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *")
+        logger.info(datetime.datetime.now())
+
+        def report(stats):
+            self.stdout.write('{}: {}'.format(datetime.datetime.now(), stats))
+
+        try:
+            gateway.serve_forever(report=report if options['verbosity'] > 0 else None,
+                                  interval=options['interval'])
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            client.loop_stop()
+            client.disconnect()
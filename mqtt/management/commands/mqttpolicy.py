@@ -0,0 +1,83 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mqtt.publish import PublishClient
+
+
+class Command(BaseCommand):
+    help = 'Show the MQTT topic policy and measure publish latency and throughput per class'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', nargs='?', type=int, default=0,
+                            help='Number of messages to publish per class, 0 only shows the policy')
+        parser.add_argument('--size', nargs='?', type=int, default=512,
+                            help='Payload size in bytes')
+        parser.add_argument('--timeout', nargs='?', type=int, default=60,
+                            help='Seconds to wait for acknowledgements')
+
+    def handle(self, *args, **options):
+
+        broker = {
+            'HOST': settings.MQTT['BROKER_HOST'],
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True
+        }
+        broker.update(settings.MQTT)
+        broker['CLIENT_ID'] = 'mqtt_policy_' + str(os.getpid())
+
+        client = PublishClient(broker)
+
+        # show policy
+        self.stdout.write('max inflight = {}, max queued = {}'.format(client.policy.max_inflight,
+                                                                       client.policy.max_queued))
+        for entry in client.policy.topics:
+            self.stdout.write('{:>45}: class = {}, qos = {}, retain = {}'.format(entry['pattern'], entry['class'],
+                                                                                 entry['qos'], entry['retain']))
+
+        if not options['count']:
+            return
+
+        # wait for connection
+        while not client.connected:
+            client.loop()
+        client.loop_start()
+
+        try:
+
+            # publish on a benchmark prefix with the policy of each pattern
+            payload = b'x' * options['size']
+            classes = {}
+            for entry in client.policy.topics:
+                classes.setdefault(entry['class'], entry)
+
+            client.policy_stats.reset()
+            for (name, entry) in classes.items():
+                topic = 'benchmark/' + entry['pattern'].replace('+', 'benchmark').replace('#', 'benchmark')
+                # classify by pattern
+                client.policy.cache[topic] = entry
+                for _ in range(options['count']):
+                    client._publish(topic, payload, entry['qos'], False)
+
+            # wait for acknowledgements
+            deadline = time.monotonic() + options['timeout']
+            while time.monotonic() < deadline:
+                stats = client.policy_stats.get_stats()
+                if all(s['acknowledged'] == s['published'] for s in stats.values()):
+                    break
+                time.sleep(0.1)
+
+            for (name, s) in sorted(client.policy_stats.get_stats().items()):
+                self.stdout.write('{:>12}: {} published, {} acknowledged, {:.1f} msg/s, '
+                                  'latency {} ms mean, {} ms max'.format(
+                                      name, s['published'], s['acknowledged'], s['throughput'],
+                                      '{:.1f}'.format(s['latency'] * 1000) if s['latency'] is not None else '-',
+                                      '{:.1f}'.format(s['max_latency'] * 1000) if s['max_latency'] is not None
+                                      else '-'))
+
+        finally:
+            client.loop_stop()
+            client.disconnect()
@@ -0,0 +1,30 @@
+import datetime
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Show the depth and replay lag of the ingest spool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spool', nargs='?', default=settings.MQTT_SPOOL['PATH'],
+                            help='Directory of the ingest spool')
+
+    def handle(self, *args, **options):
+
+        if not options['spool']:
+            raise CommandError('No spool configured')
+
+        # snapshot written by the replayer
+        try:
+            with open(os.path.join(options['spool'], 'stats.json')) as file:
+                stats = json.load(file)
+        except (OSError, ValueError) as e:
+            raise CommandError('Could not read spool statistics: {}'.format(e))
+
+        self.stdout.write('snapshot: {}'.format(datetime.datetime.fromtimestamp(stats.pop('timestamp'))))
+        for (key, value) in sorted(stats.items()):
+            self.stdout.write('{:>10}: {}'.format(key, value))
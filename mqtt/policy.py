@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger(__name__)
+
+# Default policy, the first matching pattern applies
+DEFAULT_TOPIC_POLICY = [
+    # telemetry: full state, a lost or repeated message is superseded by the next
+    {'pattern': 'ambulance/+/data', 'class': 'telemetry', 'qos': 1, 'retain': False,
+     'expiry': 60, 'alias': True, 'supersede': True},
+    {'pattern': 'user/+/client/+/ambulance/+/data', 'class': 'telemetry', 'qos': 1, 'retain': False,
+     'expiry': 60, 'alias': True, 'supersede': True},
+    # calls
+    {'pattern': 'ambulance/+/call/+/status', 'class': 'call', 'qos': 2, 'retain': False},
+    {'pattern': 'call/+/data', 'class': 'call', 'qos': 2, 'retain': False},
+    {'pattern': 'user/+/client/+/ambulance/+/call/+/#', 'class': 'call', 'qos': 2, 'retain': False},
+    # client status
+    {'pattern': 'user/+/client/+/status', 'class': 'status', 'qos': 2, 'retain': False},
+    # everything else
+    {'pattern': '#', 'class': 'default', 'qos': 2, 'retain': False},
+]
+
+
+class TopicPolicy:
+    """
+    Map topics to a class, QoS and retain flag.
+
+    The table is a list of dictionaries with a topic filter 'pattern', a
+    'class' name used for the statistics, a 'qos' and a 'retain' flag,
+    matched in order. With MQTT v5, entries can also set a message 'expiry'
+    in seconds and enable topic 'alias'es. Entries marked 'supersede' carry
+    the full state, so pending messages to the same topic can be dropped in
+    favour of the latest. Also holds the paho limits on the number of
+    messages in flight and queued, which apply to the whole connection.
+
+    Unless topics are given, the table is MQTT_POLICY['TOPICS'] or the
+    default, with the entries of each class in MQTT_POLICY['CLASSES']
+    updated from it.
+    """
+
+    def __init__(self, topics=None, max_inflight=None, max_queued=None, cache_size=10000):
+
+        from django.conf import settings
+        options = getattr(settings, 'MQTT_POLICY', {})
+
+        if topics is None:
+            # default table, with settings overriding entries by class
+            classes = options.get('CLASSES', {})
+            topics = [dict(entry, **classes.get(entry['class'], {}))
+                      for entry in options.get('TOPICS', DEFAULT_TOPIC_POLICY)]
+        self.topics = topics
+        self.max_inflight = max_inflight if max_inflight is not None else options.get('MAX_INFLIGHT', 20)
+        self.max_queued = max_queued if max_queued is not None else options.get('MAX_QUEUED', 0)
+
+        # topics are matched once
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def get(self, topic):
+        """
+        Returns the policy of topic, which can also be a subscription filter.
+        """
+        try:
+            return self.cache[topic]
+        except KeyError:
+            pass
+
+        policy = {'pattern': '#', 'class': 'default', 'qos': 2, 'retain': False}
+        for entry in self.topics:
+            if entry['pattern'] == topic or mqtt.topic_matches_sub(entry['pattern'], topic):
+                policy = entry
+                break
+
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[topic] = policy
+        return policy
+
+    def resolve(self, topic, qos=None, retain=None):
+        """
+        Returns (class, qos, retain), using the policy of topic where qos or retain is None.
+        """
+        policy = self.get(topic)
+        return (policy['class'],
+                policy['qos'] if qos is None else qos,
+                policy['retain'] if retain is None else retain)
+
+    def apply(self, client):
+        """
+        Set the limits of a paho client.
+        """
+        client.max_inflight_messages_set(self.max_inflight)
+        client.max_queued_messages_set(self.max_queued)
+
+
+class PolicyStats:
+    """
+    Per class publish counters and latencies.
+
+    Latency is measured from the call to publish to the acknowledgement
+    from the broker (PUBACK for QoS 1, PUBCOMP for QoS 2, the write for
+    QoS 0).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.acked = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.classes = {}
+            self.started = time.monotonic()
+
+    def get_class(self, name):
+        # call with lock held
+        try:
+            return self.classes[name]
+        except KeyError:
+            stats = self.classes[name] = {'published': 0, 'acknowledged': 0, 'bytes': 0,
+                                          'latency': 0.0, 'max_latency': 0.0}
+            return stats
+
+    def published(self, name, mid, size, started):
+        with self.lock:
+            stats = self.get_class(name)
+            stats['published'] += 1
+            stats['bytes'] += size
+
+            # acknowledged before publish returned?
+            acked = self.acked.pop(mid, None)
+            if acked is not None:
+                self.record(stats, acked - started)
+            else:
+                self.pending[mid] = (name, started)
+
+    def acknowledged(self, mid):
+        now = time.monotonic()
+        with self.lock:
+            try:
+                (name, started) = self.pending.pop(mid)
+            except KeyError:
+                # not published through publish (yet)
+                if len(self.acked) >= 1000:
+                    self.acked = {}
+                self.acked[mid] = now
+                return
+            self.record(self.get_class(name), now - started)
+
+    def record(self, stats, latency):
+        stats['acknowledged'] += 1
+        stats['latency'] += latency
+        stats['max_latency'] = max(stats['max_latency'], latency)
+
+    def discard(self):
+        """
+        Forget messages in flight, e.g. after a disconnection.
+        """
+        with self.lock:
+            self.pending = {}
+            self.acked = {}
+
+    def get_stats(self):
+        """
+        Returns count, throughput (messages per second), mean and max latency (seconds) per class.
+        """
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            return {
+                name: {
+                    'published': stats['published'],
+                    'acknowledged': stats['acknowledged'],
+                    'bytes': stats['bytes'],
+                    'throughput': stats['published'] / elapsed,
+                    'latency': stats['latency'] / stats['acknowledged'] if stats['acknowledged'] else None,
+                    'max_latency': stats['max_latency'] if stats['acknowledged'] else None,
+                }
+                for (name, stats) in self.classes.items()
+            }
@@ -1,6 +1,7 @@
 import os
 import atexit
 import logging
+import time
 
 from ambulance.serializers import AmbulanceSerializer
 from ambulance.serializers import CallSerializer
@@ -10,6 +11,8 @@ from hospital.serializers import HospitalSerializer
 from login.serializers import UserProfileSerializer
 from login.views import SettingsView
 from .client import BaseClient, MQTTException
+from .gateway import GatewayConnection
+from .policy import TopicPolicy
 
 from environs import Env
 
@@ -51,6 +54,9 @@ class MessagePublishClient:
     def publish_equipment_item(self, hospital, **kwargs):
         pass
 
+    def publish_equipment_items(self, equipment_items, **kwargs):
+        pass
+
     def remove_equipment_item(self, hospital, **kwargs):
         pass
 
@@ -70,11 +76,24 @@ class MessagePublishClient:
 
 
 class PublishClient(BaseClient):
+    """
+    Publish client.
+
+    If lazy, connects in the background and buffers publishes until
+    connected, so that publishing never blocks.
+    """
 
     def __init__(self, broker, **kwargs):
 
+        # connection state
+        self.lazy = kwargs.pop('lazy', False)
+        self.buffer_size = kwargs.pop('buffer_size', 10000)
+        self.state = 'connecting'
+        self.connect_started = time.monotonic()
+        self.connect_latency = None
+
         # call super
-        super().__init__(broker, **kwargs)
+        super().__init__(broker, connect_async=self.lazy, **kwargs)
 
         # set as active
         self.active = True
@@ -82,35 +101,109 @@ class PublishClient(BaseClient):
         # set retry
         self.retry = False
 
+        if self.lazy:
+            # connect in the background
+            self.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+
+        if rc and self.lazy:
+            # paho will keep retrying in the background
+            self.state = 'failed'
+            logger.warning('>> Could not connect to brocker (rc = {})'.format(rc))
+            return False
+
+        # call super
+        result = super().on_connect(client, userdata, flags, rc)
+
+        # report latency of first connection
+        self.state = 'connected'
+        if self.connect_latency is None:
+            self.connect_latency = time.monotonic() - self.connect_started
+            logger.info('>> Connected to MQTT brocker in {:.3f}s'.format(self.connect_latency))
+
+        if self.lazy:
+            # send messages published while connecting
+            self.flush_buffer()
+
+        return result
+
     def on_disconnect(self, client, userdata, rc):
         # Exception is generated only if never connected
-        if not self.connected and rc:
+        if not self.connected and rc and not self.lazy:
             raise MQTTException('Disconnected',
                                 rc)
         # call super
         super().on_disconnect(client, userdata, rc)
+        self.state = 'disconnected'
+
+    def flush_buffer(self):
+        try:
+            self.send_buffer()
+        except MQTTException as e:
+            logger.warning('>> Could not send buffered messages: {}'.format(e))
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+
+        if self.lazy:
+            with self.buffer_lock:
+                # buffer until connected and buffer is empty, preserving order
+                buffered = not self.connected or self.buffer
+                if buffered:
+                    if len(self.buffer) >= self.buffer_size:
+                        logger.warning('Publish buffer is full, dropping oldest message')
+                        self.buffer.pop(0)
+                    self.buffer.append({'topic': topic, 'payload': payload, 'qos': qos, 'retain': retain})
+
+            if buffered:
+                # connected, send messages left in the buffer after retries stopped
+                if self.connected:
+                    self.flush_buffer()
+                return
 
-    def publish_topic(self, topic, payload, qos=0, retain=False):
+        # call super
+        super().publish(topic, payload, qos, retain)
+
+    def get_state(self):
+        """
+        Returns the state of the connection, the latency of the first connection and the number of buffered messages.
+        """
+        buffer_lock = getattr(self, 'buffer_lock', None)
+        if buffer_lock is not None:
+            with buffer_lock:
+                buffered = len(self.buffer)
+        else:
+            buffered = 0
+        return {
+            'client_id': getattr(self, 'client_id', None),
+            'state': getattr(self, 'state', 'inactive'),
+            'lazy': getattr(self, 'lazy', False),
+            'connect_latency': getattr(self, 'connect_latency', None),
+            'buffered': buffered,
+            'classes': self.policy_stats.get_stats() if hasattr(self, 'policy_stats') else {},
+        }
+
+    def publish_topic(self, topic, payload, qos=None, retain=None):
         if self.active:
             super().publish_topic(topic, payload, qos, retain)
 
-    def remove_topic(self, topic, qos=0):
+    def remove_topic(self, topic, qos=None):
         if self.active:
             super().remove_topic(topic, qos)
 
-    def publish_message(self, message, qos=2):
+    def publish_message(self, message, qos=None):
         self.publish_topic('message',
                            message,
                            qos=qos,
                            retain=False)
 
-    def publish_settings(self, qos=2, retain=False):
+    def publish_settings(self, qos=None, retain=None):
         self.publish_topic('settings',
                            SettingsView.get_settings(),
                            qos=qos,
                            retain=retain)
 
-    def publish_profile(self, user, qos=2, retain=False):
+    def publish_profile(self, user, qos=None, retain=None):
         self.publish_topic('user/{}/profile'.format(user.username),
                            UserProfileSerializer(user),
                            qos=qos,
@@ -119,7 +212,7 @@ class PublishClient(BaseClient):
     def remove_profile(self, user):
         self.remove_topic('user/{}/profile'.format(user.username))
 
-    def publish_ambulance(self, ambulance, qos=2, retain=False):
+    def publish_ambulance(self, ambulance, qos=None, retain=None):
         self.publish_topic('ambulance/{}/data'.format(ambulance.id),
                            AmbulanceSerializer(ambulance),
                            qos=qos,
@@ -128,7 +221,7 @@ class PublishClient(BaseClient):
     def remove_ambulance(self, ambulance):
         self.remove_topic('ambulance/{}/data'.format(ambulance.id))
 
-    def publish_hospital(self, hospital, qos=2, retain=False):
+    def publish_hospital(self, hospital, qos=None, retain=None):
         self.publish_topic('hospital/{}/data'.format(hospital.id),
                            HospitalSerializer(hospital),
                            qos=qos,
@@ -138,7 +231,7 @@ class PublishClient(BaseClient):
         self.remove_topic('hospital/{}/data'.format(hospital.id))
         self.remove_topic('equipment/{}/metadata'.format(hospital.equipmentholder.id))
 
-    def publish_equipment_metadata(self, equipmentholder, qos=2, retain=False):
+    def publish_equipment_metadata(self, equipmentholder, qos=None, retain=None):
         equipment_items = equipmentholder.equipmentitem_set.values('equipment')
         equipments = Equipment.objects.filter(id__in=equipment_items)
         self.publish_topic('equipment/{}/metadata'.format(equipmentholder.id),
@@ -146,21 +239,25 @@ class PublishClient(BaseClient):
                            qos=qos,
                            retain=retain)
 
-    def publish_equipment_item(self, equipment_item, qos=2, retain=False):
+    def publish_equipment_item(self, equipment_item, qos=None, retain=None):
         self.publish_topic('equipment/{}/item/{}/data'.format(equipment_item.equipmentholder.id,
                                                               equipment_item.equipment.id),
                            EquipmentItemSerializer(equipment_item),
                            qos=qos,
                            retain=retain)
 
+    def publish_equipment_items(self, equipment_items, qos=None, retain=None):
+        for equipment_item in equipment_items:
+            self.publish_equipment_item(equipment_item, qos=qos, retain=retain)
+
     def remove_equipment_item(self, equipment_item):
         self.remove_topic('equipment/{}/item/{}/data'.format(equipment_item.equipmentholder.id,
                                                              equipment_item.equipment.id))
 
-    def publish_call(self, call, qos=2, retain=False):
+    def publish_call(self, call, qos=None, retain=None):
         # otherwise, publish call data
         self.publish_topic('call/{}/data'.format(call.id),
-                           CallSerializer(call),
+                           CallSerializer(call.refresh_related()),
                            qos=qos,
                            retain=retain)
 
@@ -171,7 +268,7 @@ class PublishClient(BaseClient):
 
         self.remove_topic('call/{}/data'.format(call.id))
 
-    def publish_call_status(self, ambulancecall, qos=2, retain=False):
+    def publish_call_status(self, ambulancecall, qos=None, retain=None):
         self.publish_topic('ambulance/{}/call/{}/status'.format(ambulancecall.ambulance_id,
                                                                 ambulancecall.call_id),
                            ambulancecall.status,
@@ -204,6 +301,7 @@ class SingletonPublishClient(PublishClient):
 
             self.active = False
             self.retry = True
+            self.state = 'inactive'
 
             logger.info(">> No connection to MQTT. Will retry later...")
             return
@@ -211,6 +309,22 @@ class SingletonPublishClient(PublishClient):
         # initialization
         from django.conf import settings
 
+        # hand messages to the local publish gateway?
+        gateway = getattr(settings, 'MQTT_PUBLISH_GATEWAY', '')
+        if gateway:
+
+            self.gateway = GatewayConnection(gateway)
+            self.policy = TopicPolicy()
+            self.client_id = 'mqtt_publish_' + str(os.getpid())
+            self.lazy = False
+            self.connected = True
+            self.active = True
+            self.retry = False
+            self.state = 'gateway'
+
+            logger.info(">> Publishing through MQTT gateway '{}'".format(gateway))
+            return
+
         broker = {
             'HOST': settings.MQTT['BROKER_HOST'] if not settings.TESTING else settings.MQTT['BROKER_TEST_HOST'],
             'PORT': 1883,
@@ -222,20 +336,28 @@ class SingletonPublishClient(PublishClient):
         # override client_id
         broker['CLIENT_ID'] = 'mqtt_publish_' + str(os.getpid())
 
+        # connect in the background?
+        lazy = getattr(settings, 'MQTT_PUBLISH_LAZY', False)
+
         try:
 
             # try to connect
             logger.info('>> Connecting to MQTT brocker...')
 
             # initialize PublishClient
-            super().__init__(broker, **kwargs)
+            super().__init__(broker,
+                             lazy=lazy,
+                             buffer_size=getattr(settings, 'MQTT_PUBLISH_BUFFER_SIZE', 10000),
+                             **kwargs)
 
-            # wait for connection
-            while not self.connected:
-                self.loop()
+            if not lazy:
 
-            # start loop
-            self.loop_start()
+                # wait for connection
+                while not self.connected:
+                    self.loop()
+
+                # start loop
+                self.loop_start()
 
             # register atexit handler to make sure it disconnects at exit
             atexit.register(self.disconnect)
@@ -246,12 +368,46 @@ class SingletonPublishClient(PublishClient):
 
             self.active = False
             self.retry = True
+            self.state = 'failed'
 
             logger.info(">> Failed to connect to MQTT brocker '{}'. Will retry later...".format(broker))
             logger.info('>> Generated exception: {}'.format(e))
 
+    def publish(self, topic, payload=None, qos=0, retain=False):
+
+        if getattr(self, 'gateway', None) is not None:
+            # non-blocking local write
+            self.gateway.send(topic, payload, qos, retain)
+            return
+
+        # call super
+        super().publish(topic, payload, qos, retain)
+
+    def get_state(self):
+
+        if getattr(self, 'gateway', None) is not None:
+            return dict(self.gateway.get_state(), client_id=self.client_id)
+
+        # call super
+        return super().get_state()
+
+    @classmethod
+    def postfork(cls):
+        """
+        Discard the client inherited from the parent process and, if lazy, connect in the background.
+        """
+        from django.conf import settings
+
+        cls._shared_state.clear()
+        if getattr(settings, 'MQTT_PUBLISH_LAZY', False):
+            cls()
+
     def disconnect(self):
 
+        if getattr(self, 'gateway', None) is not None:
+            self.gateway.close()
+            return
+
         # try to connect
         logger.info('<< Disconnecting from MQTT brocker')
 
@@ -0,0 +1,430 @@
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+from django.db import DatabaseError, connection
+
+from .lanes import get_ordering_key
+
+logger = logging.getLogger(__name__)
+
+# Records are
+#
+#   length (uint32) | crc32 (uint32) | timestamp (double) | topic length (uint16) | topic | payload
+#
+# where length and crc32 cover the bytes after the crc32. A zero length
+# marks the end of the records of a segment.
+
+RECORD_HEADER = struct.Struct('!II')
+RECORD_BODY = struct.Struct('!dH')
+
+
+def encode_record(topic, payload, timestamp):
+    topic = topic.encode('utf-8')
+    body = RECORD_BODY.pack(timestamp, len(topic)) + topic + (payload or b'')
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_record(buffer, offset):
+    """
+    Returns (timestamp, topic, payload, next offset) or None if there is no valid record at offset.
+    """
+    if offset + RECORD_HEADER.size > len(buffer):
+        return None
+    (length, crc) = RECORD_HEADER.unpack_from(buffer, offset)
+    start = offset + RECORD_HEADER.size
+    if length < RECORD_BODY.size or start + length > len(buffer):
+        return None
+    body = buffer[start:start + length]
+    if zlib.crc32(body) != crc:
+        return None
+    (timestamp, topic_length) = RECORD_BODY.unpack_from(body, 0)
+    topic = bytes(body[RECORD_BODY.size:RECORD_BODY.size + topic_length]).decode('utf-8')
+    payload = bytes(body[RECORD_BODY.size + topic_length:])
+    return timestamp, topic, payload, start + length
+
+
+class Spool:
+    """
+    Append-only, memory-mapped spool of messages.
+
+    Messages are appended to segment files of segment_size bytes and
+    flushed to disk at most every sync_interval seconds, so appends only
+    cost a copy into the page cache. A single reader reads them back in
+    order and commits its position once they are applied; segments that
+    were read entirely are removed. After a crash, messages appended after
+    the last flush may be lost and messages read after the last commit
+    are read again.
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, sync_interval=0.05):
+
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        os.makedirs(path, exist_ok=True)
+
+        # one process per spool
+        self.lock_file = open(os.path.join(path, 'lock'), 'w')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        self.condition = threading.Condition()
+        self.stats = {'appended': 0, 'replayed': 0, 'syncs': 0}
+
+        # committed read position
+        (self.commit_seq, self.commit_pos) = self.load_offset()
+
+        # find the end of the last segment and count pending records
+        self.depth = 0
+        segments = self.get_segments()
+        self.write_seq = segments[-1] if segments else max(self.commit_seq, 1)
+        self.write_pos = 0
+        for seq in segments:
+            if seq < self.commit_seq:
+                os.unlink(self.get_segment_path(seq))
+                continue
+            (count, end) = self.scan(seq, self.commit_pos if seq == self.commit_seq else 0)
+            self.depth += count
+            if seq == self.write_seq:
+                self.write_pos = end
+
+        # reader
+        self.read_seq = self.commit_seq
+        self.read_pos = self.commit_pos
+        self.reader = None
+        self.reader_seq = None
+
+        # writer
+        self.writer = None
+        self.open_writer(self.write_seq)
+        self.dirty = False
+
+        # flush in the background
+        self.closed = False
+        self.flusher = threading.Thread(target=self.flush_forever, daemon=True)
+        self.flusher.start()
+
+    # files
+
+    def get_segment_path(self, seq):
+        return os.path.join(self.path, 'spool-{:010d}.log'.format(seq))
+
+    def get_segments(self):
+        return sorted(int(name[6:16]) for name in os.listdir(self.path)
+                      if name.startswith('spool-') and name.endswith('.log'))
+
+    def load_offset(self):
+        try:
+            with open(os.path.join(self.path, 'offset')) as file:
+                offset = json.load(file)
+            return offset['seq'], offset['pos']
+        except (OSError, ValueError, KeyError):
+            segments = self.get_segments()
+            return (segments[0] if segments else 1), 0
+
+    def save_offset(self):
+        # call with condition held
+        filename = os.path.join(self.path, 'offset')
+        with open(filename + '.tmp', 'w') as file:
+            json.dump({'seq': self.commit_seq, 'pos': self.commit_pos}, file)
+        os.replace(filename + '.tmp', filename)
+
+    def map(self, seq, size=None):
+        with open(self.get_segment_path(seq), 'r+b' if size is None else 'w+b') as file:
+            if size is not None:
+                file.truncate(size)
+            return mmap.mmap(file.fileno(), 0)
+
+    def scan(self, seq, offset):
+        buffer = self.map(seq)
+        try:
+            count = 0
+            while True:
+                record = decode_record(buffer, offset)
+                if record is None:
+                    return count, offset
+                offset = record[3]
+                count += 1
+        finally:
+            buffer.close()
+
+    # writer
+
+    def open_writer(self, seq, size=None):
+        # call with condition held
+        if self.writer is not None:
+            if self.reader is self.writer:
+                # map again when read
+                self.reader = None
+                self.reader_seq = None
+            self.writer.flush()
+            self.writer.close()
+        if os.path.exists(self.get_segment_path(seq)):
+            self.writer = self.map(seq)
+        else:
+            self.writer = self.map(seq, size or self.segment_size)
+        self.write_seq = seq
+
+    def append(self, topic, payload):
+
+        record = encode_record(topic, payload, time.time())
+        with self.condition:
+            if self.write_pos + len(record) + RECORD_HEADER.size > len(self.writer):
+                # next segment, large enough for the record
+                self.open_writer(self.write_seq + 1, max(self.segment_size, len(record) + RECORD_HEADER.size))
+                self.write_pos = 0
+            self.writer[self.write_pos:self.write_pos + len(record)] = record
+            self.write_pos += len(record)
+            self.dirty = True
+            self.depth += 1
+            self.stats['appended'] += 1
+            self.condition.notify_all()
+
+    def flush(self):
+        with self.condition:
+            if self.dirty:
+                self.writer.flush()
+                self.dirty = False
+                self.stats['syncs'] += 1
+
+    def flush_forever(self):
+        while not self.closed:
+            time.sleep(self.sync_interval)
+            self.flush()
+
+    # reader
+
+    def read(self, limit=100, timeout=None):
+        """
+        Returns up to limit records (timestamp, topic, payload, position) after the last read, waiting up to
+        timeout seconds for one.
+        """
+        records = []
+        with self.condition:
+
+            if timeout is not None:
+                self.condition.wait_for(lambda: (self.read_seq, self.read_pos) < (self.write_seq, self.write_pos)
+                                        or self.closed, timeout)
+
+            while len(records) < limit and (self.read_seq, self.read_pos) < (self.write_seq, self.write_pos):
+
+                if self.reader_seq != self.read_seq:
+                    if self.reader is not None:
+                        self.reader.close()
+                    self.reader = self.writer if self.read_seq == self.write_seq else self.map(self.read_seq)
+                    self.reader_seq = self.read_seq
+
+                record = decode_record(self.reader, self.read_pos)
+                if record is None:
+                    # end of segment
+                    if self.reader is not self.writer:
+                        self.reader.close()
+                    self.reader = None
+                    self.reader_seq = None
+                    self.read_seq += 1
+                    self.read_pos = 0
+                    continue
+
+                (timestamp, topic, payload, self.read_pos) = record
+                records.append((timestamp, topic, payload, (self.read_seq, self.read_pos)))
+
+        return records
+
+    def rewind(self):
+        """
+        Read again from the last commit.
+        """
+        with self.condition:
+            if self.reader is not None and self.reader is not self.writer:
+                self.reader.close()
+            self.reader = None
+            self.reader_seq = None
+            (self.read_seq, self.read_pos) = (self.commit_seq, self.commit_pos)
+
+    def commit(self, position, count):
+        """
+        Record that the records up to position, count of them, were applied.
+        """
+        with self.condition:
+            previous = self.commit_seq
+            (self.commit_seq, self.commit_pos) = position
+            self.depth -= count
+            self.stats['replayed'] += count
+            self.save_offset()
+
+        # remove segments read entirely
+        for seq in range(previous, self.commit_seq):
+            try:
+                os.unlink(self.get_segment_path(seq))
+            except FileNotFoundError:
+                pass
+
+    def get_stats(self):
+        """
+        Returns counters, the depth in records and the age in seconds of the oldest record not applied.
+        """
+        with self.condition:
+            lag = 0
+            if self.depth:
+                seq = self.commit_seq
+                buffer = self.writer if seq == self.write_seq else self.map(seq)
+                record = decode_record(buffer, self.commit_pos)
+                if record is None and buffer is not self.writer:
+                    # oldest record starts the next segment
+                    buffer.close()
+                    seq += 1
+                    buffer = self.writer if seq == self.write_seq else self.map(seq)
+                    record = decode_record(buffer, 0)
+                if record is not None:
+                    lag = max(time.time() - record[0], 0)
+                if buffer is not self.writer:
+                    buffer.close()
+            return dict(self.stats, depth=self.depth, lag=lag)
+
+    def write_stats(self):
+        """
+        Write a snapshot of the statistics, for monitoring while the spool is locked.
+        """
+        filename = os.path.join(self.path, 'stats.json')
+        with open(filename + '.tmp', 'w') as file:
+            json.dump(dict(self.get_stats(), timestamp=time.time()), file)
+        os.replace(filename + '.tmp', filename)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.flusher.join()
+        with self.condition:
+            self.writer.flush()
+            if self.reader is not None and self.reader is not self.writer:
+                self.reader.close()
+            self.writer.close()
+        self.lock_file.close()
+
+
+class SpoolReplayer:
+    """
+    Apply spooled messages to the database, in order.
+
+    Waits while the database is unavailable. A message whose handler hit a
+    database error that left the connection unusable is applied again once
+    the database is back.
+
+    With a LaneScheduler, each batch is applied lane by lane and committed
+    as a whole, and telemetry is coalesced while the spool is behind.
+    """
+
+    def __init__(self, spool, apply, batch_size=100, retry=1.0, stats_interval=300, snapshot_interval=10,
+                 scheduler=None, report=None, report_interval=0):
+        self.spool = spool
+        self.apply = apply
+        self.batch_size = batch_size
+        self.retry = retry
+        self.stats_interval = stats_interval
+        self.snapshot_interval = snapshot_interval
+        self.scheduler = scheduler
+        self.report = report
+        self.report_interval = report_interval
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stopping = True
+        self.thread.join(timeout)
+
+    def wait_for_database(self):
+        while not self.stopping:
+            try:
+                connection.ensure_connection()
+                return True
+            except DatabaseError as e:
+                logger.warning('Spool replayer: database unavailable, retrying: {}'.format(e))
+                connection.close()
+                time.sleep(self.retry)
+        return False
+
+    def prioritize(self, records):
+
+        # coalesce telemetry if the spool is behind
+        overloaded = self.spool.depth >= self.scheduler.coalesce_threshold
+        for (timestamp, topic, payload, position) in records:
+            self.scheduler.put(get_ordering_key(topic), SimpleNamespace(topic=topic, payload=payload),
+                               overloaded=overloaded)
+
+        messages = []
+        entry = self.scheduler.get()
+        while entry is not None:
+            messages.append((entry[1].topic, entry[1].payload, None))
+            entry = self.scheduler.get()
+        return messages
+
+    def get_stats(self):
+        stats = {'spool': self.spool.get_stats()}
+        if self.scheduler is not None:
+            stats['lanes'] = self.scheduler.get_stats()
+        return stats
+
+    def run(self):
+
+        logged_on = snapshot_on = reported_on = time.monotonic()
+        while not self.stopping:
+
+            if self.stats_interval and time.monotonic() - logged_on > self.stats_interval:
+                logger.info('Spool: {}'.format(self.get_stats()))
+                logged_on = time.monotonic()
+
+            if self.snapshot_interval and time.monotonic() - snapshot_on > self.snapshot_interval:
+                self.spool.write_stats()
+                snapshot_on = time.monotonic()
+
+            if self.report is not None and self.report_interval and \
+                    time.monotonic() - reported_on > self.report_interval:
+                self.report(self.get_stats())
+                reported_on = time.monotonic()
+
+            records = self.spool.read(self.batch_size, timeout=1)
+            if not records:
+                continue
+
+            if self.scheduler is None:
+                messages = [(topic, payload, position) for (timestamp, topic, payload, position) in records]
+            else:
+                messages = self.prioritize(records)
+
+            applied = 0
+            for (topic, payload, position) in messages:
+
+                if not self.wait_for_database():
+                    break
+
+                self.apply(topic, payload)
+
+                # the database failed while applying, apply again
+                if connection.errors_occurred:
+                    if connection.is_usable():
+                        connection.errors_occurred = False
+                    else:
+                        connection.close()
+                        break
+
+                applied += 1
+
+            if applied == len(messages):
+                self.spool.commit(records[-1][3], len(records))
+            else:
+                if applied and self.scheduler is None:
+                    self.spool.commit(messages[applied - 1][2], applied)
+                self.spool.rewind()
+
+        connection.close()
@@ -1,6 +1,8 @@
 import logging
 from io import BytesIO
 
+import paho.mqtt.client as mqtt
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
@@ -8,16 +10,19 @@ from rest_framework.exceptions import PermissionDenied
 from rest_framework.parsers import JSONParser
 from rest_framework.renderers import JSONRenderer
 
+from ambulance.ingest import reporting_policy
 from ambulance.models import Ambulance, CallStatus, AmbulanceCallStatus, AmbulanceCall, Waypoint
 from ambulance.models import Call
 from ambulance.serializers import AmbulanceSerializer, AmbulanceUpdateSerializer, WaypointSerializer
-from equipment.models import EquipmentItem
-from equipment.serializers import EquipmentItemSerializer
+from equipment.models import EquipmentItem, EquipmentHolder
+from equipment.serializers import EquipmentItemSerializer, EquipmentItemBulkSerializer
 from hospital.models import Hospital
 from hospital.serializers import HospitalSerializer
 from login.models import Client, ClientLog, ClientStatus, ClientActivity
-from login.permissions import cache_clear
+from login.permissions import cache_clear, get_permissions
 from .client import BaseClient
+from .lanes import LaneScheduler
+from .spool import SpoolReplayer
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +43,82 @@ class ClientException(Exception):
 
 class SubscribeClient(BaseClient):
 
+    def __init__(self, broker, **kwargs):
+
+        # write messages to a spool first?
+        self.spool = kwargs.pop('spool', None)
+        self.spool_handlers = {}
+
+        # publish ingest metrics every metrics_interval seconds
+        self.metrics_interval = kwargs.pop('metrics_interval', getattr(settings, 'INGEST', {})
+                                           .get('METRICS_INTERVAL', 60))
+
+        # call super
+        super().__init__(broker, **kwargs)
+
+        if self.spool is not None:
+            options = getattr(settings, 'MQTT_SPOOL', {})
+            self.replayer = SpoolReplayer(self.spool, self.replay,
+                                          batch_size=options.get('BATCH_SIZE', 100),
+                                          stats_interval=options.get('STATS_INTERVAL', 300),
+                                          scheduler=LaneScheduler(policy=self.policy),
+                                          report=lambda stats: self.publish_metrics('ingest', stats),
+                                          report_interval=self.metrics_interval)
+            self.replayer.start()
+
+    def publish_metrics(self, name, stats):
+        self.publish_topic('metrics/{}'.format(name), stats, retain=True)
+
+    def subscribe(self, topic, qos=None):
+
+        # qos from policy of the topic
+        if qos is None:
+            qos = self.policy.get(topic)['qos']
+
+        # share subscriptions among subscribers in the same group
+        group = self.broker.get('SHARED_GROUP', '')
+        if self.v5 and group:
+            topic = '$share/{}/{}'.format(group, topic)
+
+        super().subscribe(topic, qos)
+
+    def add_handler(self, topic, handler, spool=True):
+
+        if spool and self.spool is not None:
+            # applied by the replayer
+            self.spool_handlers[topic] = handler
+            self.client.message_callback_add(topic, self.on_spool)
+
+        else:
+            self.client.message_callback_add(topic, handler)
+
+    def on_spool(self, client, userdata, msg):
+        self.spool.append(msg.topic, msg.payload)
+
+    def replay(self, topic, payload):
+
+        msg = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+        msg.payload = payload
+
+        # as paho, call all matching handlers
+        handled = False
+        for (pattern, handler) in list(self.spool_handlers.items()):
+            if mqtt.topic_matches_sub(pattern, topic):
+                handler(self.client, None, msg)
+                handled = True
+
+        if not handled:
+            logger.warning("Spooled message '{}' has no handler".format(topic))
+
+    def disconnect(self):
+
+        # call super
+        super().disconnect()
+
+        if self.spool is not None:
+            self.replayer.stop()
+            self.spool.close()
+
     # The callback for when the client receives a CONNACK
     # response from the server.
     def on_connect(self, client, userdata, flags, rc):
@@ -51,46 +132,52 @@ class SubscribeClient(BaseClient):
         # client.subscribe('#', 2)
 
         # message handler
-        self.client.message_callback_add('message',
-                                         self.on_message)
+        self.add_handler('message',
+                         self.on_message,
+                         spool=False)
 
         # ambulance handler
-        self.client.message_callback_add('user/+/client/+/ambulance/+/data',
-                                         self.on_ambulance)
+        self.add_handler('user/+/client/+/ambulance/+/data',
+                         self.on_ambulance)
 
         # # client ambulance status handler
-        # self.client.message_callback_add('user/+/client/+/ambulance/+/status',
-        #                                  self.on_client_ambulance_status)
+        # self.add_handler('user/+/client/+/ambulance/+/status',
+        #                  self.on_client_ambulance_status)
 
         # hospital handler
-        self.client.message_callback_add('user/+/client/+/hospital/+/data',
-                                         self.on_hospital)
+        self.add_handler('user/+/client/+/hospital/+/data',
+                         self.on_hospital)
 
         # hospital equipment handler
-        self.client.message_callback_add('user/+/client/+/equipment/+/item/+/data',
-                                         self.on_equipment_item)
+        self.add_handler('user/+/client/+/equipment/+/item/+/data',
+                         self.on_equipment_item)
+
+        # hospital equipment bulk handler
+        self.add_handler('user/+/client/+/equipment/+/data',
+                         self.on_equipment_items)
 
         # client status handler
-        self.client.message_callback_add('user/+/client/+/status',
-                                         self.on_client_status)
+        self.add_handler('user/+/client/+/status',
+                         self.on_client_status)
 
         # ambulance call handler
-        self.client.message_callback_add('user/+/client/+/ambulance/+/call/+/status',
-                                         self.on_call_ambulance)
+        self.add_handler('user/+/client/+/ambulance/+/call/+/status',
+                         self.on_call_ambulance)
 
         # ambulance call waypoint handler
-        self.client.message_callback_add('user/+/client/+/ambulance/+/call/+/waypoint/+/data',
-                                         self.on_call_ambulance_waypoint)
-
-        # subscribe
-        self.subscribe('message', 2)
-        self.subscribe('user/+/client/+/ambulance/+/data', 2)
-        # self.subscribe('user/+/client/+/ambulance/+/status', 2)
-        self.subscribe('user/+/client/+/hospital/+/data', 2)
-        self.subscribe('user/+/client/+/equipment/+/item/+/data', 2)
-        self.subscribe('user/+/client/+/status', 2)
-        self.subscribe('user/+/client/+/ambulance/+/call/+/status', 2)
-        self.subscribe('user/+/client/+/ambulance/+/call/+/waypoint/+/data', 2)
+        self.add_handler('user/+/client/+/ambulance/+/call/+/waypoint/+/data',
+                         self.on_call_ambulance_waypoint)
+
+        # subscribe, with qos from policy
+        self.subscribe('message')
+        self.subscribe('user/+/client/+/ambulance/+/data')
+        # self.subscribe('user/+/client/+/ambulance/+/status')
+        self.subscribe('user/+/client/+/hospital/+/data')
+        self.subscribe('user/+/client/+/equipment/+/item/+/data')
+        self.subscribe('user/+/client/+/equipment/+/data')
+        self.subscribe('user/+/client/+/status')
+        self.subscribe('user/+/client/+/ambulance/+/call/+/status')
+        self.subscribe('user/+/client/+/ambulance/+/call/+/waypoint/+/data')
 
         logger.info(">> Listening to MQTT messages...")
 
@@ -304,8 +391,16 @@ class SubscribeClient(BaseClient):
 
                 if serializer.is_valid():
 
-                    # save to database
-                    serializer.save(updated_by=user)
+                    # enforce reporting policy
+                    if reporting_policy.check(client.client_id, ambulance.status, serializer.validated_data):
+
+                        # save to database
+                        serializer.save(updated_by=user)
+
+                    else:
+
+                        logger.debug('on_ambulance: throttled by reporting policy')
+
                     is_valid = True
 
             if not is_valid:
@@ -472,6 +567,82 @@ class SubscribeClient(BaseClient):
 
         logger.debug('on_equipment_item: DONE')
 
+    # Update equipment in bulk
+
+    def on_equipment_items(self, clnt, userdata, msg):
+
+        try:
+
+            logger.debug("on_equipment_items: msg = '{}:{}'".format(msg.topic, msg.payload))
+
+            # parse topic
+            user, client, data, equipmentholder_id = self.parse_topic(msg, 4)
+
+        except Exception as e:
+
+            logger.debug("on_equipment_items: ParseException '{}'".format(e))
+            return
+
+        try:
+
+            # retrieve equipmentholder
+            equipmentholder = EquipmentHolder.objects.get(id=equipmentholder_id)
+
+        except EquipmentHolder.DoesNotExist:
+
+            # send error message to user
+            self.send_error_message(user, client, msg.topic, msg.payload,
+                                    "Equipmentholder with id '{}' does not exist".format(equipmentholder_id))
+            return
+
+        except Exception as e:
+
+            # send error message to user
+            self.send_error_message(user, client, msg.topic, msg.payload,
+                                    "Exception: '{}'".format(e))
+            return
+
+        try:
+
+            logger.debug('on_equipment_items: equipmentholder = {}'.format(equipmentholder))
+
+            # check permission once for all items
+            if not (user.is_superuser or user.is_staff or
+                    get_permissions(user).check_can_write(equipment=equipmentholder.id)):
+                # send error message to user
+                self.send_error_message(user, client, msg.topic, msg.payload,
+                                        "User '{}' is not authorized to update equipmentholder '{}'"
+                                        .format(user.username, equipmentholder.id))
+                return
+
+            # update equipment items
+            serializer = EquipmentItemBulkSerializer(equipmentholder,
+                                                     data=data)
+            if serializer.is_valid():
+
+                logger.debug('on_equipment_items: valid serializer')
+
+                # save to database
+                serializer.save(updated_by=user)
+
+            else:
+
+                logger.debug('on_equipment_items: INVALID serializer')
+
+                # send error message to user
+                self.send_error_message(user, client, msg.topic, msg.payload,
+                                        serializer.errors)
+
+        except Exception as e:
+
+            logger.debug('on_equipment_items: EXCEPTION')
+
+            # send error message to user
+            self.send_error_message(user, client, msg.topic, msg.payload,
+                                    "Exception '{}'".format(e))
+
+        logger.debug('on_equipment_items: DONE')
+
     # update client information
 
     def on_client_status(self, clnt, userdata, msg):
@@ -6,7 +6,7 @@ from django.conf import settings
 
 from ambulance.models import Ambulance, \
     AmbulanceStatus
-from mqtt.publish import SingletonPublishClient
+from mqtt.publish import SingletonPublishClient, PublishClient
 from .client import MQTTTestCase, MQTTTestClient, TestMQTT
 from mqtt.client import RETRY_TIMER_SECONDS
 
@@ -79,3 +79,63 @@ class TestMQTTBuffer(TestMQTT, MQTTTestCase):
         # assert change
         obj = Ambulance.objects.get(id=self.a1.id)
         self.assertEqual(obj.status, AmbulanceStatus.OS.name)
+
+
+class TestMQTTLazyPublish(TestMQTT, MQTTTestCase):
+
+    def test(self):
+        # Start client as admin
+        broker = {
+            'HOST': settings.MQTT['BROKER_TEST_HOST'],
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True
+        }
+
+        # Start test client
+
+        broker.update(settings.MQTT)
+        broker['CLIENT_ID'] = 'test_lazy_1'
+
+        client = MQTTTestClient(broker,
+                                check_payload=False,
+                                debug=True)
+        self.is_connected(client)
+
+        # subscribe to ambulance/+/data
+        topic = 'ambulance/{}/data'.format(self.a1.id)
+        client.expect(topic)
+        self.is_subscribed(client)
+
+        # lazy client does not block and buffers until connected
+        broker['CLIENT_ID'] = 'test_lazy_2'
+        publish_client = PublishClient(broker, lazy=True)
+        publish_client.publish_ambulance(self.a1)
+
+        k = 0
+        while publish_client.get_state()['state'] != 'connected' and k < 50:
+            k += 1
+            time.sleep(TestMQTT.DELAY)
+
+        state = publish_client.get_state()
+        self.assertEqual(state['state'], 'connected')
+        self.assertTrue(state['lazy'])
+        self.assertIsNotNone(state['connect_latency'])
+
+        # buffered message is delivered
+        self.loop(client)
+        client.wait()
+        self.assertEqual(publish_client.get_state()['buffered'], 0)
+
+        # messages left in the buffer are sent with the next publish
+        client.expect(topic)
+        client.expect(topic)
+        publish_client.add_to_buffer(topic, '{}', qos=1)
+        publish_client.publish_ambulance(self.a1)
+        self.assertEqual(publish_client.get_state()['buffered'], 0)
+
+        self.loop(client)
+        client.wait()
+
+        publish_client.disconnect()
+        publish_client.loop_stop()
@@ -0,0 +1,71 @@
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.test import TestCase
+
+from mqtt.engine import AsyncioSubscribeClient, get_ordering_key
+
+
+class TestMQTTEngine(TestCase):
+
+    def test_ordering_key(self):
+
+        self.assertEqual(get_ordering_key('user/admin/client/c1/ambulance/1/data'), 'client/c1')
+        self.assertEqual(get_ordering_key('user/admin/client/c1/ambulance/1/call/2/status'), 'client/c1')
+        self.assertEqual(get_ordering_key('user/admin/client/c1/status'), 'client/c1')
+        self.assertEqual(get_ordering_key('message'), 'message')
+
+    def test_dispatch(self):
+
+        broker = {
+            'HOST': settings.MQTT['BROKER_TEST_HOST'],
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True
+        }
+        broker.update(settings.MQTT)
+        broker['CLIENT_ID'] = 'test_engine_1'
+
+        # does not connect until the loop runs
+        client = AsyncioSubscribeClient(broker, workers=4, max_pending=1000)
+
+        handled = []
+        running = set()
+        overlapping = []
+        lock = threading.Lock()
+
+        def handler(clnt, userdata, msg):
+            with lock:
+                if msg.topic in running:
+                    overlapping.append(msg.topic)
+                running.add(msg.topic)
+            time.sleep(random.uniform(0, 0.01))
+            with lock:
+                running.discard(msg.topic)
+                handled.append((msg.topic, msg.payload))
+
+        topics = ['user/admin/client/c{}/ambulance/{}/data'.format(i, i) for i in range(4)]
+        for k in range(20):
+            for topic in topics:
+                client.dispatch(handler, SimpleNamespace(topic=topic, payload=k))
+
+        client.loop.run_until_complete(client.drain(10))
+        client.executor.shutdown(wait=True)
+        client.loop.close()
+
+        # all handled, in order per client
+        self.assertEqual(len(handled), 80)
+        for topic in topics:
+            self.assertEqual([payload for (t, payload) in handled if t == topic], list(range(20)))
+
+        # never two messages of the same client at once
+        self.assertEqual(overlapping, [])
+
+        stats = client.get_stats()
+        self.assertEqual(stats['dispatched'], 80)
+        self.assertEqual(stats['handled'], 80)
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['busy'], 0)
@@ -0,0 +1,144 @@
+import os
+import tempfile
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+from django.test import TestCase
+
+from mqtt.client import MQTTException
+from mqtt.gateway import GatewayQueue, PublishGateway, decode_frames, encode_frame
+
+
+class GatewayTestClient:
+    """
+    Records publishes, answering with the given return codes.
+    """
+
+    def __init__(self, rcs=()):
+        self.connected = True
+        self.client = SimpleNamespace(on_connect=lambda *args: None, on_publish=lambda *args: None)
+        self.rcs = list(rcs)
+        self.published = []
+
+    def _publish(self, topic, payload=None, qos=0, retain=False):
+        info = mqtt.MQTTMessageInfo(len(self.published) + 1)
+        info.rc = self.rcs.pop(0) if self.rcs else mqtt.MQTT_ERR_SUCCESS
+        self.published.append((topic, info.mid))
+        if info.rc:
+            raise MQTTException('Could not publish to topic (rc = {})'.format(info.rc), info.rc, info)
+        return info
+
+
+class TestMQTTGateway(TestCase):
+
+    def test_frames(self):
+
+        buffer = encode_frame('ambulance/1/data', b'{"status": "AV"}', qos=2, retain=True) + \
+            encode_frame('message', 'hello', qos=1) + \
+            encode_frame('call/1/data', None, qos=2, retain=True)
+
+        (frames, remaining) = decode_frames(buffer)
+        self.assertEqual(remaining, b'')
+        self.assertEqual(frames, [
+            {'topic': 'ambulance/1/data', 'payload': b'{"status": "AV"}', 'qos': 2, 'retain': True},
+            {'topic': 'message', 'payload': b'hello', 'qos': 1, 'retain': False},
+            {'topic': 'call/1/data', 'payload': None, 'qos': 2, 'retain': True},
+        ])
+
+        # partial frames are kept
+        (frames, remaining) = decode_frames(buffer[:-3])
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(remaining, encode_frame('call/1/data', None, qos=2, retain=True)[:-3])
+        (frames, remaining) = decode_frames(remaining + buffer[-3:])
+        self.assertEqual(frames, [{'topic': 'call/1/data', 'payload': None, 'qos': 2, 'retain': True}])
+        self.assertEqual(remaining, b'')
+
+    def test_queue(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            path = os.path.join(directory, 'queue.sqlite3')
+            queue = GatewayQueue(path)
+
+            queue.put('ambulance/1/data', b'1', qos=2, retain=True)
+            queue.put('message', b'hello', qos=2)
+            queue.put('ambulance/1/data', b'2', qos=2, retain=True)
+            queue.put('message', b'hello', qos=2)
+
+            # pending retained messages are coalesced
+            self.assertEqual(len(queue), 3)
+            self.assertEqual(queue.coalesced, 1)
+
+            messages = queue.take(2)
+            self.assertEqual([(m['topic'], m['payload']) for m in messages],
+                             [('message', b'hello'), ('ambulance/1/data', b'2')])
+
+            # messages in flight are not coalesced
+            queue.put('ambulance/1/data', b'3', qos=2, retain=True)
+            self.assertEqual(len(queue), 4)
+
+            queue.done(messages[0]['id'])
+            self.assertEqual(len(queue), 3)
+
+            # unacknowledged messages are resent after a restart
+            queue = GatewayQueue(path)
+            messages = queue.take(10)
+            self.assertEqual([(m['topic'], m['payload']) for m in messages],
+                             [('ambulance/1/data', b'2'), ('message', b'hello'), ('ambulance/1/data', b'3')])
+            for message in messages:
+                queue.done(message['id'])
+            self.assertEqual(len(queue), 0)
+
+    def test_queue_supersede(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            queue = GatewayQueue(os.path.join(directory, 'queue.sqlite3'))
+
+            # telemetry supersedes pending messages, calls do not
+            queue.put_many([
+                {'topic': 'ambulance/1/data', 'payload': b'1', 'qos': 1},
+                {'topic': 'call/1/data', 'payload': b'1', 'qos': 2},
+                {'topic': 'ambulance/2/data', 'payload': b'1', 'qos': 1},
+                {'topic': 'ambulance/1/data', 'payload': b'2', 'qos': 1},
+                {'topic': 'call/1/data', 'payload': b'2', 'qos': 2},
+            ])
+            self.assertEqual(len(queue), 4)
+            self.assertEqual(queue.coalesced, 1)
+
+            messages = queue.take(10)
+            self.assertEqual([(m['topic'], m['payload']) for m in messages],
+                             [('call/1/data', b'1'), ('ambulance/2/data', b'1'),
+                              ('ambulance/1/data', b'2'), ('call/1/data', b'2')])
+
+            # messages in flight are not coalesced
+            queue.put('ambulance/1/data', b'3', qos=1)
+            self.assertEqual(len(queue), 5)
+            self.assertEqual(queue.coalesced, 1)
+
+    def test_pump(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            queue = GatewayQueue(os.path.join(directory, 'queue.sqlite3'))
+            for i in range(4):
+                queue.put('call/{}/data'.format(i), b'{}', qos=2)
+
+            # the second message is taken by paho while disconnected, the third is not taken
+            client = GatewayTestClient([mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN, mqtt.MQTT_ERR_QUEUE_SIZE])
+            gateway = PublishGateway(client, os.path.join(directory, 'gateway.sock'), queue)
+            gateway.pump()
+            self.assertEqual(sorted(gateway.inflight), [1, 2])
+
+            # messages not taken are published again, messages in flight are not
+            gateway.pump()
+            self.assertEqual([topic for (topic, mid) in client.published],
+                             ['call/0/data', 'call/1/data', 'call/2/data', 'call/2/data', 'call/3/data'])
+
+            # acknowledged once, also after a reconnection
+            for mid in list(gateway.inflight):
+                gateway.post('publish', mid)
+            gateway.handle_events(gateway.wakeup_read)
+            self.assertEqual(gateway.inflight, {})
+            self.assertEqual(len(queue), 0)
+            self.assertEqual(gateway.stats['published'], 4)
@@ -0,0 +1,100 @@
+import json
+from types import SimpleNamespace
+
+from django.test import TestCase
+
+from mqtt.lanes import LaneScheduler, merge_payloads
+
+
+class TestMQTTLanes(TestCase):
+
+    def message(self, topic, payload):
+        return SimpleNamespace(topic=topic, payload=json.dumps(payload).encode())
+
+    def topics(self, scheduler, busy=()):
+        topics = []
+        entry = scheduler.get(busy)
+        while entry is not None:
+            topics.append(entry[1].topic)
+            entry = scheduler.get(busy)
+        return topics
+
+    def test_priority(self):
+
+        scheduler = LaneScheduler(lanes=['call', 'status', 'default', 'telemetry'],
+                                  coalesce_threshold=1000, max_telemetry=100)
+
+        scheduler.put('c1', self.message('user/u/client/c1/ambulance/1/data', {'location': 1}))
+        scheduler.put('c2', self.message('user/u/client/c2/hospital/1/data', {'comment': 'x'}))
+        scheduler.put('c1', self.message('user/u/client/c1/status', 'O'))
+        scheduler.put('c3', self.message('user/u/client/c3/ambulance/3/call/1/status', 'A'))
+
+        # call, status, default, telemetry, the status of c1 promotes its older telemetry
+        self.assertEqual(self.topics(scheduler), ['user/u/client/c3/ambulance/3/call/1/status',
+                                                  'user/u/client/c1/ambulance/1/data',
+                                                  'user/u/client/c1/status',
+                                                  'user/u/client/c2/hospital/1/data'])
+
+        # busy keys are skipped
+        scheduler.put('c1', self.message('user/u/client/c1/status', 'O'))
+        scheduler.put('c2', self.message('user/u/client/c2/status', 'O'))
+        self.assertEqual(scheduler.get(busy={'c1'})[0], 'c2')
+        self.assertIsNone(scheduler.get(busy={'c1'}))
+        self.assertEqual(scheduler.get()[0], 'c1')
+
+    def test_ordering(self):
+
+        scheduler = LaneScheduler(lanes=['call', 'status', 'default', 'telemetry'],
+                                  coalesce_threshold=0, max_telemetry=100)
+
+        # fixes before and after going offline are not merged across the status
+        topic = 'user/u/client/c1/ambulance/1/data'
+        for (key, msg) in [('client/c1', self.message(topic, {'location': 1})),
+                           ('client/c2', self.message('user/u/client/c2/ambulance/2/data', {'location': 2})),
+                           ('client/c1', self.message('user/u/client/c1/status', 'F')),
+                           ('client/c1', self.message(topic, {'location': 3})),
+                           ('client/c2', self.message('user/u/client/c2/status', 'O'))]:
+            scheduler.put(key, msg)
+        self.assertEqual(len(scheduler), 5)
+
+        # each client in arrival order, clients with a status message first
+        self.assertEqual(self.topics(scheduler), [topic,
+                                                  'user/u/client/c1/status',
+                                                  'user/u/client/c2/ambulance/2/data',
+                                                  'user/u/client/c2/status',
+                                                  topic])
+        self.assertEqual(scheduler.get_stats()['telemetry']['depth'], 0)
+
+    def test_coalesce(self):
+
+        scheduler = LaneScheduler(lanes=['call', 'status', 'default', 'telemetry'],
+                                  coalesce_threshold=2, max_telemetry=3)
+
+        topic = 'user/u/client/c1/ambulance/1/data'
+        scheduler.put('c1', self.message(topic, {'location': 1, 'status': 'AV'}))
+        scheduler.put('c1', self.message(topic, {'location': 2}))
+
+        # overloaded
+        scheduler.put('c1', self.message(topic, [{'location': 3}, {'location': 4}]))
+        self.assertEqual(len(scheduler), 2)
+
+        # drop the oldest beyond max_telemetry
+        for i in range(2, 5):
+            scheduler.put('c{}'.format(i), self.message('user/u/client/c{}/ambulance/{}/data'.format(i, i),
+                                                        {'location': i}))
+
+        stats = scheduler.get_stats()['telemetry']
+        self.assertEqual(stats['queued'], 6)
+        self.assertEqual(stats['coalesced'], 1)
+        self.assertEqual(stats['dropped'], 2)
+        self.assertEqual(stats['depth'], 3)
+
+        # the coalesced fix was dropped, the rest keeps arrival order
+        self.assertEqual([json.loads(scheduler.get()[1].payload)['location'] for _ in range(3)], [2, 3, 4])
+
+    def test_merge_payloads(self):
+
+        self.assertEqual(json.loads(merge_payloads(b'{"location": 1, "status": "AV"}',
+                                                   b'[{"location": 2}, {"location": 3}]')),
+                         {'location': 3, 'status': 'AV'})
+        self.assertIsNone(merge_payloads(b'{"location": 1}', b'not json'))
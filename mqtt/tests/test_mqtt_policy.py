@@ -0,0 +1,67 @@
+from django.test import TestCase
+
+from mqtt.policy import PolicyStats, TopicPolicy
+
+
+class TestMQTTPolicy(TestCase):
+
+    def test_policy(self):
+
+        policy = TopicPolicy(topics=[
+            {'pattern': 'ambulance/+/data', 'class': 'telemetry', 'qos': 0, 'retain': False},
+            {'pattern': 'ambulance/+/call/+/status', 'class': 'call', 'qos': 2, 'retain': True},
+            {'pattern': '#', 'class': 'default', 'qos': 1, 'retain': False},
+        ], max_inflight=50, max_queued=1000)
+
+        self.assertEqual(policy.resolve('ambulance/1/data'), ('telemetry', 0, False))
+        self.assertEqual(policy.resolve('ambulance/1/call/2/status'), ('call', 2, True))
+        self.assertEqual(policy.resolve('hospital/1/data'), ('default', 1, False))
+
+        # explicit qos and retain take precedence
+        self.assertEqual(policy.resolve('ambulance/1/data', qos=2, retain=True), ('telemetry', 2, True))
+
+        # subscription filters
+        self.assertEqual(policy.get('ambulance/+/data')['class'], 'telemetry')
+
+    def test_default_policy(self):
+
+        policy = TopicPolicy()
+        self.assertEqual(policy.resolve('ambulance/1/data')[:2], ('telemetry', 1))
+        self.assertEqual(policy.resolve('user/+/client/+/ambulance/+/data')[:2], ('telemetry', 1))
+        self.assertEqual(policy.resolve('ambulance/1/call/2/status')[:2], ('call', 2))
+        self.assertEqual(policy.resolve('user/admin/client/c1/ambulance/1/call/2/waypoint/3/data')[:2],
+                         ('call', 2))
+        self.assertEqual(policy.resolve('hospital/1/data')[:2], ('default', 2))
+
+        # settings override the default table by class
+        with self.settings(MQTT_POLICY={'CLASSES': {'telemetry': {'qos': 0, 'expiry': 10}}}):
+            policy = TopicPolicy()
+        self.assertEqual(policy.resolve('ambulance/1/data')[:2], ('telemetry', 0))
+        self.assertEqual(policy.get('ambulance/1/data')['expiry'], 10)
+        self.assertTrue(policy.get('ambulance/1/data')['alias'])
+        self.assertEqual(policy.resolve('ambulance/1/call/2/status')[:2], ('call', 2))
+
+    def test_stats(self):
+
+        stats = PolicyStats()
+
+        stats.published('telemetry', 1, 10, 0)
+        stats.published('call', 2, 20, 0)
+        stats.acknowledged(1)
+
+        # acknowledged before publish returned
+        stats.acknowledged(3)
+        stats.published('call', 3, 20, 0)
+
+        result = stats.get_stats()
+        self.assertEqual(result['telemetry']['published'], 1)
+        self.assertEqual(result['telemetry']['acknowledged'], 1)
+        self.assertEqual(result['telemetry']['bytes'], 10)
+        self.assertEqual(result['call']['published'], 2)
+        self.assertEqual(result['call']['acknowledged'], 1)
+        self.assertIsNotNone(result['call']['latency'])
+
+        # discard messages in flight
+        stats.discard()
+        stats.acknowledged(2)
+        self.assertEqual(stats.get_stats()['call']['acknowledged'], 1)
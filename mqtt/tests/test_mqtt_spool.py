@@ -0,0 +1,77 @@
+import os
+import tempfile
+import time
+
+from django.test import TestCase
+
+from mqtt.spool import Spool, SpoolReplayer
+
+
+class TestMQTTSpool(TestCase):
+
+    def test_spool(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            # small segments to force rotation
+            spool = Spool(directory, segment_size=256)
+            for i in range(10):
+                spool.append('user/admin/client/c1/ambulance/1/data', '{{"value": {}}}'.format(i).encode())
+
+            records = spool.read(4)
+            self.assertEqual([payload for (_, _, payload, _) in records],
+                             [b'{"value": 0}', b'{"value": 1}', b'{"value": 2}', b'{"value": 3}'])
+            spool.commit(records[-1][3], len(records))
+
+            # read again after rewind
+            records = spool.read(2)
+            spool.rewind()
+            self.assertEqual(spool.read(2), records)
+            spool.rewind()
+
+            stats = spool.get_stats()
+            self.assertEqual(stats['appended'], 10)
+            self.assertEqual(stats['replayed'], 4)
+            self.assertEqual(stats['depth'], 6)
+            self.assertTrue(stats['lag'] >= 0)
+            spool.close()
+
+            # restart from the last commit
+            spool = Spool(directory, segment_size=256)
+            self.assertEqual(spool.get_stats()['depth'], 6)
+            records = spool.read(100)
+            self.assertEqual([payload for (_, _, payload, _) in records],
+                             ['{{"value": {}}}'.format(i).encode() for i in range(4, 10)])
+            spool.commit(records[-1][3], len(records))
+            self.assertEqual(spool.get_stats()['depth'], 0)
+            self.assertEqual(spool.get_stats()['lag'], 0)
+
+            # segments read entirely are removed
+            self.assertEqual(len([name for name in os.listdir(directory) if name.endswith('.log')]), 1)
+            spool.close()
+
+    def test_replayer(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+
+            spool = Spool(directory)
+            applied = []
+            replayer = SpoolReplayer(spool, lambda topic, payload: applied.append((topic, payload)),
+                                     batch_size=3)
+            replayer.start()
+
+            for i in range(10):
+                spool.append('user/admin/client/c1/status', str(i).encode())
+
+            k = 0
+            while len(applied) < 10 and k < 50:
+                k += 1
+                time.sleep(0.1)
+
+            replayer.stop()
+            self.assertEqual(applied, [('user/admin/client/c1/status', str(i).encode()) for i in range(10)])
+            self.assertEqual(spool.get_stats()['depth'], 0)
+
+            spool.write_stats()
+            self.assertTrue(os.path.exists(os.path.join(directory, 'stats.json')))
+            spool.close()
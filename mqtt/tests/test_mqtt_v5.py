@@ -0,0 +1,107 @@
+import logging
+
+from django.conf import settings
+from django.test import TestCase
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.reasoncodes import ReasonCodes
+
+from mqtt.client import BaseClient
+from mqtt.publish import PublishClient
+from .client import MQTTTestCase, MQTTTestClient, TestMQTT
+
+logger = logging.getLogger(__name__)
+
+
+class TestMQTTv5(TestMQTT, MQTTTestCase):
+
+    def test(self):
+        # Start client as admin
+        broker = {
+            'HOST': settings.MQTT['BROKER_TEST_HOST'],
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True
+        }
+
+        # Start test client, on MQTT 3.1.1
+
+        broker.update(settings.MQTT)
+        broker['CLIENT_ID'] = 'test_v5_1'
+
+        client = MQTTTestClient(broker,
+                                check_payload=False,
+                                debug=True)
+        self.is_connected(client)
+
+        # subscribe to ambulance/+/data
+        topic = 'ambulance/{}/data'.format(self.a1.id)
+        client.expect(topic)
+        client.expect(topic)
+        self.is_subscribed(client)
+
+        # publish on MQTT v5 with topic aliases
+        broker['CLIENT_ID'] = 'test_v5_2'
+        broker['PROTOCOL'] = '5'
+        broker['SESSION_EXPIRY'] = 60
+        broker['TOPIC_ALIAS_MAXIMUM'] = 10
+        publish_client = PublishClient(broker)
+        self.assertTrue(publish_client.v5)
+        self.is_connected(publish_client)
+
+        # second message is sent with the alias only
+        publish_client.publish_ambulance(self.a1, qos=0)
+        publish_client.publish_ambulance(self.a1, qos=0)
+        if publish_client.topic_alias_maximum:
+            self.assertEqual(publish_client.topic_aliases, {topic: 1})
+
+        # both are delivered on the full topic
+        self.loop(client, publish_client)
+        client.wait()
+
+        # telemetry uses aliases under the default policy, at QoS 1
+        client.expect(topic)
+        client.expect(topic)
+        publish_client.publish_ambulance(self.a1)
+        publish_client.publish_ambulance(self.a1)
+        if publish_client.topic_alias_maximum:
+            self.assertEqual(publish_client.topic_aliases, {topic: 1})
+
+        self.loop(client, publish_client)
+        client.wait()
+
+        publish_client.wait()
+
+
+class TestMQTTv5Aliases(TestCase):
+
+    def test_reconnect(self):
+
+        broker = {
+            'HOST': 'localhost',
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True,
+            'CLIENT_ID': 'test_v5_aliases',
+            'PROTOCOL': '5',
+        }
+        client = BaseClient(broker, connect_async=True)
+        client.topic_alias_maximum = 10
+
+        # messages in flight while disconnected, the second with the alias only
+        topic = 'ambulance/1/data'
+        info1 = client._publish_v5(topic, b'1', qos=1)
+        info2 = client._publish_v5(topic, b'2', qos=1)
+        messages = client.client._out_messages
+        self.assertEqual(messages[info2.mid].topic, '')
+        self.assertEqual(messages[info2.mid].properties.TopicAlias, 1)
+
+        # resent on the full topic after reconnecting
+        properties = Properties(PacketTypes.CONNACK)
+        properties.TopicAliasMaximum = 10
+        client.on_connect_v5(client.client, None, {}, ReasonCodes(PacketTypes.CONNACK, 'Success'), properties)
+        for info in (info1, info2):
+            self.assertEqual(messages[info.mid].topic, topic)
+            self.assertFalse(hasattr(messages[info.mid].properties, 'TopicAlias'))
+        self.assertEqual(client.aliased, {})
+        self.assertEqual(client.topic_aliases, {})